@@ -0,0 +1,308 @@
+"""Growth and engagement reports, computed with NumPy.
+
+A batch job streams the messages, likes, follows and users tables
+through server-side cursors, CHUNK_SIZE rows at a time, into NumPy
+arrays. It adds them up with vectorized ops and saves the results in
+one compressed .npz file in ANALYTICS_FOLDER:
+
+- posts, likes and distinct posters per day and per week (from Monday)
+- follower and following count histograms, in power-of-two bins
+- percentiles of likes per message, and of likes received per message
+  posted by each user who has posted
+
+Memory grows with the number of days, users and message ids, not with
+the number of rows. The tables are read in one read-only REPEATABLE
+READ transaction, so they agree with each other however busy the site
+is. /admin/analytics shows the saved report to admins (users.is_admin),
+so looking at it never queries the tables.
+
+NumPy is imported by the functions that use it, so web workers, which
+import this for the admin page, only load it once the page is viewed.
+
+Run it daily or so (e.g. from Heroku Scheduler):
+
+    python analytics.py
+"""
+
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+from flask import (
+    Blueprint, current_app, flash, g, redirect, render_template)
+from sqlalchemy import Integer, cast, func, select
+
+from models import db, User, Message, Like, Follows
+
+CHUNK_SIZE = 50_000
+
+PERCENTILES = [50, 90, 99, 100]
+
+REPORT_FILE = "report.npz"
+
+# Day 0, 1970-01-01, was a Thursday; weeks start on Mondays.
+WEEK_OFFSET = 3
+
+analytics = Blueprint("analytics", __name__)
+
+
+def stream(query, chunk_size=CHUNK_SIZE):
+    """Run `query` (integer columns) with a server-side cursor, yielding
+    an int64 array of each `chunk_size` rows, one column per column."""
+
+    import numpy as np
+
+    result = db.session.execute(
+        query.execution_options(stream_results=True,
+                                max_row_buffer=chunk_size))
+    for rows in result.partitions(chunk_size):
+        yield np.array(rows, dtype=np.int64).reshape(-1, len(result.keys()))
+
+
+def day_of(column):
+    """SQL for the day number (days since 1970-01-01) of a timestamp."""
+
+    return cast(func.floor(func.extract("epoch", column) / 86400), Integer)
+
+
+def add_counts(total, counts):
+    """Add bincount arrays of possibly different lengths."""
+
+    if len(counts) > len(total):
+        total, counts = counts, total
+    total[:len(counts)] += counts
+    return total
+
+
+def distinct_pairs(pairs):
+    """Unique rows of a 2-column int64 array of non-negative values, as
+    single int64 keys."""
+
+    import numpy as np
+
+    return np.unique((pairs[:, 0] << 32) | pairs[:, 1])
+
+
+def degree_histogram(degrees):
+    """Counts of `degrees` in bins 0, 1, 2-3, 4-7, 8-15, ...; returns
+    (bin lower bounds, counts)."""
+
+    import numpy as np
+
+    bins = np.zeros(len(degrees), dtype=np.int64)
+    nonzero = degrees > 0
+    bins[nonzero] = np.floor(np.log2(degrees[nonzero])).astype(np.int64) + 1
+
+    counts = np.bincount(bins, minlength=1)
+    lower = np.concatenate([[0], 2 ** np.arange(len(counts) - 1)])
+    return lower, counts
+
+
+def percentiles(values):
+    import numpy as np
+
+    if not len(values):
+        return np.zeros(len(PERCENTILES))
+    return np.percentile(values, PERCENTILES)
+
+
+def compute_report(chunk_size=CHUNK_SIZE):
+    """Compute the report from the database; returns a dict of arrays."""
+
+    # One snapshot for every table, or a like on a message newer than
+    # the message scan would index past the end of author_of.
+    db.session.commit()
+    db.session.connection(execution_options=dict(
+        isolation_level="REPEATABLE READ", postgresql_readonly=True))
+    try:
+        return _compute_report(chunk_size)
+    finally:
+        db.session.rollback()
+
+
+def _compute_report(chunk_size):
+    import numpy as np
+
+    empty = np.zeros(0, dtype=np.int64)
+
+    # Messages: per day counts, distinct posters, and who wrote each id.
+    posts_per_day, author_of = empty, np.full(0, -1, dtype=np.int64)
+    poster_days, poster_weeks = [], []
+    for chunk in stream(select(Message.id, Message.user_id,
+                               day_of(Message.timestamp)), chunk_size):
+        ids, user_ids, days = chunk.T
+        posts_per_day = add_counts(posts_per_day, np.bincount(days))
+
+        if ids.max() >= len(author_of):
+            grown = np.full(ids.max() + 1, -1, dtype=np.int64)
+            grown[:len(author_of)] = author_of
+            author_of = grown
+        author_of[ids] = user_ids
+
+        poster_days.append(distinct_pairs(np.c_[days, user_ids]))
+        poster_weeks.append(distinct_pairs(
+            np.c_[(days + WEEK_OFFSET) // 7, user_ids]))
+
+    # Likes: per day counts, and per message.
+    likes_per_day, likes_per_message = empty, empty
+    for chunk in stream(select(Like.message_id, day_of(Like.timestamp)),
+                        chunk_size):
+        message_ids, days = chunk.T
+        likes_per_day = add_counts(likes_per_day, np.bincount(days))
+        likes_per_message = add_counts(likes_per_message,
+                                       np.bincount(message_ids))
+
+    # Follows: each user's following and follower counts.
+    following, followers = empty, empty
+    for chunk in stream(select(Follows.user_following_id,
+                               Follows.user_being_followed_id), chunk_size):
+        following = add_counts(following, np.bincount(chunk[:, 0]))
+        followers = add_counts(followers, np.bincount(chunk[:, 1]))
+
+    user_ids = np.concatenate(
+        [empty] + [chunk[:, 0]
+                   for chunk in stream(select(User.id), chunk_size)])
+
+    # Line the per-id counts up with the users (and messages) there are.
+    size = user_ids.max() + 1 if len(user_ids) else 0
+    following = add_counts(np.zeros(size, dtype=np.int64), following)
+    followers = add_counts(np.zeros(size, dtype=np.int64), followers)
+    likes_per_message = add_counts(
+        np.zeros(len(author_of), dtype=np.int64), likes_per_message)
+
+    posted = author_of >= 0
+    messages_by = np.bincount(author_of[posted], minlength=size)
+    likes_received = np.bincount(author_of[posted],
+                                 weights=likes_per_message[posted],
+                                 minlength=size)
+    posters = messages_by > 0
+
+    # Days (and weeks) from the first post or like to the last.
+    days = max(len(posts_per_day), len(likes_per_day))
+    posts_per_day = add_counts(np.zeros(days, dtype=np.int64), posts_per_day)
+    likes_per_day = add_counts(np.zeros(days, dtype=np.int64), likes_per_day)
+    poster_keys = np.unique(np.concatenate([empty] + poster_days))
+    posters_per_day = np.bincount(poster_keys >> 32, minlength=days)
+
+    active = np.flatnonzero(posts_per_day + likes_per_day)
+    first = active[0] if len(active) else days
+
+    week_of = (np.arange(days) + WEEK_OFFSET) // 7
+    weeks = week_of[-1] + 1 if days else 0
+    poster_keys = np.unique(np.concatenate([empty] + poster_weeks))
+
+    first_week = week_of[first] if first < days else weeks
+    follower_bins, follower_counts = degree_histogram(followers[user_ids])
+    following_bins, following_counts = degree_histogram(following[user_ids])
+
+    return dict(
+        generated_at=np.array(time.time()),
+        totals=np.array([len(user_ids), posted.sum(),
+                         likes_per_message.sum(), following.sum()]),
+        first_day=np.array(first),
+        posts_per_day=posts_per_day[first:],
+        likes_per_day=likes_per_day[first:],
+        posters_per_day=posters_per_day[first:],
+        first_week=np.array(first_week),
+        posts_per_week=np.bincount(week_of, weights=posts_per_day,
+                                   minlength=weeks)[first_week:],
+        likes_per_week=np.bincount(week_of, weights=likes_per_day,
+                                   minlength=weeks)[first_week:],
+        posters_per_week=np.bincount(poster_keys >> 32,
+                                     minlength=weeks)[first_week:],
+        follower_bins=follower_bins,
+        follower_counts=follower_counts,
+        following_bins=following_bins,
+        following_counts=following_counts,
+        likes_per_message=percentiles(likes_per_message[posted]),
+        like_ratio=percentiles(likes_received[posters]
+                               / messages_by[posters]),
+    )
+
+
+def report_path():
+    return os.path.join(current_app.config["ANALYTICS_FOLDER"], REPORT_FILE)
+
+
+def save_report(report):
+    """Save `report` where the admin page reads it from."""
+
+    import numpy as np
+
+    folder = current_app.config["ANALYTICS_FOLDER"]
+    os.makedirs(folder, exist_ok=True)
+
+    # Written aside and moved into place, so the page never reads half.
+    with tempfile.NamedTemporaryFile(dir=folder, suffix=".npz",
+                                     delete=False) as file:
+        np.savez_compressed(file, **report)
+    os.chmod(file.name, 0o644)
+    os.replace(file.name, report_path())
+
+
+def load_report():
+    """The last saved report, or None if there isn't one."""
+
+    import numpy as np
+
+    try:
+        with np.load(report_path()) as report:
+            return {name: report[name] for name in report.files}
+    except FileNotFoundError:
+        return None
+
+
+def dated(first, counts, step):
+    """[(date, *counts)] rows, newest first, from day number `first`."""
+
+    start = date(1970, 1, 1) + timedelta(days=int(first))
+    return [(start + timedelta(days=i * step), *map(int, values))
+            for i, values in reversed(list(enumerate(zip(*counts))))]
+
+
+@analytics.get("/admin/analytics")
+def show_analytics():
+    """Show the last analytics report to admins."""
+
+    if not g.user or not g.user.is_admin:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    report = load_report()
+    if report is None:
+        return render_template("admin/analytics.html", report=None)
+
+    return render_template(
+        "admin/analytics.html",
+        report=report,
+        generated_at=time.strftime(
+            "%d %B %Y %H:%M UTC", time.gmtime(float(report["generated_at"]))),
+        days=dated(report["first_day"],
+                   (report["posts_per_day"], report["likes_per_day"],
+                    report["posters_per_day"]), step=1)[:30],
+        weeks=dated(report["first_week"] * 7 - WEEK_OFFSET,
+                    (report["posts_per_week"], report["likes_per_week"],
+                     report["posters_per_week"]), step=7)[:12],
+        percentiles=PERCENTILES,
+    )
+
+
+def init_app(app):
+    """Serve the analytics report on `app`."""
+
+    app.config.setdefault(
+        "ANALYTICS_FOLDER", os.path.join(app.instance_path, "analytics"))
+
+    app.register_blueprint(analytics)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        started = time.perf_counter()
+        report = compute_report()
+        save_report(report)
+        print(f"Saved {report_path()} in "
+              f"{time.perf_counter() - started:.1f}s.")
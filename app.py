@@ -1,6 +1,11 @@
+import json
 import os
+import time
+from types import SimpleNamespace
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Blueprint, Flask, Response, current_app, render_template, request, flash,
+    redirect, session, g, abort, jsonify)
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import Unauthorized
 from forms import (
@@ -10,7 +15,13 @@ from forms import (
     CSRFProtectionForm,
     UpdateUserForm,
     )
-from models import db, connect_db, User, Message
+from models import (
+    db, connect_db, User, Message, Like, Notification, Recommendation,
+    TrendingScore, TRENDING_PERIODS)
+# Only what the views need to be defined: feature modules (and what they
+# pull in, like prometheus_client) are imported by create_app() and the
+# views that use them, so `import app` doesn't load them.
+import ratelimit
 # from flask_debugtoolbar import DebugToolbarExtension
 # from functools import wraps
 
@@ -18,28 +29,133 @@ load_dotenv()
 
 CURR_USER_KEY = "curr_user"
 
+bp = Blueprint('warbler', __name__)
 
-app = Flask(__name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-# toolbar = DebugToolbarExtension(app)
-# app.config['DEBUG_TB_HOSTS'] = ['dant-shw-debug-toolbar']
+def env_flag(name, default=""):
+    """Whether environment variable `name` is set to "1", "true" or "yes"."""
 
-connect_db(app)
+    return os.environ.get(name, default).strip().lower() in ("1", "true", "yes")
+
+
+def create_app(config=None):
+    """Create and set up a Warbler app.
+
+    Settings come from environment variables, overridden by anything in
+    the `config` dict.
+    """
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', '')
+        .replace("postgres://", "postgresql://"))
+    app.config['SQLALCHEMY_ECHO'] = False
+    # One connection per thread (or greenlet) that can be serving a
+    # request; gunicorn.conf.py sets DB_POOL_SIZE to match the worker.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': 10,
+        'pool_pre_ping': True,
+    }
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    app.config['JINJA_CACHE_DIR'] = os.environ.get(
+        'JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+    app.config['PRECOMPILE_TEMPLATES'] = env_flag('PRECOMPILE_TEMPLATES', '1')
+    app.config['PROFILER_ENABLED'] = env_flag('PROFILER_ENABLED')
+    app.config['PROFILER_SAMPLE_RATE'] = float(
+        os.environ.get('PROFILER_SAMPLE_RATE', 0))
+    app.config['MEMPROFILE_SAMPLE_RATE'] = float(
+        os.environ.get('MEMPROFILE_SAMPLE_RATE', 0))
+    app.config['PUBSUB_BACKEND'] = os.environ.get('PUBSUB_BACKEND', 'local')
+    # An open stream holds its connection (and, on a sync worker, the
+    # whole worker); gunicorn.conf.py turns this on for async workers.
+    app.config['TIMELINE_STREAM_ENABLED'] = env_flag('TIMELINE_STREAM')
+    app.config['TIMELINE_STREAM_SECONDS'] = 300
+    app.config['TIMELINE_STREAM_HEARTBEAT'] = 15
+    app.config['SHARDS'] = [
+        url for url in os.environ.get('SHARD_DATABASE_URLS', '').split(',')
+        if url]
+    # Shares cached profiles between workers on a host; see singleflight.
+    app.config['SINGLEFLIGHT_DIR'] = os.environ.get('SINGLEFLIGHT_DIR')
+    # gunicorn.conf.py warms workers at boot; see warmup.
+    app.config['WARMUP'] = os.environ.get('WARMUP', '')
+    app.config['WARMUP_SECONDS'] = float(os.environ.get('WARMUP_SECONDS', 10))
+    app.config['WARMUP_MEMORY_MB'] = int(
+        os.environ.get('WARMUP_MEMORY_MB', 64))
+    # toolbar = DebugToolbarExtension(app)
+    # app.config['DEBUG_TB_HOSTS'] = ['dant-shw-debug-toolbar']
+
+    app.config.update(config or {})
+
+    import analytics
+    import autocomplete
+    import availability
+    import export
+    import memprofile
+    import metrics
+    import pagecache
+    import profiler
+    import pubsub
+    import sharding
+    import singleflight
+    import tags
+    import template_cache
+    import uploads
+    import warmup
+
+    connect_db(app)
+    sharding.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    memprofile.init_app(app)
+    ratelimit.init_app(app)
+    singleflight.init_app(app)
+    pubsub.init_app(app)
+    autocomplete.init_app(app)
+    availability.init_app(app)
+    pagecache.init_app(app)
+    warmup.init_app(app)
+    app.register_blueprint(bp)
+    uploads.init_app(app)
+    tags.init_app(app)
+    export.init_app(app)
+    analytics.init_app(app)
+    template_cache.init_app(app)
+
+    return app
+
+
+_default_app = None
+
+
+def __getattr__(name):
+    """Build the default app the first time `app.app` is used.
+
+    This keeps `import app` cheap and free of side effects, while
+    `from app import app` and `gunicorn app:app` still work.
+    """
+
+    global _default_app
+
+    if name == 'app':
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -50,7 +166,7 @@ def add_user_to_g():
         g.user = None
 
 
-@app.before_request
+@bp.before_app_request
 def csrf_protection():
     """CSRFProtectionForm"""
     g.csrf_form = CSRFProtectionForm()
@@ -64,6 +180,44 @@ def csrf_protection():
 #             return redirect("/")
 
 
+def wants_json():
+    """Did the client ask for JSON rather than a page?
+
+    The like and follow buttons' scripts do, so they can update in place
+    instead of following a redirect and re-rendering a whole page.
+    """
+
+    return request.accept_mimetypes.best == 'application/json'
+
+
+def unauthorized():
+    """Flash and redirect home, or a JSON 403 for scripts."""
+
+    if wants_json():
+        return jsonify(error="Access unauthorized."), 403
+
+    flash("Access unauthorized.", "danger")
+    return redirect("/")
+
+
+def follow_state(followed_user):
+    """JSON body describing g.user's follow of `followed_user`."""
+
+    return jsonify(
+        following=g.user.is_following(followed_user),
+        followers_count=followed_user.followers_count,
+        following_count=g.user.following_count,
+    )
+
+
+def mark_taken(form, kinds):
+    """Show which of `form`'s username and email fields are taken."""
+
+    flash("Username or Email already taken", 'danger')
+    for kind in kinds:
+        getattr(form, kind).errors.append(f"That {kind} is already taken.")
+
+
 def do_login(user):
     """Log in user."""
 
@@ -77,7 +231,8 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
+@ratelimit.limit(methods=["POST"])
 def signup():
     """Handle user signup.
 
@@ -89,11 +244,21 @@ def signup():
     and re-present form.
     """
 
+    import autocomplete
+    import availability
+
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Before hashing the password, which is the slow part.
+        taken = availability.taken(username=form.username.data,
+                                   email=form.email.data)
+        if taken:
+            mark_taken(form, taken)
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -107,6 +272,9 @@ def signup():
             flash("Username or Email already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        autocomplete.user_changed(user)
+        availability.user_changed(user)
+        forget_profiles(user.id)
         do_login(user)
 
         return redirect("/")
@@ -115,7 +283,8 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
+@ratelimit.limit(methods=["POST"])
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -136,7 +305,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
     """Handle logout of user and redirect to homepage."""
 
@@ -153,11 +322,13 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@bp.get('/users')
+@ratelimit.limit(when=lambda: request.args.get('q'))
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and
+    an 'after' param for the next page.
     """
 
     if not g.user:
@@ -165,92 +336,198 @@ def list_users():
         return redirect("/")
 
     search = request.args.get('q')
+    users, next_after = User.directory_page(
+        search=search, after=request.args.get('after', type=int))
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
+    return render_template(
+        'users/index.html',
+        users=users,
+        search=search,
+        next_after=next_after,
+        viewer_following=g.user.following_ids_among([u.id for u in users]))
 
 
-@app.get('/users/<int:user_id>')
+@bp.get('/users/<int:user_id>')
 def show_user(user_id):
-    """Show user profile."""
+    """Show user profile, with their newest messages.
+
+    Takes a 'before' param in querystring for older messages.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = profile_snapshot(user_id)
+    if user is None:
+        abort(404)
+
+    before = request.args.get('before', type=int)
+    if before is None:
+        messages, next_before = user.messages, user.next_before
+    else:
+        messages, next_before = Message.posted_by(user_id, before=before)
 
-    return render_template('users/show.html', user=user)
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           next_before=next_before)
+
+
+def profile_snapshot(user_id):
+    """What users/show.html shows about a user and their first page of
+    messages, as plain data.
+
+    Requests for the same profile share one load, cached briefly (see
+    singleflight), so a suddenly popular profile doesn't hit the DB once
+    per request. None if there's no such user.
+    """
 
+    import singleflight
 
-@app.get('/users/<int:user_id>/following')
+    def load():
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+
+        messages, next_before = Message.posted_by(user_id)
+
+        return SimpleNamespace(
+            id=user.id,
+            username=user.username,
+            image_url=user.image_url,
+            header_image_url=user.header_image_url,
+            bio=user.bio,
+            location=user.location,
+            followers_count=user.followers_count,
+            following_count=user.following_count,
+            messages_count=user.messages_count,
+            likes_count=user.likes_count,
+            messages=[
+                SimpleNamespace(id=m.id, text=m.text, timestamp=m.timestamp)
+                for m in messages],
+            next_before=next_before,
+        )
+
+    return singleflight.cached(("profile", user_id), load)
+
+
+def forget_profiles(*user_ids):
+    """Drop cached profiles whose messages, counts or details changed."""
+
+    import singleflight
+
+    singleflight.invalidate(*[("profile", id) for id in user_ids])
+
+
+@bp.get('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show a page of people this user is following.
+
+    Takes an 'after' param in querystring for the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users, next_after = user.following_page(
+        after=request.args.get('after', type=int))
+
+    return render_template(
+        'users/following.html',
+        user=user,
+        users=users,
+        next_after=next_after,
+        viewer_following=g.user.following_ids_among([u.id for u in users]))
 
 
-@app.get('/users/<int:user_id>/followers')
+@bp.get('/users/<int:user_id>/followers')
 def show_followers(user_id):
-    """Show list of followers of this user."""
+    """Show a page of followers of this user.
+
+    Takes an 'after' param in querystring for the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users, next_after = user.followers_page(
+        after=request.args.get('after', type=int))
+
+    return render_template(
+        'users/followers.html',
+        user=user,
+        users=users,
+        next_after=next_after,
+        viewer_following=g.user.following_ids_among([u.id for u in users]))
 
 
-@app.post('/users/follow/<int:follow_id>')
+@bp.post('/users/follow/<int:follow_id>')
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
-    Redirect to following page for the current for the current user.
+    Redirect to following page for the current for the current user, or
+    return the new follow state and counts as JSON if asked for it.
     """
 
+    import events
+    import sharding
+
     if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+        return unauthorized()
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if g.user.follow(followed_user):
+        events.follow_changed(g.user.id, follow_id, True)
     db.session.commit()
+    forget_profiles(g.user.id, follow_id)
+    sharding.follow_changed(g.user.id, follow_id)
+
+    if wants_json():
+        return follow_state(followed_user)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@bp.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
-    Redirect to following page for the current for the current user.
+    Redirect to following page for the current for the current user, or
+    return the new follow state and counts as JSON if asked for it.
     """
 
+    import events
+    import sharding
+
     if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+        return unauthorized()
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+    if g.user.unfollow(followed_user):
+        events.follow_changed(g.user.id, follow_id, False)
     db.session.commit()
+    forget_profiles(g.user.id, follow_id)
+    sharding.follow_changed(g.user.id, follow_id)
+
+    if wants_json():
+        return follow_state(followed_user)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
+    import autocomplete
+    import availability
+    import uploads
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
@@ -258,6 +535,14 @@ def profile():
     form = UpdateUserForm(obj=g.user)
 
     if form.validate_on_submit():
+        # Before checking the password, which is the slow part.
+        taken = availability.taken(user_id=g.user.id,
+                                   username=form.username.data,
+                                   email=form.email.data)
+        if taken:
+            mark_taken(form, taken)
+            return render_template('users/edit.html', form=form)
+
         user = User.authenticate(g.user.username, form.password.data)
 
         if not user:
@@ -270,6 +555,19 @@ def profile():
             g.user.header_image_url = form.header_image_url.data
             g.user.bio = form.bio.data
 
+            try:
+                if form.image_file.data:
+                    g.user.image_url, _ = uploads.store_image(
+                        form.image_file.data.read(), "avatar")
+                if form.header_image_file.data:
+                    g.user.header_image_url, _ = uploads.store_image(
+                        form.header_image_file.data.read(), "header")
+
+            except uploads.InvalidImageError as e:
+                db.session.rollback()
+                flash(str(e), 'danger')
+                return render_template('users/edit.html', form=form)
+
             try:
                 db.session.commit()
 
@@ -278,6 +576,9 @@ def profile():
                 flash("Username or Email already taken", 'danger')
                 return render_template('users/edit.html', form=form)
 
+            autocomplete.user_changed(g.user)
+            availability.user_changed(g.user)
+            forget_profiles(g.user.id)
             flash("User updated.", "success")
 
             return redirect(f'/users/{g.user.id}')
@@ -285,35 +586,51 @@ def profile():
     return render_template('users/edit.html', form=form)
 
 
-@app.post('/users/delete')
+@bp.post('/users/delete')
 def delete_user():
     """Delete user.
 
     Redirect to signup page.
     """
 
+    import autocomplete
+    import events
+    import sharding
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     # TODO: it feels wrong to no ask for a password here, would bring it up to the big man.
     do_logout()
 
+    user_id = g.user.id
+    g.user.release_follow_counts()
     db.session.delete(g.user)
+    events.user_deleted(user_id)
     db.session.commit()
 
+    autocomplete.user_deleted(user_id)
+    forget_profiles(user_id)
+    sharding.user_deleted(user_id)
+
     return redirect("/signup")
 
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def add_message():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
     """
 
+    import events
+    import pubsub
+    import sharding
+    import tags
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
@@ -323,26 +640,142 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        tags.index_messages([(msg.id, msg.text)])
+        events.message_posted(msg)
         db.session.commit()
+        forget_profiles(g.user.id)
+        sharding.message_posted(msg)
+
+        pubsub.publish("messages", {"id": msg.id, "user_id": g.user.id})
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@bp.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
 
+    import archive
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = Message.query.get(message_id)
+    if msg is None:
+        # Old messages may have been moved out to archive files.
+        msg = archive.find_message(message_id)
+        if msg is None:
+            abort(404)
+
+        return render_template('messages/show.html', message=msg,
+                               archived=True)
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.post('/messages/<int:message_id>/delete')
+@bp.get('/tags/<tag>')
+def show_tag(tag):
+    """Show messages tagged #tag, newest first; ?before= pages back."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages, next_before = Message.tagged(
+        tag, before=request.args.get('before', type=int))
+
+    return render_template('messages/timeline.html',
+                           title=f"#{tag.lower()}",
+                           messages=messages,
+                           next_before=next_before)
+
+
+@bp.get('/mentions')
+def show_mentions():
+    """Show messages that @mention the current user, newest first;
+    ?before= pages back."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages, next_before = Message.mentioning(
+        g.user, before=request.args.get('before', type=int))
+
+    return render_template('messages/timeline.html',
+                           title=f"Mentions of @{g.user.username}",
+                           messages=messages,
+                           next_before=next_before)
+
+
+@bp.get('/notifications')
+def show_notifications():
+    """Show the current user's notifications, newest first; ?before=
+    pages back. Unread ones are highlighted; the page's script marks
+    them read with a POST, so prefetches and previews don't."""
+
+    import notifications
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    page, next_before = Notification.page(
+        g.user, before=request.args.get('before', type=int))
+
+    return render_template('users/notifications.html',
+                           notifications=page,
+                           unread={n.id for n in page if not n.read},
+                           actors=notifications.named_actors(page),
+                           next_before=next_before)
+
+
+@bp.post('/notifications/read')
+def mark_notifications_read():
+    """Mark all the current user's notifications read.
+
+    Redirects to the notifications, or returns JSON if asked for it.
+    """
+
+    if not g.user or not g.csrf_form.validate_on_submit():
+        return unauthorized()
+
+    if g.user.unread_notifications:
+        Notification.mark_all_read(g.user)
+        db.session.commit()
+
+    if wants_json():
+        return jsonify(unread_notifications=0)
+
+    return redirect('/notifications')
+
+
+@bp.get('/trending')
+def show_trending():
+    """Show the most-liked recent messages.
+
+    ?period=day (the default) or week sets how fast old likes fade.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    period = request.args.get('period', 'day')
+    if period not in TRENDING_PERIODS:
+        period = 'day'
+
+    return render_template('messages/trending.html',
+                           messages=TrendingScore.top(period, limit=50),
+                           period=period,
+                           periods=TRENDING_PERIODS)
+
+
+@bp.post('/messages/<int:message_id>/delete')
 def delete_message(message_id):
     """Delete a message.
 
@@ -350,13 +783,20 @@ def delete_message(message_id):
     Redirect to user page on success.
     """
 
+    import events
+    import sharding
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
+    author_id = msg.user_id
     db.session.delete(msg)
+    events.message_deleted(message_id, author_id)
     db.session.commit()
+    forget_profiles(author_id)
+    sharding.message_deleted(message_id, author_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -365,7 +805,7 @@ def delete_message(message_id):
 # Homepage and error pages
 
 
-@app.get('/')
+@bp.get('/')
 def homepage():
     """Show homepage:
 
@@ -373,65 +813,143 @@ def homepage():
     - logged in: 100 most recent messages of followed_users
     """
 
+    import sharding
+
     if g.user:
-        followings = [following.id for following in g.user.following]
-        followings.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followings))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        liked_messages = {message.id for message in g.user.liked_messages}
-        user_messages = {message.id for message in g.user.messages}
+        messages = timeline_for(g.user)
+        message_ids = [m.id for m in messages]
+        if sharding.serving():
+            liked_messages = sharding.liked_among(g.user.id, message_ids)
+        else:
+            liked_messages = g.user.liked_among(message_ids)
+        user_messages = {m.id for m in messages if m.user_id == g.user.id}
+        recommendations = Recommendation.for_user(g.user)
 
         return render_template('home.html',
                                messages=messages,
                                liked_messages=liked_messages,
-                               user_messages=user_messages,)
+                               user_messages=user_messages,
+                               recommendations=recommendations,)
 
     else:
         return render_template('home-anon.html')
 
+
+def timeline_for(user):
+    """The newest messages by `user` and the users they follow."""
+
+    import sharding
+
+    if sharding.serving():
+        user_ids = sharding.following_ids(user.id) | {user.id}
+        return sharding.timeline_messages(user_ids)
+
+    user_ids = user.following_ids() | {user.id}
+    return Message.timeline(user_ids)
+
+
+@bp.get('/timeline/stream')
+def stream_timeline():
+    """Stream new timeline messages as server-sent events.
+
+    Sends the id of each new message by the current user or someone
+    they follow as it's posted, for the homepage to offer to show. Each
+    stream ends after TIMELINE_STREAM_SECONDS and the browser reconnects,
+    picking up any follows made since.
+
+    Only async workers serve streams (TIMELINE_STREAM_ENABLED); on other
+    workers each would tie up a whole worker, so this returns 204, which
+    tells browsers not to reconnect.
+    """
+
+    import pubsub
+
+    if not g.user:
+        return Response(status=401)
+
+    config = current_app.config
+    if not config['TIMELINE_STREAM_ENABLED']:
+        return Response(status=204)
+
+    user_ids = g.user.following_ids() | {g.user.id}
+    messages = pubsub.get_pubsub()
+    heartbeat = config['TIMELINE_STREAM_HEARTBEAT']
+    ends_at = time.monotonic() + config['TIMELINE_STREAM_SECONDS']
+
+    # Runs after the request (and its DB session) has finished, so an
+    # idle stream holds no DB connection.
+    def stream():
+        with messages.subscribe("messages") as subscription:
+            yield "retry: 5000\n\n"
+
+            while time.monotonic() < ends_at:
+                message = subscription.get(timeout=heartbeat)
+                if message is None:
+                    # Keeps proxies from closing an idle connection.
+                    yield ": keepalive\n\n"
+                elif message["user_id"] in user_ids:
+                    yield f"data: {json.dumps(message)}\n\n"
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+
 ##############################################################################
 # Likes routes:
 
 
-@app.post('/messages/<int:message_id>/like')
+@bp.post('/messages/<int:message_id>/like')
 def toggle_like(message_id):
-    """add or remove like from warble"""
+    """add or remove like from warble
+
+    Redirects home, or returns the new state as JSON if asked for it.
+    """
+
+    import events
+    import sharding
 
     liked_message = Message.query.get_or_404(message_id)
 
     if (not g.user
         or not g.csrf_form.validate_on_submit()
-            or liked_message in g.user.messages):
+            or liked_message.user_id == g.user.id):
 
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+        return unauthorized()
 
-    # toggle like
-    if liked_message in g.user.liked_messages:
-        g.user.liked_messages.remove(liked_message)
-    else:
-        g.user.liked_messages.append(liked_message)
+    liked = g.user.toggle_like(liked_message)
+    events.like_changed(g.user.id, liked_message, liked)
     db.session.commit()
+    forget_profiles(g.user.id)
+    sharding.like_changed(g.user.id, message_id)
+
+    if wants_json():
+        return jsonify(
+            liked=liked,
+            likes_count=Like.query.filter_by(message_id=message_id).count(),
+        )
 
     return redirect('/')
 
 
-@app.get('/users/<int:user_id>/likes')
+@bp.get('/users/<int:user_id>/likes')
 def show_user_liked_messages(user_id):
-    """Show user's liked messages."""
+    """Show user's liked messages, newest first.
+
+    Takes a 'before' param in querystring for the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    messages, next_before = user.liked_page(
+        before=request.args.get('before', type=int))
 
-    return render_template('users/show_liked.html', user=user)
+    return render_template('users/show_liked.html',
+                           user=user,
+                           messages=messages,
+                           next_before=next_before)
 
 
 ##############################################################################
@@ -441,10 +959,15 @@ def show_user_liked_messages(user_id):
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Responses that already set their own max-age (like uploaded images)
+    are left alone.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if response.cache_control.max_age is None:
+        response.cache_control.no_store = True
     return response
@@ -0,0 +1,291 @@
+"""Move cold months of messages out of Postgres into compressed files.
+
+Timelines only read recent messages, but every old one still makes the
+messages table and its indexes bigger. This moves whole months of old
+messages, with their likes, into gzipped NDJSON files in ARCHIVE_FOLDER
+(instance/archive by default), one per month, and records each in
+message_archives. Archived messages can still be viewed by id, just
+more slowly: show_message falls back to find_message().
+
+    python archive.py status              messages per month, and where
+    python archive.py archive [MONTHS]    archive all months more than
+                                          MONTHS (default 12) ago
+    python archive.py restore YYYY-MM     move a month back into Postgres
+
+Each month is archived in one transaction, so a crash leaves it either
+archived or not. Both ways, each message moved is logged in the event
+log (see events.py). Hashtags and mentions are re-indexed on restore, and
+messages by users deleted since are skipped.
+"""
+
+import gzip
+import json
+import os
+import sys
+from collections import defaultdict, namedtuple
+from datetime import date, datetime
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+import events
+from models import db, User, Message, Like, MessageArchive
+from tags import index_messages
+
+ARCHIVE_AFTER_MONTHS = 12
+
+BATCH_SIZE = 5_000
+
+ArchivedMessage = namedtuple(
+    "ArchivedMessage", ["id", "text", "timestamp", "user"])
+
+
+def archive_folder():
+    return (current_app.config.get("ARCHIVE_FOLDER")
+            or os.path.join(current_app.instance_path, "archive"))
+
+
+def add_months(month, months):
+    """The first day of the month `months` after `month`."""
+
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_counts():
+    """{first day of month: number of messages} still in Postgres."""
+
+    month = func.date_trunc("month", Message.timestamp)
+    return {start.date(): count
+            for start, count in (db.session
+                                 .query(month, func.count())
+                                 .group_by(month))}
+
+
+def in_month(month):
+    return ((Message.timestamp >= month)
+            & (Message.timestamp < add_months(month, 1)))
+
+
+def _message_batches(month):
+    """Lock and yield the month's messages in id-keyset batches."""
+
+    last_id = 0
+    while True:
+        batch = (Message
+                 .query
+                 .filter(in_month(month), Message.id > last_id)
+                 .order_by(Message.id)
+                 .limit(BATCH_SIZE)
+                 .with_for_update()
+                 .all())
+        if not batch:
+            return
+
+        yield batch
+        last_id = batch[-1].id
+
+
+def _record(message, likes):
+    # "id" first, so find_message() can skip lines without parsing them.
+    return json.dumps(dict(
+        id=message.id,
+        user_id=message.user_id,
+        timestamp=message.timestamp.isoformat(),
+        text=message.text,
+        likes=likes,
+    ), separators=(",", ":"))
+
+
+def archive_month(month):
+    """Move `month`'s messages and likes to a file; return how many."""
+
+    os.makedirs(archive_folder(), exist_ok=True)
+    filename = f"messages-{month:%Y-%m}.ndjson.gz"
+    path = os.path.join(archive_folder(), filename)
+
+    archived = []
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as file:
+        for batch in _message_batches(month):
+            likes = defaultdict(list)
+            for like in Like.query.filter(
+                    Like.message_id.in_([m.id for m in batch])):
+                likes[like.message_id].append(
+                    [like.user_id, like.timestamp.isoformat()])
+
+            for message in batch:
+                file.write(_record(message, likes[message.id]) + "\n")
+            archived.extend((m.id, m.user_id) for m in batch)
+
+        file.flush()
+        os.fsync(file.fileno())
+
+    if not archived:
+        os.remove(path + ".tmp")
+        db.session.rollback()
+        return 0
+
+    os.replace(path + ".tmp", path)
+
+    db.session.add(MessageArchive(month=month,
+                                  filename=filename,
+                                  message_count=len(archived),
+                                  first_id=archived[0][0],
+                                  last_id=archived[-1][0]))
+
+    # Last, as the log's lock holds up every logged change until commit.
+    events.messages_archived(archived)
+    Message.query.filter(in_month(month)).delete(synchronize_session=False)
+    db.session.commit()
+
+    return len(archived)
+
+
+def archive_old_months(months=ARCHIVE_AFTER_MONTHS, today=None):
+    """Archive every month that ended more than `months` months ago.
+
+    Returns {month: messages archived}.
+    """
+
+    this_month = (today or date.today()).replace(day=1)
+    cutoff = add_months(this_month, -months)
+
+    return {month: archive_month(month)
+            for month in sorted(month_counts())
+            if month < cutoff}
+
+
+def read_archive(archive):
+    """Yield the records in `archive`'s file, as dicts."""
+
+    path = os.path.join(archive_folder(), archive.filename)
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            yield json.loads(line)
+
+
+def find_message(message_id):
+    """An archived message as an ArchivedMessage, or None.
+
+    Reads each archive file that could hold it, so this is slow.
+    """
+
+    prefix = f'{{"id":{message_id},'
+    archives = MessageArchive.query.filter(
+        MessageArchive.first_id <= message_id,
+        MessageArchive.last_id >= message_id)
+
+    for archive in archives:
+        path = os.path.join(archive_folder(), archive.filename)
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith(prefix):
+                    record = json.loads(line)
+                    user = User.query.get(record["user_id"])
+                    if user is None:
+                        return None
+
+                    return ArchivedMessage(
+                        id=record["id"],
+                        text=record["text"],
+                        timestamp=datetime.fromisoformat(record["timestamp"]),
+                        user=user)
+
+    return None
+
+
+def _restore_batch(records):
+    """Insert `records`; return those restored, as they are now, to log."""
+
+    user_ids = {r["user_id"] for r in records}
+    user_ids.update(user_id for r in records for user_id, _ in r["likes"])
+    existing = {id for id, in (db.session
+                               .query(User.id)
+                               .filter(User.id.in_(user_ids)))}
+
+    records = [r for r in records if r["user_id"] in existing]
+    messages = [dict(id=r["id"],
+                     user_id=r["user_id"],
+                     timestamp=datetime.fromisoformat(r["timestamp"]),
+                     text=r["text"])
+                for r in records]
+    if not messages:
+        return []
+
+    inserted = set(db.session.execute(
+        insert(Message)
+        .values(messages)
+        .on_conflict_do_nothing()
+        .returning(Message.id)).scalars())
+
+    likes = [dict(message_id=r["id"],
+                  user_id=user_id,
+                  timestamp=datetime.fromisoformat(liked_at))
+             for r in records
+             for user_id, liked_at in r["likes"] if user_id in existing]
+    if likes:
+        db.session.execute(
+            insert(Like).values(likes).on_conflict_do_nothing())
+
+    index_messages([(m["id"], m["text"]) for m in messages])
+    return [dict(r, likes=[like for like in r["likes"] if like[0] in existing])
+            for r in records if r["id"] in inserted]
+
+
+def restore_month(month):
+    """Move an archived month back into Postgres; return how many
+    messages were restored."""
+
+    archive = MessageArchive.query.get(month)
+    if archive is None:
+        return 0
+
+    restored = []
+    batch = []
+    for record in read_archive(archive):
+        batch.append(record)
+        if len(batch) >= BATCH_SIZE:
+            restored.extend(_restore_batch(batch))
+            batch = []
+    restored.extend(_restore_batch(batch))
+
+    db.session.delete(archive)
+    # Last, as the log's lock holds up every logged change until commit.
+    events.messages_restored(restored)
+    db.session.commit()
+    os.remove(os.path.join(archive_folder(), archive.filename))
+
+    return len(restored)
+
+
+def status():
+    """Print how many messages each month has, and where they are."""
+
+    months = {month: (count, "postgres")
+              for month, count in month_counts().items()}
+    for archive in MessageArchive.query:
+        months[archive.month] = (archive.message_count, archive.filename)
+
+    for month, (count, where) in sorted(months.items()):
+        print(f"{month:%Y-%m}  {count:>8}  {where}")
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        command = sys.argv[1] if len(sys.argv) > 1 else "status"
+
+        if command == "archive":
+            months = int(sys.argv[2]) if len(sys.argv) > 2 else (
+                ARCHIVE_AFTER_MONTHS)
+            for month, count in archive_old_months(months).items():
+                print(f"Archived {count} messages from {month:%Y-%m}.")
+
+        elif command == "restore":
+            month = datetime.strptime(sys.argv[2], "%Y-%m").date()
+            print(f"Restored {restore_month(month)} messages.")
+
+        else:
+            status()
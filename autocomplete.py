@@ -0,0 +1,214 @@
+"""Username autocomplete from an in-memory prefix index.
+
+Each worker keeps every user's (lowercased username, id) in a sorted
+list and finds a prefix with a binary search, so lookups take
+microseconds however many users there are. The index:
+
+- loads in a background thread the first time it's needed (or when
+  warmed up), while lookups fall back to the ix_users_lower_username
+  index in Postgres;
+- is kept up to date as users sign up, rename and leave, in every
+  worker, by publishing each change on the "users" pub/sub channel;
+- reloads every AUTOCOMPLETE_RELOAD_SECONDS anyway, to pick up changes
+  made outside the app (like seed.py) or dropped by a slow subscriber.
+
+    GET /api/users/autocomplete?prefix=jo[&limit=10]
+"""
+
+import threading
+import time
+from bisect import bisect_left, insort
+
+from flask import Blueprint, current_app, g, jsonify, request
+from sqlalchemy import func
+
+import pubsub
+from models import db, User, DEFAULT_IMAGE_URL
+from uploads import thumbnail_url
+
+MAX_RESULTS = 10
+
+autocomplete = Blueprint("autocomplete", __name__)
+
+
+class PrefixIndex:
+    """Users by lowercased username, for prefix lookups.
+
+    Thread-safe. `loaded` is False until load() has run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._users = {}
+        self.loaded = False
+
+    def load(self, users):
+        """Replace the index with `users`, (id, username, image_url)."""
+
+        users = {id: (username, image_url)
+                 for id, username, image_url in users}
+        keys = sorted((username.lower(), id)
+                      for id, (username, _) in users.items())
+
+        with self._lock:
+            self._keys = keys
+            self._users = users
+            self.loaded = True
+
+    def add(self, id, username, image_url):
+        """Add a user, or update one that's been renamed."""
+
+        with self._lock:
+            self._discard(id)
+            self._users[id] = (username, image_url)
+            insort(self._keys, (username.lower(), id))
+
+    def remove(self, id):
+        with self._lock:
+            self._discard(id)
+
+    def _discard(self, id):
+        if id in self._users:
+            key = (self._users.pop(id)[0].lower(), id)
+            del self._keys[bisect_left(self._keys, key)]
+
+    def search(self, prefix, limit=MAX_RESULTS):
+        """Up to `limit` users whose username starts with `prefix`
+        (ignoring case), alphabetically, as (id, username, image_url)."""
+
+        prefix = prefix.lower()
+        with self._lock:
+            start = bisect_left(self._keys, (prefix,))
+            matches = []
+            for key, id in self._keys[start:start + limit]:
+                if not key.startswith(prefix):
+                    break
+                matches.append((id, *self._users[id]))
+            return matches
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def load_users():
+    return (db.session
+            .query(User.id, User.username, User.image_url)
+            .yield_per(10_000))
+
+
+def search_db(prefix, limit=MAX_RESULTS):
+    """Same as PrefixIndex.search, off ix_users_lower_username."""
+
+    pattern = (prefix.lower()
+               .replace("\\", "\\\\")
+               .replace("%", "\\%")
+               .replace("_", "\\_"))
+    lower = func.lower(User.username)
+
+    return (db.session
+            .query(User.id, User.username, User.image_url)
+            .filter(lower.like(f"{pattern}%", escape="\\"))
+            .order_by(lower, User.id)
+            .limit(limit)
+            .all())
+
+
+class Autocomplete:
+    """A worker's prefix index, and the thread that keeps it current."""
+
+    def __init__(self, app):
+        self.app = app
+        self.index = PrefixIndex()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Load the index and follow changes, in the background."""
+
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+
+        threading.Thread(target=self._run, name="autocomplete",
+                         daemon=True).start()
+
+    def _run(self):
+        reload_every = self.app.config["AUTOCOMPLETE_RELOAD_SECONDS"]
+        with self.app.app_context():
+            # Subscribe first, so no change made during the load is lost.
+            with pubsub.get_pubsub().subscribe("users") as changes:
+                while True:
+                    try:
+                        self.index.load(load_users())
+                    except Exception:
+                        self.app.logger.exception(
+                            "Couldn't load autocomplete index")
+                    finally:
+                        db.session.remove()
+
+                    reload_at = time.monotonic() + reload_every
+                    while time.monotonic() < reload_at:
+                        change = changes.get(timeout=reload_at
+                                             - time.monotonic())
+                        if change is None:
+                            continue
+                        if change.get("deleted"):
+                            self.index.remove(change["id"])
+                        else:
+                            self.index.add(change["id"], change["username"],
+                                           change["image_url"])
+
+    def search(self, prefix, limit):
+        self.start()
+        if self.index.loaded:
+            return self.index.search(prefix, limit)
+        return search_db(prefix, limit)
+
+
+def get_autocomplete():
+    return current_app.extensions["autocomplete"]
+
+
+def user_changed(user):
+    """Tell every worker's index that `user` signed up or changed."""
+
+    pubsub.publish("users", dict(
+        id=user.id, username=user.username, image_url=user.image_url))
+
+
+def user_deleted(user_id):
+    """Tell every worker's index that a user is gone."""
+
+    pubsub.publish("users", dict(id=user_id, deleted=True))
+
+
+@autocomplete.get("/api/users/autocomplete")
+def autocomplete_users():
+    """Users whose username starts with ?prefix=, as JSON."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    prefix = request.args.get("prefix", "")
+    limit = max(1, min(request.args.get("limit", MAX_RESULTS, type=int),
+                       MAX_RESULTS))
+    if not prefix:
+        return jsonify(users=[])
+
+    return jsonify(users=[
+        dict(id=id, username=username,
+             image_url=thumbnail_url(image_url or DEFAULT_IMAGE_URL, 32))
+        for id, username, image_url
+        in get_autocomplete().search(prefix, limit)
+    ])
+
+
+def init_app(app):
+    """Set up username autocomplete on `app`. Needs pubsub set up."""
+
+    app.config.setdefault("AUTOCOMPLETE_RELOAD_SECONDS", 600)
+
+    app.extensions["autocomplete"] = Autocomplete(app)
+    app.register_blueprint(autocomplete)
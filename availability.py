@@ -0,0 +1,235 @@
+"""Username and email availability, from a per-worker Bloom filter.
+
+Signing up with a taken username or email used to cost a bcrypt hash
+and a failed INSERT before anyone found out. Now each worker keeps a
+Bloom filter of every user's username and email, lowercased, so most
+available names are known to be available without asking Postgres.
+A hit in the filter may be a false positive (about FALSE_POSITIVE_RATE
+of the time), so hits are checked against the lower(username) and
+lower(email) indexes. Names are compared case-insensitively, and those
+indexes are unique, so the database agrees: "Jo" can't sign up if "jo"
+has. The signup and profile forms strip spaces, so what's stored is what
+normalize() compares.
+
+Like the autocomplete index, the filter:
+
+- loads in a background thread the first time it's needed, checking
+  everything against the database meanwhile;
+- takes new names as users sign up or rename, in every worker, from
+  the "signups" pub/sub channel;
+- is rebuilt every AVAILABILITY_RELOAD_SECONDS, dropping old names
+  (a Bloom filter can't forget one) and picking up changes made
+  outside the app, and when it's grown past its capacity.
+
+    GET /api/users/available?username=jo[&email=jo@example.com]
+"""
+
+import math
+import threading
+import time
+from hashlib import blake2b
+
+from flask import Blueprint, current_app, jsonify, request
+from sqlalchemy import func, or_
+
+import pubsub
+import ratelimit
+from metrics import record_cache
+from models import db, User
+
+FALSE_POSITIVE_RATE = 0.01
+
+# Room to grow between rebuilds, as a multiple of the names loaded.
+GROWTH = 2
+
+MIN_CAPACITY = 10_000
+
+KINDS = ("username", "email")
+
+availability = Blueprint("availability", __name__)
+
+
+def normalize(value):
+    """How a username or email is compared: as SQL's lower() does."""
+
+    return value.strip().lower()
+
+
+class BloomFilter:
+    """A set of strings that can say "maybe" but never a wrong "no"."""
+
+    def __init__(self, capacity, error_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, item):
+        # Two hashes from one digest, combined into as many as needed.
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        positions = self._positions(item)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+
+def key(kind, value):
+    return f"{kind}:{normalize(value)}"
+
+
+def load_filter():
+    """A new filter holding every user's username and email."""
+
+    users = db.session.query(func.count(User.id)).scalar()
+    bloom = BloomFilter(max(MIN_CAPACITY, 2 * users * GROWTH))
+
+    rows = db.session.query(User.username, User.email).yield_per(10_000)
+    for username, email in rows:
+        bloom.add(key("username", username))
+        bloom.add(key("email", email))
+
+    return bloom
+
+
+def taken_in_db(user_id=None, **values):
+    """Which of the `values` (username=..., email=...) another user than
+    `user_id` already has, as a set of kinds."""
+
+    columns = {"username": User.username, "email": User.email}
+    conditions = [func.lower(columns[kind]) == normalize(value)
+                  for kind, value in values.items()]
+
+    query = (db.session
+             .query(User.username, User.email)
+             .filter(or_(*conditions)))
+    if user_id is not None:
+        query = query.filter(User.id != user_id)
+
+    taken = set()
+    for row in query:
+        taken.update(kind for kind, value in values.items()
+                     if normalize(getattr(row, kind)) == normalize(value))
+    return taken
+
+
+class Availability:
+    """A worker's Bloom filter, and the thread that keeps it current."""
+
+    def __init__(self, app):
+        self.app = app
+        self.filter = None
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Load the filter and follow changes, in the background."""
+
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+
+        threading.Thread(target=self._run, name="availability",
+                         daemon=True).start()
+
+    def _run(self):
+        reload_every = self.app.config["AVAILABILITY_RELOAD_SECONDS"]
+        with self.app.app_context():
+            # Subscribe first, so no signup made during the load is lost.
+            with pubsub.get_pubsub().subscribe("signups") as changes:
+                while True:
+                    try:
+                        self.filter = load_filter()
+                    except Exception:
+                        self.app.logger.exception(
+                            "Couldn't load availability filter")
+                    finally:
+                        db.session.remove()
+
+                    reload_at = time.monotonic() + reload_every
+                    while (time.monotonic() < reload_at
+                           and not (self.filter and self.filter.full)):
+                        change = changes.get(timeout=reload_at
+                                             - time.monotonic())
+                        if change is not None:
+                            self.add(change["username"], change["email"])
+
+    def add(self, username, email):
+        if self.filter is not None:
+            self.filter.add(key("username", username))
+            self.filter.add(key("email", email))
+
+    def maybe_taken(self, kind, value):
+        """False if `value` surely isn't anyone's `kind`."""
+
+        self.start()
+        bloom = self.filter
+        return bloom is None or key(kind, value) in bloom
+
+
+def get_availability():
+    return current_app.extensions["availability"]
+
+
+def taken(user_id=None, **values):
+    """Which of the `values` (username=..., email=...) are taken by a
+    user other than `user_id`, as a set of kinds.
+
+    Only names the filter might have are looked up in the database.
+    """
+
+    checker = get_availability()
+    maybe = {kind: value for kind, value in values.items()
+             if value and checker.maybe_taken(kind, value)}
+    for kind, value in values.items():
+        if value:
+            record_cache("availability", kind not in maybe)
+
+    return taken_in_db(user_id, **maybe) if maybe else set()
+
+
+def user_changed(user):
+    """Add `user`'s (perhaps new) username and email to every worker's
+    filter, this one's straight away."""
+
+    get_availability().add(user.username, user.email)
+    pubsub.publish("signups", dict(username=user.username, email=user.email))
+
+
+@availability.get("/api/users/available")
+@ratelimit.limit()
+def user_availability():
+    """Whether ?username= and/or ?email= are free to sign up with, as
+    JSON: {"username": true, "email": false}."""
+
+    values = {kind: request.args[kind].strip()
+              for kind in KINDS if request.args.get(kind, "").strip()}
+    unavailable = taken(**values)
+
+    return jsonify({kind: kind not in unavailable for kind in values})
+
+
+def init_app(app):
+    """Set up availability checks on `app`. Needs pubsub set up."""
+
+    app.config.setdefault("AVAILABILITY_RELOAD_SECONDS", 600)
+
+    app.extensions["availability"] = Availability(app)
+    app.register_blueprint(availability)
@@ -0,0 +1,156 @@
+"""Benchmark time to first byte of fresh workers.
+
+Starts fresh Python processes, like new gunicorn workers, and times how
+long each takes to boot (import the app) and then, once booted, to serve
+the first byte of a few anonymous pages. Compares:
+
+    cold:   no bytecode cache, templates compiled lazily on first request
+    cached: bytecode cache populated, templates loaded lazily
+    warm:   bytecode cache populated, templates precompiled at boot
+
+It also times `import app` on its own (which no longer builds the app)
+against building the app with create_app(), and with `workers` measures
+per-worker memory of gunicorn with and without preload_app:
+
+    python bench_startup.py [runs]
+    python bench_startup.py workers
+"""
+
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+PAGES = ["/login", "/signup", "/"]
+
+IMPORT = """
+import sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print((imported - start) * 1000, (created - imported) * 1000)
+"""
+
+WORKER = """
+import json, sys, time
+start = time.perf_counter()
+from app import app
+booted = time.perf_counter()
+client = app.test_client()
+first_bytes = {}
+for page in sys.argv[1:]:
+    client.get(page)
+    first_bytes[page] = (time.perf_counter() - booted) * 1000
+print(json.dumps({"boot": (booted - start) * 1000, "pages": first_bytes}))
+"""
+
+
+def run_worker(env):
+    """Run one fresh worker process; return its timings in ms."""
+
+    out = subprocess.run([sys.executable, "-c", WORKER, *PAGES],
+                         env=env, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def bench(label, env, runs):
+    results = [run_worker(env) for _ in range(runs)]
+    boot = statistics.median(r["boot"] for r in results)
+    print(f"{label}: boot {boot:.0f} ms")
+    for page in PAGES:
+        ttfb = statistics.median(r["pages"][page] for r in results)
+        print(f"  first byte of {page}: {ttfb:.1f} ms after boot")
+
+
+def bench_import(runs):
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT], check=True,
+                             capture_output=True, text=True)
+        results.append([float(ms) for ms in out.stdout.split()])
+
+    print(f"import app: {statistics.median(r[0] for r in results):.0f} ms, "
+          f"then create_app(): {statistics.median(r[1] for r in results):.0f} ms")
+
+
+def worker_memory_kb(pid):
+    """(RSS, PSS, private) memory of a process in kB, from smaps_rollup."""
+
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+
+    private = fields["Private_Clean"] + fields["Private_Dirty"]
+    return fields["Rss"], fields["Pss"], private
+
+
+def bench_workers(n_workers=4, port=8765):
+    """Compare per-worker memory with and without preload_app."""
+
+    for preload in (False, True):
+        # With preload, use our gunicorn.conf.py; without, an empty config.
+        with tempfile.NamedTemporaryFile("w", suffix=".py") as empty_conf:
+            config = "gunicorn.conf.py" if preload else empty_conf.name
+            master = subprocess.Popen(
+                ["gunicorn", "-c", config, "-w", str(n_workers),
+                 "-b", f"127.0.0.1:{port}", "app:create_app()"],
+                stderr=subprocess.DEVNULL)
+            try:
+                time.sleep(3)
+                for _ in range(n_workers * 5):
+                    for page in PAGES:
+                        urllib.request.urlopen(
+                            f"http://127.0.0.1:{port}{page}").read()
+
+                children = subprocess.run(
+                    ["pgrep", "-P", str(master.pid)],
+                    capture_output=True, text=True).stdout.split()
+                memory = [worker_memory_kb(pid) for pid in children]
+
+            finally:
+                master.terminate()
+                master.wait()
+
+        rss, pss, private = (statistics.mean(m[i] for m in memory) / 1024
+                             for i in range(3))
+        print(f"preload_app={preload}: {len(memory)} workers, per worker "
+              f"RSS {rss:.1f} MB, PSS {pss:.1f} MB, private {private:.1f} MB")
+
+
+def main(runs=5):
+    bench_import(runs)
+
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        cold = dict(os.environ, JINJA_CACHE_DIR="", PRECOMPILE_TEMPLATES="")
+        bench("cold", cold, runs)
+
+        cached = dict(os.environ, JINJA_CACHE_DIR=cache_dir,
+                      PRECOMPILE_TEMPLATES="")
+        run_worker(cached)
+        bench("cached", cached, runs)
+
+        warm = dict(os.environ, JINJA_CACHE_DIR=cache_dir,
+                    PRECOMPILE_TEMPLATES="1")
+        bench("warm", warm, runs)
+
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["workers"]:
+        bench_workers()
+    else:
+        main(*(int(arg) for arg in sys.argv[1:]))
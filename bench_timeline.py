@@ -0,0 +1,131 @@
+"""Benchmark homepage timeline latency as message history grows.
+
+Fills a scratch database (BENCH_DATABASE_URL, default
+postgresql:///warbler_bench; it is wiped) with USERS users each
+following FOLLOWS others, and N messages spread over two years like the
+seed data. For each N it times the homepage timeline query for random
+users:
+
+    no index:  messages without ix_messages_user_timestamp
+    index:     with it
+    archived:  with it, after archiving all but the last KEEP_MONTHS
+
+    python bench_timeline.py [N ...]
+"""
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+from sqlalchemy import text
+
+from app import create_app
+from archive import archive_old_months
+from models import db, Follows, Message, User
+
+USERS = 1_000
+FOLLOWS = 50
+KEEP_MONTHS = 3
+RUNS = 50
+
+SIZES = [100_000, 300_000, 1_000_000]
+
+
+def fill(n_messages):
+    """Recreate the tables and fill them with random data."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        dict(username=f"bench{i}", email=f"bench{i}@email.com", password="x")
+        for i in range(USERS)])
+    db.session.commit()
+
+    db.session.execute(text("""
+        INSERT INTO follows (user_following_id, user_being_followed_id)
+        SELECT DISTINCT f.id, (SELECT min(id) FROM users)
+                              + floor(random() * :users)::int
+        FROM users f, generate_series(1, :follows)
+        ON CONFLICT DO NOTHING
+    """), dict(users=USERS, follows=FOLLOWS))
+
+    db.session.execute(text("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT 'benchmark message',
+               now() at time zone 'utc' - random() * interval '730 days',
+               (SELECT min(id) FROM users) + floor(random() * :users)::int
+        FROM generate_series(1, :messages)
+    """), dict(users=USERS, messages=n_messages))
+    db.session.commit()
+
+    analyze()
+
+
+def analyze():
+    with db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM ANALYZE"))
+
+
+def time_timelines():
+    """Median ms to load a random user's timeline, as the homepage does."""
+
+    user_ids = [id for id, in db.session.query(User.id)]
+    following = {}
+    for follower, followed in db.session.query(
+            Follows.user_following_id, Follows.user_being_followed_id):
+        following.setdefault(follower, [follower]).append(followed)
+
+    timings = []
+    for _ in range(RUNS):
+        user_id = random.choice(user_ids)
+        start = time.perf_counter()
+        Message.timeline(following.get(user_id, [user_id]))
+        timings.append((time.perf_counter() - start) * 1000)
+        db.session.rollback()
+
+    return statistics.median(timings)
+
+
+def benchmark(n_messages):
+    fill(n_messages)
+    messages = Message.__table__
+
+    db.session.execute(text("DROP INDEX ix_messages_user_timestamp"))
+    db.session.commit()
+    analyze()
+    no_index = time_timelines()
+
+    for index in messages.indexes:
+        index.create(db.engine)
+    analyze()
+    indexed = time_timelines()
+
+    archive_old_months(KEEP_MONTHS, today=date.today())
+    analyze()
+    hot = Message.query.count()
+    archived = time_timelines()
+
+    print(f"{n_messages:>10} {hot:>10} {no_index:>10.1f} {indexed:>10.1f}"
+          f" {archived:>10.1f}")
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or SIZES
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": os.environ.get(
+            "BENCH_DATABASE_URL", "postgresql:///warbler_bench"),
+        "ARCHIVE_FOLDER": tempfile.mkdtemp(),
+    })
+
+    with app.app_context():
+        print(f"{'messages':>10} {'hot':>10} {'no index':>10} {'index':>10}"
+              f" {'archived':>10}   (median ms)")
+        for n in sizes:
+            benchmark(n)
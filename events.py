@@ -0,0 +1,374 @@
+"""Append-only log of changes to messages, likes, follows and users.
+
+Every route that changes one of those also appends an Event in the same
+transaction, and so does archive.py, so the log has exactly the changes
+that were committed, in commit order: offsets are handed out under a
+transaction-level advisory lock, so one transaction can't commit a lower
+offset after another has committed a higher one. Anything derived from
+the data (counters, indexes, caches) can be kept up to date, or rebuilt,
+by reading the log from where it left off.
+
+    message_posted / message_deleted      key message:<id>
+    message_archived / message_restored   key message:<id>
+    followed / unfollowed                 key follow:<follower>:<followed>
+    liked / unliked                       key like:<user>:<message>
+    user_deleted                          key user:<id>
+
+An archived message goes from the database with its likes, like a
+deleted one; a restored one comes back with its likes in its data.
+
+That lock is the log's cost: from its first event until it commits, a
+transaction that changes any of those holds up every other one that
+does, so they commit one at a time, site-wide. That caps such writes at
+one commit latency each, which is plenty for now but will be the limit
+as writes grow.
+
+A Consumer applies events to its own state and tracks its own offset,
+in memory and (with save_checkpoint) in consumer_checkpoints. It can
+snapshot its state so a rebuild replays only the events after it. The
+log only starts when it was added, so a consumer on an older database
+must seed() its state from the tables first.
+
+compact() shrinks the part of the log every consumer is past: only the
+latest event for each key is kept, and removals go altogether, along
+with everything about the users and messages they removed. Replaying a
+compacted log gives the same result as replaying the whole thing.
+
+    python events.py [status]
+    python events.py compact
+    python events.py seed           seed the example MessageCounts
+"""
+
+import json
+import sys
+import zlib
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Event, ConsumerCheckpoint, EventSnapshot, Message
+
+# Arbitrary, but the same for every writer of the log.
+LOCK_KEY = 0x776172626c6572
+
+BATCH_SIZE = 1_000
+
+REMOVALS = {"message_deleted", "message_archived", "unfollowed", "unliked",
+            "user_deleted"}
+
+# Logged by maintenance jobs, not by users doing things.
+MAINTENANCE = {"message_archived", "message_restored"}
+
+
+def lock_log():
+    """Hold the log's lock until the current transaction ends."""
+
+    db.session.execute(select(func.pg_advisory_xact_lock(LOCK_KEY)))
+
+
+def append(type, key, user_id, subject_id=None, target_user_id=None,
+           **data):
+    """Add an event to the current transaction; commit to log it.
+
+    Flushes first, so the transaction already holds its row locks when
+    it takes the log's lock, then holds that only until it commits.
+    """
+
+    db.session.flush()
+    lock_log()
+
+    event = Event(type=type, key=key, user_id=user_id,
+                  subject_id=subject_id, target_user_id=target_user_id,
+                  data=data or None)
+    db.session.add(event)
+    return event
+
+
+def append_all(events):
+    """Add many Events to the current transaction at once, as append()."""
+
+    db.session.flush()
+    lock_log()
+    db.session.add_all(events)
+
+
+def message_posted(message):
+    append("message_posted", f"message:{message.id}", message.user_id,
+           subject_id=message.id, target_user_id=message.user_id,
+           text=message.text, timestamp=message.timestamp.isoformat())
+
+
+def message_deleted(message_id, author_id):
+    append("message_deleted", f"message:{message_id}", author_id,
+           subject_id=message_id, target_user_id=author_id)
+
+
+def messages_archived(messages):
+    """Log archiving `messages`, given as (message_id, author_id) pairs,
+    which takes their likes with them."""
+
+    append_all([
+        Event(type="message_archived", key=f"message:{message_id}",
+              user_id=author_id, subject_id=message_id,
+              target_user_id=author_id)
+        for message_id, author_id in messages])
+
+
+def messages_restored(records):
+    """Log restoring archived messages, given as archive records."""
+
+    append_all([
+        Event(type="message_restored", key=f"message:{record['id']}",
+              user_id=record["user_id"], subject_id=record["id"],
+              target_user_id=record["user_id"],
+              data=dict(text=record["text"], timestamp=record["timestamp"],
+                        likes=record["likes"]))
+        for record in records])
+
+
+def follow_changed(follower_id, followed_id, following):
+    append("followed" if following else "unfollowed",
+           f"follow:{follower_id}:{followed_id}", follower_id,
+           subject_id=followed_id, target_user_id=followed_id)
+
+
+def like_changed(user_id, message, liked):
+    append("liked" if liked else "unliked",
+           f"like:{user_id}:{message.id}", user_id,
+           subject_id=message.id, target_user_id=message.user_id)
+
+
+def user_deleted(user_id):
+    append("user_deleted", f"user:{user_id}", user_id)
+
+
+def read(after=0, limit=BATCH_SIZE):
+    """Up to `limit` events after offset `after`, oldest first."""
+
+    return (Event
+            .query
+            .filter(Event.offset > after)
+            .order_by(Event.offset)
+            .limit(limit)
+            .all())
+
+
+def last_offset():
+    return db.session.query(func.coalesce(func.max(Event.offset), 0)).scalar()
+
+
+def get_checkpoint(consumer):
+    checkpoint = ConsumerCheckpoint.query.get(consumer)
+    return checkpoint.offset if checkpoint else 0
+
+
+def lock_checkpoint(consumer):
+    """The offset `consumer` has got to, locked until commit, so only one
+    process at a time consumes for it."""
+
+    db.session.execute(
+        insert(ConsumerCheckpoint)
+        .values(consumer=consumer, offset=0)
+        .on_conflict_do_nothing())
+    return (db.session
+            .query(ConsumerCheckpoint.offset)
+            .filter_by(consumer=consumer)
+            .with_for_update()
+            .scalar())
+
+
+def save_checkpoint(consumer, offset):
+    """Record that `consumer` has applied everything up to `offset`, in
+    the current transaction (so along with what it derived)."""
+
+    db.session.execute(
+        insert(ConsumerCheckpoint)
+        .values(consumer=consumer, offset=offset)
+        .on_conflict_do_update(
+            index_elements=[ConsumerCheckpoint.consumer],
+            set_=dict(offset=offset, updated_at=func.now())))
+
+
+class Consumer:
+    """Something derived from the event log.
+
+    Subclasses set `name` and define apply(event), plus get_state() and
+    set_state(state) (JSON-able) to be snapshotted.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.offset = 0
+
+    def apply(self, event):
+        raise NotImplementedError
+
+    def get_state(self):
+        raise NotImplementedError
+
+    def set_state(self, state):
+        raise NotImplementedError
+
+    def state_from_tables(self):
+        """The state, worked out from the tables rather than the log."""
+
+        raise NotImplementedError
+
+    def poll(self, limit=BATCH_SIZE):
+        """Apply the next `limit` events; returns how many there were."""
+
+        events = read(self.offset, limit)
+        for event in events:
+            self.apply(event)
+        if events:
+            self.offset = events[-1].offset
+        return len(events)
+
+    def catch_up(self):
+        while self.poll():
+            pass
+
+    def snapshot(self):
+        """Save this consumer's state as of its offset."""
+
+        state = zlib.compress(json.dumps(self.get_state()).encode())
+        db.session.merge(EventSnapshot(
+            consumer=self.name, offset=self.offset, state=state))
+        save_checkpoint(self.name, self.offset)
+        db.session.commit()
+
+    def seed(self):
+        """Snapshot the state as the tables have it now, for a database
+        with history from before the log.
+
+        Holds the log's lock while it reads, so no logged change commits
+        in between; that holds up writes for as long as it takes.
+        """
+
+        lock_log()
+        self.set_state(self.state_from_tables())
+        self.offset = last_offset()
+        self.snapshot()
+
+    def rebuild(self):
+        """Start again from the last snapshot (or the very beginning) and
+        replay everything since."""
+
+        snapshot = EventSnapshot.query.get(self.name)
+        if snapshot is None:
+            self.set_state(None)
+            self.offset = 0
+        else:
+            self.set_state(json.loads(zlib.decompress(snapshot.state)))
+            self.offset = snapshot.offset
+
+        self.catch_up()
+
+
+class MessageCounts(Consumer):
+    """How many messages each user has posted: an example consumer."""
+
+    name = "message_counts"
+
+    def set_state(self, state):
+        self.counts = {int(user_id): count
+                       for user_id, count in (state or {}).items()}
+
+    def get_state(self):
+        return self.counts
+
+    def state_from_tables(self):
+        return dict(db.session
+                    .query(Message.user_id, func.count())
+                    .group_by(Message.user_id))
+
+    def apply(self, event):
+        count = self.counts.get(event.user_id, 0)
+        if event.type in ("message_posted", "message_restored"):
+            self.counts[event.user_id] = count + 1
+        elif event.type in ("message_deleted", "message_archived"):
+            self.counts[event.user_id] = max(count - 1, 0)
+        elif event.type == "user_deleted":
+            self.counts.pop(event.user_id, None)
+
+
+def compactable_offset():
+    """The offset every consumer has checkpointed or snapshotted past."""
+
+    return min(
+        db.session.query(func.min(ConsumerCheckpoint.offset)).scalar() or 0,
+        db.session.query(func.min(EventSnapshot.offset)).scalar()
+        or last_offset())
+
+
+def compact(upto=None):
+    """Compact the log up to offset `upto` (by default, as far as every
+    consumer has got). Returns the number of events removed."""
+
+    if upto is None:
+        upto = compactable_offset()
+
+    params = dict(upto=upto, removals=list(REMOVALS))
+    removed = 0
+
+    # Everything about users deleted in this part of the log, and likes
+    # of messages deleted or archived in it (which took those rows).
+    removed += db.session.execute(db.text("""
+        DELETE FROM events e
+        USING (SELECT DISTINCT user_id FROM events
+               WHERE "offset" <= :upto AND type = 'user_deleted') gone
+        WHERE e."offset" <= :upto
+          AND (e.user_id = gone.user_id OR e.target_user_id = gone.user_id)
+    """), params).rowcount
+
+    removed += db.session.execute(db.text("""
+        DELETE FROM events e
+        USING (SELECT DISTINCT subject_id FROM events
+               WHERE "offset" <= :upto
+                 AND type IN ('message_deleted', 'message_archived')) gone
+        WHERE e."offset" <= :upto
+          AND e.type IN ('liked', 'unliked')
+          AND e.subject_id = gone.subject_id
+    """), params).rowcount
+
+    # Then all but each key's latest event, and keys that end removed.
+    removed += db.session.execute(db.text("""
+        DELETE FROM events e
+        WHERE e."offset" <= :upto
+          AND EXISTS (SELECT 1 FROM events later
+                      WHERE later.key = e.key
+                        AND later."offset" > e."offset"
+                        AND later."offset" <= :upto)
+    """), params).rowcount
+
+    removed += db.session.execute(db.text("""
+        DELETE FROM events
+        WHERE "offset" <= :upto AND type = ANY(:removals)
+    """), params).rowcount
+
+    db.session.commit()
+    return removed
+
+
+def status():
+    """Print the size of the log and where each consumer is in it."""
+
+    count = db.session.query(func.count(Event.offset)).scalar()
+    print(f"{count} events, up to offset {last_offset()}")
+    for checkpoint in ConsumerCheckpoint.query.order_by("consumer"):
+        print(f"  {checkpoint.consumer:24} at {checkpoint.offset}")
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        if len(sys.argv) > 1 and sys.argv[1] == "compact":
+            print(f"Removed {compact()} events.")
+        elif len(sys.argv) > 1 and sys.argv[1] == "seed":
+            counts = MessageCounts()
+            counts.seed()
+            print(f"Seeded {counts.name} at offset {counts.offset}.")
+        else:
+            status()
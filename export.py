@@ -0,0 +1,297 @@
+"""Streaming export of everything Warbler has on a user.
+
+An export holds the user's profile, messages (including archived ones),
+likes, and who they follow and are followed by. It comes as NDJSON, one
+{"type": ..., ...} object per line, or as a zip with one file per
+section. Rows are read with server-side cursors (yield_per) and written
+out as they arrive, so memory use doesn't grow with the account.
+
+    GET /users/<id>/export[?format=zip]
+
+streams small accounts' exports straight back. Accounts with more than
+EXPORT_INLINE_MAX_ROWS rows are exported to a file in EXPORT_FOLDER by a
+background job instead, and the user is sent to a page that links to
+it once it's ready. From the command line:
+
+    python export.py USER_ID [--zip] > export
+"""
+
+import io
+import json
+import os
+import sys
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import (
+    Blueprint, Response, abort, current_app, flash, g, redirect,
+    render_template, request, send_from_directory, stream_with_context)
+
+from models import db, User, Message, Like, Follows, MessageArchive
+
+BATCH_SIZE = 1_000
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "zip": "application/zip",
+}
+
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="exports")
+
+exports = Blueprint("exports", __name__)
+
+
+def profile(user):
+    yield dict(
+        id=user.id,
+        username=user.username,
+        email=user.email,
+        bio=user.bio,
+        location=user.location,
+        image_url=user.image_url,
+        header_image_url=user.header_image_url,
+    )
+
+
+def messages(user):
+    rows = (db.session
+            .query(Message.id, Message.text, Message.timestamp)
+            .filter(Message.user_id == user.id)
+            .order_by(Message.id)
+            .yield_per(BATCH_SIZE))
+
+    for row in rows:
+        yield dict(id=row.id, text=row.text,
+                   timestamp=row.timestamp.isoformat())
+
+
+def archived_messages(user):
+    from archive import read_archive
+
+    for archive in MessageArchive.query.order_by(MessageArchive.month):
+        for record in read_archive(archive):
+            if record["user_id"] == user.id:
+                yield dict(id=record["id"], text=record["text"],
+                           timestamp=record["timestamp"])
+
+
+def likes(user):
+    rows = (db.session
+            .query(Like.message_id, Like.timestamp)
+            .filter(Like.user_id == user.id)
+            .order_by(Like.message_id)
+            .yield_per(BATCH_SIZE))
+
+    for row in rows:
+        yield dict(message_id=row.message_id,
+                   timestamp=row.timestamp.isoformat())
+
+
+def _follows(user_id_col, condition):
+    rows = (db.session
+            .query(User.id, User.username)
+            .join(Follows, user_id_col == User.id)
+            .filter(condition)
+            .order_by(user_id_col)
+            .yield_per(BATCH_SIZE))
+
+    for row in rows:
+        yield dict(id=row.id, username=row.username)
+
+
+def following(user):
+    return _follows(Follows.user_being_followed_id,
+                    Follows.user_following_id == user.id)
+
+
+def followers(user):
+    return _follows(Follows.user_following_id,
+                    Follows.user_being_followed_id == user.id)
+
+
+# In export order. Each reads its rows only once it's iterated.
+SECTIONS = [
+    ("profile", profile),
+    ("messages", messages),
+    ("archived_messages", archived_messages),
+    ("likes", likes),
+    ("following", following),
+    ("followers", followers),
+]
+
+
+def export_ndjson(user):
+    """Yield the export as NDJSON lines (bytes)."""
+
+    for name, section in SECTIONS:
+        for record in section(user):
+            yield (json.dumps(dict(type=name, **record)) + "\n").encode()
+
+
+class _Chunks(io.RawIOBase):
+    """A write-only, unseekable file that keeps what's written until
+    taken, so a zip can be streamed out as it's built."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_zip(user):
+    """Yield the export as a zip (bytes), one NDJSON file per section."""
+
+    out = _Chunks()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, section in SECTIONS:
+            with zf.open(f"{name}.ndjson", "w") as file:
+                for record in section(user):
+                    file.write((json.dumps(record) + "\n").encode())
+                    if out.chunks:
+                        yield out.take()
+    yield out.take()
+
+
+def export(user, format="ndjson"):
+    return export_zip(user) if format == "zip" else export_ndjson(user)
+
+
+def row_count(user, limit):
+    """How many rows `user`'s export has, counting no higher than
+    `limit` (so big accounts are cheap to check)."""
+
+    def count(query):
+        return (db.session
+                .query(db.func.count())
+                .select_from(query.limit(limit).subquery())
+                .scalar())
+
+    return (user.followers_count
+            + user.following_count
+            + count(db.session.query(Message.id)
+                    .filter(Message.user_id == user.id))
+            + count(db.session.query(Like.message_id)
+                    .filter(Like.user_id == user.id)))
+
+
+def export_folder():
+    return current_app.config["EXPORT_FOLDER"]
+
+
+def run_export_job(app, user_id, format, filename):
+    """Write an export to EXPORT_FOLDER/filename (in a background job)."""
+
+    with app.app_context():
+        path = os.path.join(export_folder(), filename)
+        try:
+            user = User.query.get(user_id)
+            with open(path + ".tmp", "wb") as file:
+                for chunk in export(user, format):
+                    file.write(chunk)
+            os.replace(path + ".tmp", path)
+
+        except Exception:
+            current_app.logger.exception("Export %s failed", filename)
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+        finally:
+            db.session.remove()
+
+
+def start_export_job(user, format):
+    """Start exporting `user` in the background; return the job id."""
+
+    os.makedirs(export_folder(), exist_ok=True)
+    job_id = uuid.uuid4().hex
+    filename = f"{user.id}-{job_id}.{format}"
+
+    # Creating the .tmp now means the job shows as running straight away.
+    open(os.path.join(export_folder(), filename + ".tmp"), "wb").close()
+    executor.submit(run_export_job, current_app._get_current_object(),
+                    user.id, format, filename)
+
+    return job_id
+
+
+@exports.get("/users/<int:user_id>/export")
+def export_user(user_id):
+    """Export a user's data; only they may.
+
+    Streams it back, or for big accounts starts a background job and
+    redirects to its page.
+    """
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    format = request.args.get("format", "ndjson")
+    if format not in FORMATS:
+        abort(404)
+
+    max_rows = current_app.config["EXPORT_INLINE_MAX_ROWS"]
+    if row_count(g.user, max_rows + 1) > max_rows:
+        job_id = start_export_job(g.user, format)
+        return redirect(f"/users/{user_id}/export/{job_id}.{format}")
+
+    return Response(
+        stream_with_context(export(g.user, format)),
+        mimetype=FORMATS[format],
+        headers={"Content-Disposition":
+                 f"attachment; filename=warbler-{g.user.username}.{format}"})
+
+
+@exports.get("/users/<int:user_id>/export/<job_id>.<format>")
+def show_export_job(user_id, job_id, format):
+    """Download a finished export job, or show that it's still running."""
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    filename = f"{user_id}-{job_id}.{format}"
+    if format not in FORMATS or not job_id.isalnum():
+        abort(404)
+
+    if os.path.exists(os.path.join(export_folder(), filename)):
+        return send_from_directory(
+            export_folder(), filename, as_attachment=True,
+            download_name=f"warbler-{g.user.username}.{format}")
+
+    if os.path.exists(os.path.join(export_folder(), filename + ".tmp")):
+        return render_template("users/export.html")
+
+    abort(404)
+
+
+def init_app(app):
+    """Set up the export routes on `app`."""
+
+    app.config.setdefault(
+        "EXPORT_FOLDER", os.path.join(app.instance_path, "exports"))
+    app.config.setdefault("EXPORT_INLINE_MAX_ROWS", 50_000)
+
+    app.register_blueprint(exports)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        user = User.query.get(int(sys.argv[1]))
+        format = "zip" if "--zip" in sys.argv else "ndjson"
+
+        for chunk in export(user, format):
+            sys.stdout.buffer.write(chunk)
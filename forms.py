@@ -1,6 +1,22 @@
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length, URL, Optional
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
+
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
+
+def strip(value):
+    """Drop surrounding spaces, which usernames and emails can't have."""
+
+    return value.strip() if value else value
+
+
+def url_or_path(form, field):
+    """Accept full URLs or site paths like our default and uploaded images."""
+
+    if not field.data.startswith('/'):
+        URL()(form, field)
 
 
 class MessageForm(FlaskForm):
@@ -12,8 +28,10 @@ class MessageForm(FlaskForm):
 class UserAddForm(FlaskForm):
     """Form for adding users."""
 
-    username = StringField('Username', validators=[DataRequired()])
-    email = StringField('E-mail', validators=[DataRequired(), Email()])
+    username = StringField('Username', validators=[DataRequired()],
+                           filters=[strip])
+    email = StringField('E-mail', validators=[DataRequired(), Email()],
+                        filters=[strip])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
 
@@ -26,12 +44,18 @@ class LoginForm(FlaskForm):
 
 
 class UpdateUserForm(FlaskForm):
-    username = StringField('Username', validators=[DataRequired()])
-    email = StringField('E-mail', validators=[DataRequired(), Email()])
+    username = StringField('Username', validators=[DataRequired()],
+                           filters=[strip])
+    email = StringField('E-mail', validators=[DataRequired(), Email()],
+                        filters=[strip])
     image_url = StringField('(Optional) Image URL',
-                            validators=[URL(),Optional()])
+                            validators=[Optional(), url_or_path])
+    image_file = FileField('(Optional) Upload image',
+                           validators=[FileAllowed(IMAGE_EXTENSIONS)])
     header_image_url = StringField('(Optional) Image URL',
-                            validators=[URL(),Optional()])
+                            validators=[Optional(), url_or_path])
+    header_image_file = FileField('(Optional) Upload header image',
+                                  validators=[FileAllowed(IMAGE_EXTENSIONS)])
     bio = TextAreaField('(Optional)')
     password = PasswordField('Password', validators=[DataRequired(), Length(min=6)])
 
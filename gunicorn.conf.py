@@ -0,0 +1,140 @@
+"""Gunicorn settings for Warbler; gunicorn reads this file automatically.
+
+The app is built once in the master (preload_app) and then forked, so
+workers share its imported modules, compiled templates and config
+copy-on-write instead of each building their own.
+
+Pick the worker class with GUNICORN_WORKER_CLASS:
+
+    sync      one request at a time per worker (default)
+    gthread   GUNICORN_THREADS requests at a time per worker
+    gevent    GUNICORN_WORKER_CONNECTIONS greenlets per worker
+    eventlet  same, with eventlet (install it first)
+
+The database pool is sized to match, so every thread or greenlet that
+can be serving a request can get a connection.
+
+Workers write Prometheus metrics to files in PROMETHEUS_MULTIPROC_DIR so
+/metrics can add them up across workers.
+
+The live timeline stream (/timeline/stream) is only served by gevent and
+eventlet workers, where an idle stream costs a greenlet rather than a
+worker. Workers pass new messages to each other's streams through
+Postgres LISTEN/NOTIFY (PUBSUB_BACKEND).
+
+Workers share hot profile pages' data through files in SINGLEFLIGHT_DIR,
+so only one worker on the host loads each. Unless set, that's a new
+private temp directory for each run.
+
+Each worker warms up its caches before taking requests (WARMUP), for
+the users and profiles requested most before the restart, going by the
+counts workers save in the database.
+"""
+
+import gc
+import os
+import shutil
+import tempfile
+
+# Must be set before prometheus_client is imported by the app.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "warbler-metrics"))
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+os.environ.setdefault("PUBSUB_BACKEND", "postgres")
+# A fresh private (0700) directory, so no one else can plant pickles.
+own_singleflight_dir = "SINGLEFLIGHT_DIR" not in os.environ
+if own_singleflight_dir:
+    os.environ["SINGLEFLIGHT_DIR"] = tempfile.mkdtemp(
+        prefix="warbler-singleflight-")
+
+os.environ.setdefault("WARMUP", "boot")
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+preload_app = True
+
+if worker_class == "gevent":
+    # Patch before the app (and its locks and sockets) is preloaded.
+    from gevent import monkey
+    monkey.patch_all()
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+elif worker_class == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+
+    from psycogreen.eventlet import patch_psycopg
+    patch_psycopg()
+
+if worker_class == "gthread":
+    os.environ.setdefault("DB_POOL_SIZE", str(threads))
+
+elif worker_class in ("gevent", "eventlet"):
+    # Greenlets mostly wait on the DB, so a pool as big as
+    # worker_connections would just move the queue into Postgres.
+    os.environ.setdefault("DB_POOL_SIZE", "10")
+    os.environ.setdefault("DB_MAX_OVERFLOW", "10")
+    os.environ.setdefault("TIMELINE_STREAM", "1")
+
+else:
+    os.environ.setdefault("DB_POOL_SIZE", "1")
+
+
+def on_starting(server):
+    """Remove metrics left by a previous run, which would be counted
+    again, and its cached profiles."""
+
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    for name in os.listdir(metrics_dir):
+        if not name.endswith(f"_{os.getpid()}.db"):
+            os.remove(os.path.join(metrics_dir, name))
+
+    cache_dir = os.environ["SINGLEFLIGHT_DIR"]
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, name))
+
+
+def pre_fork(server, worker):
+    """Stop the garbage collector from touching (and so copying) pages
+    the master set up before forking."""
+
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Drop DB connections inherited from the master, then warm up.
+
+    A connection shared across processes gets corrupted, so each worker
+    must open its own. close=False leaves the master's sockets alone.
+    """
+
+    import warmup
+    from models import db
+
+    app = worker.app.wsgi()
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    warmup.start(app)
+
+
+def on_exit(server):
+    """Remove the cached profiles' directory, if we made it."""
+
+    if own_singleflight_dir:
+        shutil.rmtree(os.environ["SINGLEFLIGHT_DIR"], ignore_errors=True)
+
+
+def child_exit(server, worker):
+    """Stop counting a dead worker's live gauges."""
+
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,316 @@
+"""Per-route memory budgets, measured with tracemalloc.
+
+MemoryProfile records the peak memory a stretch of code allocates, and
+which lines of Warbler's own code allocated the most of what was live
+as templates were rendered (when a view's query results are all still
+held). It's used three ways:
+
+- test_memory.py runs routes against a big generated dataset and fails
+  any route whose peak goes over its budget;
+- `python memprofile.py` does the same against a scratch database
+  (BENCH_DATABASE_URL, default postgresql:///warbler_bench; it is
+  wiped) and prints a report;
+- with MEMPROFILE_SAMPLE_RATE set, that fraction of real requests are
+  measured, and any that go over budget are logged with their top
+  allocation sites.
+
+Budgets are bytes per endpoint in MEMORY_BUDGETS; other endpoints get
+MEMORY_BUDGET_DEFAULT.
+
+tracemalloc slows down every allocation in the process while it's on,
+and its peak counts every thread's allocations, so a worker only samples
+one request at a time.
+"""
+
+import os
+import random
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+from flask import current_app, g, request
+from sqlalchemy import text
+
+MB = 1024 * 1024
+
+# Frames kept per allocation, to find the Warbler line behind it.
+FRAMES = 30
+TOP_SITES = 10
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BUDGETS = {
+    # The timeline query takes the ids of everyone the user follows.
+    "warbler.homepage": 8 * MB,
+    "warbler.list_users": 2 * MB,
+    "warbler.show_user": 4 * MB,
+    "warbler.show_user_liked_messages": 4 * MB,
+    "warbler.show_following": 2 * MB,
+    "warbler.show_followers": 2 * MB,
+}
+
+# (endpoint, URL) pairs the harness requests, as the heavy user.
+ROUTES = [
+    ("warbler.homepage", "/"),
+    ("warbler.list_users", "/users"),
+    ("warbler.show_user", "/users/{user_id}"),
+    ("warbler.show_user_liked_messages", "/users/{user_id}/likes"),
+    ("warbler.show_following", "/users/{user_id}/following"),
+    ("warbler.show_followers", "/users/{user_id}/followers"),
+]
+
+# measure() passes its profile to the request in the WSGI environ.
+ENVIRON_KEY = "warbler.memprofile"
+
+_sample_lock = threading.Lock()
+
+
+class MemoryProfile:
+    """Measures memory allocated between start() and stop().
+
+    `peak` is the most allocated at once, in bytes. `sites` is a list of
+    ("file:line", bytes, allocations) for the lines of Warbler code
+    behind the most memory live at the biggest template render, taken
+    only if that was more than `sites_over` bytes.
+    """
+
+    def __init__(self, sites_over=0):
+        self.sites_over = sites_over
+        self.peak = 0
+        self.sites = []
+        self._base = 0
+        self._started_tracing = False
+        self._baseline = None
+        self._snapshot = None
+        self._snapshot_size = -1
+
+    def start(self):
+        if tracemalloc.is_tracing():
+            self._baseline = tracemalloc.take_snapshot()
+        else:
+            tracemalloc.start(FRAMES)
+            self._started_tracing = True
+
+        tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def rendering(self):
+        """Called as each template renders; snapshot if it's the biggest."""
+
+        size = tracemalloc.get_traced_memory()[0] - self._base
+        if size > self.sites_over and size > self._snapshot_size:
+            self._snapshot = tracemalloc.take_snapshot()
+            self._snapshot_size = size
+
+    def stop(self):
+        self.peak = max(tracemalloc.get_traced_memory()[1] - self._base, 0)
+        if self._snapshot is not None:
+            self.sites = self._top_sites(self._snapshot)
+        if self._started_tracing:
+            tracemalloc.stop()
+        self._snapshot = self._baseline = None
+        return self
+
+    def _top_sites(self, snapshot):
+        """Total up live memory by the innermost Warbler line behind it."""
+
+        if self._baseline is not None:
+            traces = [stat for stat in snapshot.compare_to(
+                self._baseline, "traceback") if stat.size_diff > 0]
+            traces = [(stat.traceback, stat.size_diff, stat.count_diff)
+                      for stat in traces]
+        else:
+            traces = [(trace.traceback, trace.size, 1)
+                      for trace in snapshot.traces]
+
+        sizes = Counter()
+        counts = Counter()
+        for traceback, size, count in traces:
+            site = _warbler_frame(traceback)
+            if site:
+                sizes[site] += size
+                counts[site] += count
+
+        return [(site, size, counts[site])
+                for site, size in sizes.most_common(TOP_SITES)]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _warbler_frame(traceback):
+    # Innermost frame first; skip this file and anything installed.
+    for frame in reversed(traceback):
+        filename = frame.filename
+        if (filename.startswith(HERE)
+                and "site-packages" not in filename
+                and filename != __file__):
+            return f"{os.path.relpath(filename, HERE)}:{frame.lineno}"
+    return None
+
+
+def budget_for(endpoint):
+    config = current_app.config
+    return config["MEMORY_BUDGETS"].get(
+        endpoint, config["MEMORY_BUDGET_DEFAULT"])
+
+
+def format_sites(sites):
+    return "\n".join(f"  {size / 1024:10.1f} KiB {count:8} allocs  {site}"
+                     for site, size, count in sites)
+
+
+def note_render():
+    """Context processor: lets the request's profile look at a render."""
+
+    profile = g.get("memprofile") or request.environ.get(ENVIRON_KEY)
+    if profile is not None:
+        profile.rendering()
+    return {}
+
+
+def start_sample():
+    """Measure this request, if it's sampled and no other one is."""
+
+    rate = current_app.config["MEMPROFILE_SAMPLE_RATE"]
+    if not rate or random.random() >= rate:
+        return
+    if not _sample_lock.acquire(blocking=False):
+        return
+
+    g.memprofile = MemoryProfile(
+        sites_over=budget_for(request.endpoint)).start()
+
+
+def finish_sample(exc):
+    """Log this request if it went over its memory budget."""
+
+    profile = g.pop("memprofile", None)
+    if profile is None:
+        return
+
+    try:
+        profile.stop()
+    finally:
+        _sample_lock.release()
+
+    budget = budget_for(request.endpoint)
+    if profile.peak > budget:
+        current_app.logger.warning(
+            "%s %s allocated %.1f MiB, over its %.1f MiB budget:\n%s",
+            request.method, request.full_path.rstrip("?"),
+            profile.peak / MB, budget / MB, format_sites(profile.sites))
+
+
+def init_app(app):
+    """Add memory budgets, and opt-in sampling against them, to `app`."""
+
+    app.config.setdefault("MEMORY_BUDGETS", dict(DEFAULT_BUDGETS))
+    app.config.setdefault("MEMORY_BUDGET_DEFAULT", 8 * MB)
+    app.config.setdefault("MEMPROFILE_SAMPLE_RATE", 0.0)
+
+    app.context_processor(note_render)
+    app.before_request(start_sample)
+    app.teardown_request(finish_sample)
+
+
+def fill(users=5_000, messages=5_000, likes=5_000):
+    """Fill empty tables with `users` users, and one heavy user with
+    `messages` messages, `likes` likes and every other user following it
+    and followed by it. Returns the heavy user's id."""
+
+    from models import db, User
+
+    db.session.bulk_insert_mappings(User, [
+        dict(username=f"mem{i}", email=f"mem{i}@email.com", password="x",
+             bio="A fairly ordinary bio for a fairly ordinary user.")
+        for i in range(users)])
+    db.session.flush()
+
+    heavy_id = db.session.query(db.func.min(User.id)).scalar()
+    params = dict(heavy_id=heavy_id, messages=messages, likes=likes)
+
+    db.session.execute(text("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT 'message number ' || n,
+               now() at time zone 'utc' - n * interval '1 minute', :heavy_id
+        FROM generate_series(1, :messages) n
+    """), params)
+
+    db.session.execute(text("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT 'liked message number ' || n,
+               now() at time zone 'utc' - n * interval '1 minute', u.id
+        FROM generate_series(1, :likes) n
+        JOIN users u ON u.id = :heavy_id + 1 + n % (
+            SELECT count(*) - 1 FROM users)
+    """), params)
+
+    db.session.execute(text("""
+        INSERT INTO likes (user_id, message_id)
+        SELECT :heavy_id, id FROM messages WHERE user_id != :heavy_id
+    """), params)
+
+    db.session.execute(text("""
+        INSERT INTO follows (user_following_id, user_being_followed_id)
+        SELECT id, :heavy_id FROM users WHERE id != :heavy_id
+        UNION ALL
+        SELECT :heavy_id, id FROM users WHERE id != :heavy_id
+    """), params)
+
+    User.refresh_follow_counts()
+    db.session.commit()
+
+    return heavy_id
+
+
+def measure(client, url):
+    """GET `url` with test `client`, returning its MemoryProfile."""
+
+    # Once first, so one-off imports and caches aren't counted.
+    client.get(url)
+
+    profile = MemoryProfile()
+    with profile:
+        resp = client.get(url, environ_base={ENVIRON_KEY: profile})
+
+    if resp.status_code != 200:
+        raise RuntimeError(f"GET {url} returned {resp.status_code}")
+    return profile
+
+
+if __name__ == "__main__":
+    from app import create_app, CURR_USER_KEY
+    from models import db
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": os.environ.get(
+            "BENCH_DATABASE_URL", "postgresql:///warbler_bench"),
+        "SINGLEFLIGHT_TTL": 0,
+        "SINGLEFLIGHT_STALE": 0,
+    })
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        heavy_id = fill(users=size, messages=size, likes=size)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = heavy_id
+
+    with app.app_context():
+        for endpoint, url in ROUTES:
+            url = url.format(user_id=heavy_id)
+            profile = measure(client, url)
+            budget = budget_for(endpoint)
+            verdict = "ok" if profile.peak <= budget else "OVER BUDGET"
+            print(f"{url:28} peak {profile.peak / MB:7.2f} MiB "
+                  f"(budget {budget / MB:.1f} MiB) {verdict}")
+            print(format_sites(profile.sites))
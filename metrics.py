@@ -0,0 +1,165 @@
+"""Prometheus metrics, served at /metrics.
+
+Under gunicorn each worker is its own process, so metrics are written to
+files in PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py sets this up) and
+/metrics adds up every worker's files, whichever worker serves it.
+
+Set METRICS_TOKEN to require `Authorization: Bearer <token>` on /metrics.
+"""
+
+import os
+import time
+
+from flask import (
+    Blueprint, Response, abort, current_app, g, has_request_context, request)
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+    Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUESTS = Counter(
+    "warbler_requests_total",
+    "HTTP requests served.",
+    ["endpoint", "method", "status"])
+
+REQUEST_LATENCY = Histogram(
+    "warbler_request_duration_seconds",
+    "Time spent serving HTTP requests.",
+    ["endpoint"],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+DB_QUERIES = Counter(
+    "warbler_db_queries_total",
+    "SQL statements run.",
+    ["endpoint"])
+
+DB_QUERY_LATENCY = Histogram(
+    "warbler_db_query_duration_seconds",
+    "Time spent running SQL statements.",
+    ["endpoint"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+
+CACHE_REQUESTS = Counter(
+    "warbler_cache_requests_total",
+    "Cache lookups, by cache and whether they hit.",
+    ["cache", "result"])
+
+BCRYPT_IN_USE = Gauge(
+    "warbler_bcrypt_in_use",
+    "bcrypt hashes running.",
+    multiprocess_mode="livesum")
+
+BCRYPT_WAITING = Gauge(
+    "warbler_bcrypt_waiting",
+    "bcrypt hashes waiting for a free slot.",
+    multiprocess_mode="livesum")
+
+BCRYPT_SLOTS = Gauge(
+    "warbler_bcrypt_slots",
+    "bcrypt hashes allowed to run at once.",
+    multiprocess_mode="livesum")
+
+DB_POOL_CHECKED_OUT = Gauge(
+    "warbler_db_pool_checked_out",
+    "DB connections in use.",
+    multiprocess_mode="livesum")
+
+DB_POOL_SIZE = Gauge(
+    "warbler_db_pool_size",
+    "DB connections the pool keeps open.",
+    multiprocess_mode="livesum")
+
+metrics = Blueprint("metrics", __name__)
+
+
+def record_cache(cache, hit):
+    """Count a lookup in `cache` as a hit or a miss."""
+
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or "none"
+    return "none"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, params, context, many):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, params, context, many):
+    start = conn.info["metrics_query_start"].pop()
+    endpoint = _endpoint()
+    DB_QUERIES.labels(endpoint).inc()
+    DB_QUERY_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+
+
+@event.listens_for(Engine, "handle_error")
+def discard_query_timer(context):
+    """A failed query never reaches after_cursor_execute; drop its start
+    time so the next query on this connection isn't timed from it."""
+
+    conn = context.connection
+    if context.execution_context is not None and conn is not None:
+        starts = conn.info.get("metrics_query_start")
+        if starts:
+            starts.pop()
+
+
+def start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def record_request(response):
+    """Count this request and update this worker's resource gauges."""
+
+    endpoint = request.endpoint or "none"
+    REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+
+    if "metrics_start" in g:
+        REQUEST_LATENCY.labels(endpoint).observe(
+            time.perf_counter() - g.metrics_start)
+
+    from passwords import pool_usage
+    in_use, waiting, slots = pool_usage()
+    BCRYPT_IN_USE.set(in_use)
+    BCRYPT_WAITING.set(waiting)
+    BCRYPT_SLOTS.set(slots)
+
+    from models import db
+    pool = db.engine.pool
+    DB_POOL_CHECKED_OUT.set(pool.checkedout())
+    DB_POOL_SIZE.set(pool.size())
+
+    return response
+
+
+@metrics.get("/metrics")
+def show_metrics():
+    """Metrics for every worker, in Prometheus text format."""
+
+    token = current_app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(404)
+
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Record metrics for `app`'s requests and serve them at /metrics."""
+
+    app.config.setdefault("METRICS_TOKEN", os.environ.get("METRICS_TOKEN"))
+
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    app.register_blueprint(metrics)
@@ -2,15 +2,40 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import any_, bindparam, func, update
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+
+from passwords import hash_password, check_password
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
+# How many user cards to show per page of followers/following.
+FOLLOWS_PAGE_SIZE = 24
+
+# How many messages to show per page of a tag or mentions timeline.
+MESSAGES_PAGE_SIZE = 50
+
+# How many notifications to show per page.
+NOTIFICATIONS_PAGE_SIZE = 20
+
+# Trending decay periods, in seconds: a like counts for 1/e as much
+# after each period has passed.
+TRENDING_PERIODS = {
+    "day": 24 * 60 * 60,
+    "week": 7 * 24 * 60 * 60,
+}
+
+# How many top messages to keep trending scores for, per period.
+TRENDING_KEEP = 100
+
+# Trending scores are stored relative to this, so they never need
+# decaying after the fact.
+TRENDING_EPOCH = datetime(2022, 1, 1)
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -29,6 +54,13 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key covers lookups by followed user; this covers
+    # lookups of who a user is following.
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     def __repr__(self):
         return f"""<Followed user_id #{self.user_being_followed_id},
                     following user_id #{self.user_following_id}>"""
@@ -80,6 +112,46 @@ class User(db.Model):
         nullable=False,
     )
 
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Can see /admin pages.
+    is_admin = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
+    # Kept by notifications.py, so the navbar needn't count them.
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Usernames and emails are unique case-insensitively, as availability
+    # checks them. Also for username prefix searches (LIKE 'jo%').
+    __table_args__ = (
+        db.Index('ix_users_lower_username',
+                 db.func.lower(username).label('lower_username'),
+                 unique=True,
+                 postgresql_ops={'lower_username': 'text_pattern_ops'}),
+        db.Index('ix_users_lower_email', db.func.lower(email), unique=True),
+    )
+
     messages = db.relationship('Message',
                                 backref="user",
                                 cascade="all, delete",
@@ -109,7 +181,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -136,7 +208,7 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
                 return user
 
@@ -145,16 +217,274 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows
+            .query
+            .filter_by(user_following_id=self.id,
+                       user_being_followed_id=other_user.id)
+            .exists()
+        ).scalar()
+
+    def following_ids(self):
+        """Ids of everyone this user follows, as a set."""
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id))
+        return {user_id for (user_id,) in rows}
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following? Returns a set."""
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
+    def liked_among(self, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set."""
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Like.message_id)
+                .filter(Like.user_id == self.id,
+                        Like.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
+    @property
+    def messages_count(self):
+        """How many messages this user has posted."""
+
+        return (db.session
+                .query(db.func.count(Message.id))
+                .filter(Message.user_id == self.id)
+                .scalar())
+
+    @property
+    def likes_count(self):
+        """How many messages this user has liked."""
+
+        return (db.session
+                .query(db.func.count(Like.message_id))
+                .filter(Like.user_id == self.id)
+                .scalar())
+
+    def follow(self, other_user):
+        """Follow `other_user`, keeping both users' counters up to date.
+
+        Does nothing if already following them, even if another request
+        is following them at the same moment. Returns whether it followed.
+        """
+
+        inserted = db.session.execute(
+            insert(Follows)
+            .values(user_following_id=self.id,
+                    user_being_followed_id=other_user.id)
+            .on_conflict_do_nothing()
+        ).rowcount
+        if inserted:
+            self._bump_follow_counts(other_user, 1)
+        return bool(inserted)
+
+    def unfollow(self, other_user):
+        """Stop following `other_user`, keeping counters up to date.
+
+        Does nothing if not following them. Returns whether it unfollowed.
+        """
+
+        deleted = (Follows
+                   .query
+                   .filter_by(user_following_id=self.id,
+                              user_being_followed_id=other_user.id)
+                   .delete())
+        if deleted:
+            self._bump_follow_counts(other_user, -1)
+        return bool(deleted)
+
+    def _bump_follow_counts(self, other_user, change):
+        """Atomically adjust counters for self following other_user.
+
+        Rows are updated in id order, as the notifications aggregator
+        locks them, so the two can't deadlock.
+        """
+
+        updates = sorted([
+            (self.id, {User.following_count: User.following_count + change}),
+            (other_user.id,
+             {User.followers_count: User.followers_count + change}),
+        ], key=lambda update: update[0])
+        for user_id, values in updates:
+            User.query.filter_by(id=user_id).update(
+                values, synchronize_session=False)
+
+        db.session.expire(self, ['following', 'following_count'])
+        db.session.expire(other_user, ['followers', 'followers_count'])
+
+    def release_follow_counts(self):
+        """Decrement counters of everyone this user follows or is followed
+        by; call before deleting the user."""
+
+        followed_ids = (db.session
+                        .query(Follows.user_being_followed_id)
+                        .filter(Follows.user_following_id == self.id))
+        follower_ids = (db.session
+                        .query(Follows.user_following_id)
+                        .filter(Follows.user_being_followed_id == self.id))
+
+        User.query.filter(User.id.in_(followed_ids)).update(
+            {User.followers_count: User.followers_count - 1},
+            synchronize_session=False)
+        User.query.filter(User.id.in_(follower_ids)).update(
+            {User.following_count: User.following_count - 1},
+            synchronize_session=False)
+
+    def toggle_like(self, message):
+        """Like `message`, or unlike it if already liked.
+
+        Safe against concurrent toggles: each one either deletes or
+        inserts a single row, so likes never duplicate or error. The
+        message's trending scores are updated in the same transaction.
+        Returns True if the message is now liked.
+        """
+
+        likes = Like.__table__
+        unliked_at = db.session.execute(
+            likes
+            .delete()
+            .where(likes.c.user_id == self.id,
+                   likes.c.message_id == message.id)
+            .returning(likes.c.timestamp)
+        ).scalar()
+
+        if unliked_at:
+            TrendingScore.remove_like(message.id, unliked_at)
+        else:
+            liked_at = db.session.execute(
+                insert(Like)
+                .values(user_id=self.id,
+                        message_id=message.id,
+                        timestamp=datetime.utcnow())
+                .on_conflict_do_nothing()
+                .returning(Like.timestamp)
+            ).scalar()
+
+            # None if a concurrent toggle inserted it first and counted it.
+            if liked_at:
+                TrendingScore.add_like(message.id, liked_at)
+
+        db.session.expire(self, ['liked_messages'])
+        return not unliked_at
+
+    def following_page(self, after=None, limit=FOLLOWS_PAGE_SIZE):
+        """A page of users this user follows, ordered by id after `after`.
+
+        Returns (cards, next cursor or None).
+        """
+
+        return _user_card_page(Follows.user_being_followed_id,
+                               Follows.user_following_id == self.id,
+                               after, limit)
+
+    def followers_page(self, after=None, limit=FOLLOWS_PAGE_SIZE):
+        """A page of users following this user, ordered by id after `after`.
+
+        Returns (cards, next cursor or None).
+        """
+
+        return _user_card_page(Follows.user_following_id,
+                               Follows.user_being_followed_id == self.id,
+                               after, limit)
+
+    def liked_page(self, before=None, limit=MESSAGES_PAGE_SIZE):
+        """A page of messages this user liked, newest first, before the
+        message id `before`.
+
+        Returns (messages, next cursor or None).
+        """
+
+        return _message_page(Like, Like.user_id == self.id, before, limit)
+
+    @classmethod
+    def directory_page(cls, search=None, after=None,
+                       limit=FOLLOWS_PAGE_SIZE):
+        """A page of users whose username contains `search` (or all
+        users), ordered by id after `after`.
+
+        Returns (cards, next cursor or None).
+        """
+
+        query = db.session.query(cls.id,
+                                 cls.username,
+                                 cls.image_url,
+                                 cls.header_image_url,
+                                 cls.bio)
+
+        if search:
+            query = query.filter(cls.username.like(f"%{search}%"))
+        if after is not None:
+            query = query.filter(cls.id > after)
+
+        cards = query.order_by(cls.id).limit(limit + 1).all()
+
+        if len(cards) > limit:
+            return cards[:limit], cards[limit - 1].id
+
+        return cards, None
+
+    @classmethod
+    def refresh_follow_counts(cls):
+        """Recompute every user's follower/following counters from the
+        follows table (e.g. after bulk loading follows)."""
+
+        followers = (db.session
+                     .query(db.func.count())
+                     .filter(Follows.user_being_followed_id == cls.id)
+                     .scalar_subquery())
+        following = (db.session
+                     .query(db.func.count())
+                     .filter(Follows.user_following_id == cls.id)
+                     .scalar_subquery())
+
+        cls.query.update({cls.followers_count: followers,
+                          cls.following_count: following},
+                         synchronize_session=False)
+
+
+def _user_card_page(user_id_col, condition, after, limit):
+    """Keyset-paginate user cards joined through `user_id_col` of follows.
+
+    Only loads the columns the user cards render.
+    """
+
+    query = (db.session
+             .query(User.id,
+                    User.username,
+                    User.image_url,
+                    User.header_image_url,
+                    User.bio)
+             .join(Follows, user_id_col == User.id)
+             .filter(condition))
+
+    if after is not None:
+        query = query.filter(user_id_col > after)
+
+    cards = query.order_by(user_id_col).limit(limit + 1).all()
+
+    if len(cards) > limit:
+        return cards[:limit], cards[limit - 1].id
+
+    return cards, None
 
 
 class Message(db.Model):
@@ -184,9 +514,128 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Timelines read each followed user's newest messages straight off
+    # this, however much older history there is.
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp'),
+    )
+
     def __repr__(self):
         return f"<Msg #{self.id}: {self.text}, {self.timestamp}, {self.user_id}>"
 
+    @classmethod
+    def timeline(cls, user_ids, limit=100):
+        """The newest `limit` messages by any of `user_ids`."""
+
+        # One array parameter rather than one per id: following thousands
+        # of users would otherwise compile into thousands of bind params.
+        user_ids = bindparam("user_ids", list(user_ids),
+                             type_=ARRAY(db.Integer))
+
+        return (cls
+                .query
+                .filter(cls.user_id == any_(user_ids))
+                .order_by(cls.timestamp.desc())
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def posted_by(cls, user_id, before=None, limit=MESSAGES_PAGE_SIZE):
+        """A page of `user_id`'s messages, newest first, before the
+        message id `before`.
+
+        Returns (messages, next cursor or None).
+        """
+
+        query = cls.query.filter(cls.user_id == user_id)
+        if before is not None:
+            query = query.filter(cls.id < before)
+
+        messages = query.order_by(cls.id.desc()).limit(limit + 1).all()
+
+        if len(messages) > limit:
+            return messages[:limit], messages[limit - 1].id
+
+        return messages, None
+
+    @classmethod
+    def tagged(cls, tag, before=None, limit=MESSAGES_PAGE_SIZE):
+        """A page of messages tagged #`tag`, newest first, before the
+        message id `before`.
+
+        Returns (messages, next cursor or None).
+        """
+
+        return _message_page(MessageTag, MessageTag.tag == tag.lower(),
+                             before, limit)
+
+    @classmethod
+    def mentioning(cls, user, before=None, limit=MESSAGES_PAGE_SIZE):
+        """A page of messages that @mention `user`, newest first, before
+        the message id `before`.
+
+        Returns (messages, next cursor or None).
+        """
+
+        return _message_page(Mention, Mention.user_id == user.id,
+                             before, limit)
+
+
+def _message_page(index, condition, before, limit):
+    """Keyset-paginate messages through `index`, a table of message ids,
+    walking its (key, message_id) primary key backwards."""
+
+    query = (Message
+             .query
+             .join(index, index.message_id == Message.id)
+             .filter(condition)
+             .options(db.joinedload(Message.user)))
+
+    if before is not None:
+        query = query.filter(index.message_id < before)
+
+    messages = query.order_by(index.message_id.desc()).limit(limit + 1).all()
+
+    if len(messages) > limit:
+        return messages[:limit], messages[limit - 1].id
+
+    return messages, None
+
+
+class MessageTag(db.Model):
+    """A #hashtag in a message."""
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.String(140),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
 
 class Like(db.Model):
     """Like model."""
@@ -205,6 +654,505 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.text("(now() at time zone 'utc')"),
+    )
+
+    # The primary key covers a message's likes; this covers a user's.
+    __table_args__ = (
+        db.Index('ix_likes_user_message', 'user_id', 'message_id'),
+    )
+
+
+def trending_exponent(period, liked_at):
+    """Log of the weight of a like at `liked_at`, relative to the epoch."""
+
+    elapsed = (liked_at - TRENDING_EPOCH).total_seconds()
+    return elapsed / TRENDING_PERIODS[period]
+
+
+class TrendingScore(db.Model):
+    """A message's time-decayed like score over one decay period.
+
+    `score` is log(sum(exp(trending_exponent(period, t)))) over the
+    times t the message was liked. Newer likes count for exponentially
+    more, so ordering by `score` is ordering by current decayed score,
+    without ever rescaling old rows. Storing the log keeps it from
+    overflowing.
+
+    Only the TRENDING_KEEP best messages per period are kept; one that
+    falls out and is liked again starts over from that like. trending.py
+    rebuilds the table exactly from likes.
+    """
+
+    __tablename__ = 'trending_scores'
+
+    # Trending scores within this of a like's exponent are that like alone.
+    MIN_GAP = 1e-9
+
+    period = db.Column(
+        db.String(10),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    message = db.relationship("Message")
+
+    __table_args__ = (
+        db.Index('ix_trending_scores_period_score', 'period', 'score'),
+    )
+
+    @classmethod
+    def add_like(cls, message_id, liked_at):
+        """Add a like at `liked_at` to the message's scores."""
+
+        for period in TRENDING_PERIODS:
+            stmt = insert(cls).values(
+                period=period,
+                message_id=message_id,
+                score=trending_exponent(period, liked_at))
+
+            # log(exp(old) + exp(new)), without overflowing exp() or
+            # underflowing it (which Postgres reports as an error).
+            old = cls.__table__.c.score
+            new = stmt.excluded.score
+            gap = func.least(func.abs(old - new), 700)
+
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[cls.period, cls.message_id],
+                set_=dict(score=func.greatest(old, new)
+                          + func.ln(1 + func.exp(-gap)))))
+
+            cls.prune(period)
+
+    @classmethod
+    def remove_like(cls, message_id, liked_at):
+        """Take a like at `liked_at` back out of the message's scores."""
+
+        table = cls.__table__
+
+        for period in TRENDING_PERIODS:
+            gap = table.c.score - trending_exponent(period, liked_at)
+            row = (table.c.period == period,
+                   table.c.message_id == message_id)
+
+            # If this was its only like, the message isn't trending.
+            db.session.execute(
+                table.delete().where(*row, gap <= cls.MIN_GAP))
+
+            # log(exp(score) - exp(like)), keeping exp() from underflowing.
+            db.session.execute(
+                table.update()
+                .where(*row, gap > cls.MIN_GAP)
+                .values(score=table.c.score
+                        + func.ln(1 - func.exp(-func.least(gap, 700)))))
+
+    @classmethod
+    def prune(cls, period):
+        """Drop all but the TRENDING_KEEP best scores for `period`."""
+
+        table = cls.__table__
+        cutoff = (db.select(table.c.score)
+                  .where(table.c.period == period)
+                  .order_by(table.c.score.desc())
+                  .offset(TRENDING_KEEP)
+                  .limit(1)
+                  .scalar_subquery())
+
+        db.session.execute(
+            table.delete().where(table.c.period == period,
+                                 table.c.score <= cutoff))
+
+    @classmethod
+    def top(cls, period, limit=TRENDING_KEEP):
+        """The most-liked messages over `period`, best first."""
+
+        return [score.message for score in (
+            cls
+            .query
+            .filter_by(period=period)
+            .order_by(cls.score.desc())
+            .options(db.joinedload(cls.message).joinedload(Message.user))
+            .limit(limit)
+            .all())]
+
+
+class MessageArchive(db.Model):
+    """A month of messages moved out of the messages table into a file.
+
+    See archive.py.
+    """
+
+    __tablename__ = 'message_archives'
+
+    # The first day of the month.
+    month = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    filename = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # Lowest and highest message id in the file, to narrow down which
+    # files to read when looking for one message.
+    first_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    last_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Recommendation(db.Model):
+    """A precomputed who-to-follow suggestion for a user."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    recommended_user = db.relationship(
+        "User", foreign_keys=[recommended_user_id])
+
+    __table_args__ = (
+        db.Index('ix_recommendations_user_rank', 'user_id', 'rank'),
+    )
+
+    @classmethod
+    def for_user(cls, user, limit=5):
+        """Top recommendations for `user`, skipping anyone followed since
+        they were computed."""
+
+        already_following = (db.session
+                             .query(Follows.user_being_followed_id)
+                             .filter(Follows.user_following_id == user.id))
+
+        return (cls
+                .query
+                .filter(cls.user_id == user.id,
+                        cls.recommended_user_id.notin_(already_following))
+                .order_by(cls.rank)
+                .options(db.joinedload(cls.recommended_user))
+                .limit(limit)
+                .all())
+
+
+class Event(db.Model):
+    """A change to messages, likes, follows or users, in the order the
+    changes were committed. See events.py."""
+
+    __tablename__ = 'events'
+
+    # Increases in commit order, so a consumer that has read up to an
+    # offset has seen every event before it.
+    offset = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    type = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Who made the change. Not a foreign key: the log outlives users.
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # The message, or followed user, it's about.
+    subject_id = db.Column(
+        db.Integer,
+    )
+
+    # The other user whose deletion would undo it (the followed user,
+    # or the liked or posted message's author).
+    target_user_id = db.Column(
+        db.Integer,
+    )
+
+    # What it changes; only the latest event per key survives compaction.
+    key = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    data = db.Column(
+        db.JSON,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_events_key_offset', 'key', 'offset'),
+    )
+
+
+class ConsumerCheckpoint(db.Model):
+    """How far through the event log a consumer has got."""
+
+    __tablename__ = 'consumer_checkpoints'
+
+    consumer = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    offset = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
+
+class EventSnapshot(db.Model):
+    """A consumer's state as of an offset, to replay onwards from."""
+
+    __tablename__ = 'event_snapshots'
+
+    consumer = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    offset = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    # zlib-compressed JSON.
+    state = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class Notification(db.Model):
+    """Someone followed a user, or some people liked one of their
+    messages: likes of the same message, and follows, collapse into one
+    notification until it's read. Written by notifications.py."""
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Who's notified.
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    # 'follow' or 'like'.
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # The liked message, for likes.
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+    )
+
+    # The latest few people to follow or like, newest first.
+    actor_ids = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    # How many people in all.
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    # The event log offset of its latest follow or like; orders the
+    # notifications and pages through them.
+    offset = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    message = db.relationship('Message')
+
+    __table_args__ = (
+        db.Index('ix_notifications_user_offset', 'user_id', 'offset'),
+    )
+
+    @classmethod
+    def page(cls, user, before=None, limit=NOTIFICATIONS_PAGE_SIZE):
+        """A page of `user`'s notifications, newest first, before the
+        offset `before`.
+
+        Returns (notifications, next cursor or None).
+        """
+
+        query = cls.query.filter(cls.user_id == user.id)
+        if before is not None:
+            query = query.filter(cls.offset < before)
+
+        notifications = (query
+                         .options(db.joinedload(cls.message))
+                         .order_by(cls.offset.desc())
+                         .limit(limit + 1)
+                         .all())
+
+        if len(notifications) > limit:
+            return notifications[:limit], notifications[limit - 1].offset
+
+        return notifications, None
+
+    @classmethod
+    def mark_all_read(cls, user):
+        """Mark all `user`'s notifications read; returns the ids of those
+        that weren't.
+
+        Takes the user's row first, as the aggregator does, so it can't
+        slip between the aggregator's reads and writes.
+        """
+
+        User.query.filter_by(id=user.id).update(
+            {User.unread_notifications: 0}, synchronize_session=False)
+        marked = db.session.execute(
+            update(cls)
+            .where(cls.user_id == user.id, cls.read.is_(False))
+            .values(read=True)
+            .returning(cls.id)
+        ).scalars().all()
+        db.session.expire(user, ['unread_notifications'])
+        return set(marked)
+
+
+class AccessCount(db.Model):
+    """How often a user's timeline or profile was loaded in an hour, for
+    picking what to warm up after a restart. Written by warmup.py."""
+
+    __tablename__ = 'access_counts'
+
+    # 'timeline' or 'profile'.
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # Not a foreign key: counts for deleted users just go cold.
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # The start of the hour counted.
+    hour = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_access_counts_hour', 'hour'),
+    )
+
+    @classmethod
+    def add(cls, connection, kind, counts, hour):
+        """Add {user id: count} to `kind`'s counts for `hour`."""
+
+        if not counts:
+            return
+
+        stmt = insert(cls).values([
+            dict(kind=kind, user_id=user_id, hour=hour, count=count)
+            for user_id, count in counts.items()])
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=[cls.kind, cls.user_id, cls.hour],
+            set_=dict(count=cls.count + stmt.excluded.count)))
+
+    @classmethod
+    def totals(cls, since):
+        """{kind: {user id: count}} counted since `since`."""
+
+        totals = {}
+        for kind, user_id, count in (db.session
+                                     .query(cls.kind, cls.user_id,
+                                            func.sum(cls.count))
+                                     .filter(cls.hour >= since)
+                                     .group_by(cls.kind, cls.user_id)):
+            totals.setdefault(kind, {})[user_id] = count
+        return totals
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,177 @@
+"""Notifications of new followers and likes, built from the event log.
+
+Following and liking only append to the event log (see events.py), so
+the routes that do them stay as quick as they were. This batch job
+reads the log's new follows and likes and turns them into
+notifications for the followed users and the liked messages' authors.
+
+Follows of a user, and likes of one message, collapse into the user's
+unread notification for them, if there is one: "alice, bob and 10
+others liked your warble". A notification stays put once read, and
+later likes start a new one. Unfollows and unlikes don't take anything
+back.
+
+Each user's number of unread notifications is kept on their row
+(users.unread_notifications) for the navbar.
+
+Run it every minute or so (e.g. from Heroku Scheduler), or leave it
+running:
+
+    python notifications.py           process everything new, then exit
+    python notifications.py --every 10
+
+Batches are processed in one transaction, along with the checkpoint,
+and only one process at a time can hold the checkpoint. So every event
+is notified exactly once, however many copies run.
+"""
+
+import sys
+import time
+from collections import defaultdict
+
+import events
+from models import db, User, Message, Notification
+
+CONSUMER = "notifications"
+
+BATCH_SIZE = 1_000
+
+# How many of the people who followed or liked a notification keeps.
+ACTORS_KEPT = 3
+
+KINDS = {"followed": "follow", "liked": "like"}
+
+
+def collapse(batch):
+    """Group follows and likes by what they notify.
+
+    Returns {(user_id, kind, message_id): (actor ids, newest first,
+    latest offset)}.
+    """
+
+    groups = {}
+    for event in batch:
+        kind = KINDS.get(event.type)
+        if kind is None or event.target_user_id is None:
+            continue
+
+        key = (event.target_user_id, kind,
+               event.subject_id if kind == "like" else None)
+        actors, _ = groups.get(key, ([], None))
+        groups[key] = ([event.user_id]
+                       + [id for id in actors if id != event.user_id],
+                       event.offset)
+
+    return groups
+
+
+def notify(groups):
+    """Add `groups` (from collapse()) to their users' notifications."""
+
+    # Users are locked in id order, as follows lock them; and before
+    # anything else, so they can't mark notifications read meanwhile.
+    user_ids = (db.session
+                .query(User.id)
+                .filter(User.id.in_({user_id for user_id, _, _ in groups}))
+                .order_by(User.id)
+                .with_for_update()
+                .all())
+    user_ids = {user_id for user_id, in user_ids}
+
+    # Don't let liked messages be deleted before they're notified.
+    message_ids = {message_id for _, _, message_id in groups if message_id}
+    message_ids = {message_id for message_id, in (
+        db.session
+        .query(Message.id)
+        .filter(Message.id.in_(message_ids))
+        .with_for_update(key_share=True))}
+
+    unread = {(n.user_id, n.kind, n.message_id): n
+              for n in Notification.query.filter(
+                  Notification.user_id.in_(user_ids),
+                  Notification.read.is_(False))}
+
+    new_unread = defaultdict(int)
+    for key, (actors, offset) in groups.items():
+        user_id, kind, message_id = key
+        if user_id not in user_ids:
+            continue
+        if message_id is not None and message_id not in message_ids:
+            continue
+
+        notification = unread.get(key)
+        if notification is None:
+            db.session.add(Notification(
+                user_id=user_id, kind=kind, message_id=message_id,
+                actor_ids=actors[:ACTORS_KEPT], count=len(actors),
+                offset=offset))
+            new_unread[user_id] += 1
+        else:
+            # Only the latest few actors are kept, so someone who comes
+            # back after several others is counted again.
+            seen = set(notification.actor_ids)
+            notification.count += sum(1 for id in actors if id not in seen)
+            notification.actor_ids = (
+                actors + [id for id in notification.actor_ids
+                          if id not in actors])[:ACTORS_KEPT]
+            notification.offset = offset
+
+    for user_id, count in sorted(new_unread.items()):
+        User.query.filter_by(id=user_id).update(
+            {User.unread_notifications: User.unread_notifications + count},
+            synchronize_session=False)
+
+
+def process_batch(limit=BATCH_SIZE):
+    """Notify the next `limit` events' follows and likes.
+
+    Returns the number of events processed; 0 once caught up.
+    """
+
+    try:
+        offset = events.lock_checkpoint(CONSUMER)
+        batch = events.read(offset, limit)
+        if batch:
+            notify(collapse(batch))
+            events.save_checkpoint(CONSUMER, batch[-1].offset)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return len(batch)
+
+
+def process_all():
+    """Notify everything new in the log; returns the events processed."""
+
+    total = 0
+    while count := process_batch():
+        total += count
+    return total
+
+
+def named_actors(notifications):
+    """The users each of `notifications` names, newest first, by
+    notification id. Deleted users are left out."""
+
+    ids = {id for n in notifications for id in n.actor_ids}
+    users = {user.id: user
+             for user in User.query.filter(User.id.in_(ids))}
+
+    return {n.id: [users[id] for id in n.actor_ids if id in users]
+            for n in notifications}
+
+
+if __name__ == "__main__":
+    from app import app
+
+    every = (float(sys.argv[2])
+             if len(sys.argv) == 3 and sys.argv[1] == "--every" else None)
+
+    with app.app_context():
+        while True:
+            print(f"Processed {process_all()} events.")
+            if every is None:
+                break
+            time.sleep(every)
@@ -0,0 +1,122 @@
+"""Whole-page cache for logged-out visitors.
+
+The pages anonymous visitors see (the landing page, the login and signup
+forms) are the same for all of them except for the CSRF token in their
+forms. The first render of each is kept in memory with the token swapped
+for a placeholder. Later anonymous requests get the cached page with their
+own token put back, before the user is loaded or anything is rendered.
+
+A request is only served from, or stored in, the cache if it's a GET of
+one of PAGE_CACHE_ENDPOINTS with no query string, from someone who isn't
+logged in and has no flashed messages waiting. Cached pages last
+PAGE_CACHE_SECONDS. Their responses say `Vary: Cookie`, since logging in
+changes them.
+"""
+
+import threading
+import time
+
+from flask import Response, current_app, g, request, session
+from flask_wtf.csrf import generate_csrf
+
+from metrics import record_cache
+
+CSRF_PLACEHOLDER = "__PAGECACHE_CSRF_TOKEN__"
+
+
+class PageCache:
+    """Rendered pages by path, with CSRF tokens taken out."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def get(self, path):
+        """(status, mimetype, body) cached for `path`, or None."""
+
+        page = self._pages.get(path)
+        if page is None or page[0] < time.monotonic():
+            return None
+        return page[1:]
+
+    def put(self, path, status, mimetype, body):
+        with self._lock:
+            self._pages[path] = (
+                time.monotonic() + self.seconds, status, mimetype, body)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+def get_page_cache():
+    return current_app.extensions["pagecache"]
+
+
+def cacheable():
+    """Is this request for a page that's the same for every visitor?"""
+
+    from app import CURR_USER_KEY
+
+    return (request.method == "GET"
+            and request.endpoint in current_app.config["PAGE_CACHE_ENDPOINTS"]
+            and not request.args
+            and CURR_USER_KEY not in session
+            and "_flashes" not in session)
+
+
+def serve_cached_page():
+    """Send the cached page for this request, if there is one.
+
+    Runs before the user is loaded, so a hit never touches the DB.
+    """
+
+    if not cacheable():
+        return None
+
+    page = get_page_cache().get(request.path)
+    record_cache("page", page is not None)
+    if page is None:
+        g.pagecache_store = True
+        return None
+
+    status, mimetype, body = page
+    if CSRF_PLACEHOLDER in body:
+        body = body.replace(CSRF_PLACEHOLDER, generate_csrf())
+
+    return Response(body, status=status, mimetype=mimetype)
+
+
+def store_page(response):
+    """Keep this response if it's a cacheable page, and say it varies."""
+
+    if g.pop("pagecache_store", False) and response.status_code == 200:
+        body = response.get_data(as_text=True)
+        # The form fields rendered this request's token, if any.
+        token = g.get("csrf_token")
+        if token:
+            body = body.replace(token, CSRF_PLACEHOLDER)
+        get_page_cache().put(
+            request.path, response.status_code, response.mimetype, body)
+
+    if request.endpoint in current_app.config["PAGE_CACHE_ENDPOINTS"]:
+        response.vary.add("Cookie")
+
+    return response
+
+
+def init_app(app):
+    """Serve logged-out visitors' pages from memory.
+
+    Set up before anything that loads the user, so hits skip it.
+    """
+
+    app.config.setdefault("PAGE_CACHE_SECONDS", 60)
+    app.config.setdefault(
+        "PAGE_CACHE_ENDPOINTS",
+        {"warbler.homepage", "warbler.login", "warbler.signup"})
+
+    app.extensions["pagecache"] = PageCache(app.config["PAGE_CACHE_SECONDS"])
+    app.before_request(serve_cached_page)
+    app.after_request(store_page)
@@ -0,0 +1,83 @@
+"""Password hashing that doesn't stall other requests.
+
+bcrypt is deliberately slow, so hashes run through a bounded pool:
+
+- under gevent or eventlet workers, on the hub's native thread pool, so
+  other greenlets keep serving while a hash runs;
+- under sync or threaded workers, in the calling thread (bcrypt releases
+  the GIL), with a semaphore capping how many run at once so a burst of
+  logins can't starve every other request of CPU.
+"""
+
+import os
+import sys
+import threading
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+MAX_CONCURRENT_HASHES = int(
+    os.environ.get("BCRYPT_CONCURRENCY", os.cpu_count() or 1))
+
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT_HASHES)
+_lock = threading.Lock()
+
+# How many hashes are running or waiting for a slot; see pool_usage().
+_in_use = 0
+_waiting = 0
+
+
+def _cooperative_runner():
+    """Return a function that runs a call off the event loop, if this
+    process has been monkey-patched by gevent or eventlet; else None."""
+
+    if "gevent.monkey" in sys.modules:
+        from gevent import get_hub, monkey
+
+        if monkey.is_module_patched("socket"):
+            return lambda fn, *args: get_hub().threadpool.apply(fn, args)
+
+    if "eventlet.patcher" in sys.modules:
+        from eventlet import patcher, tpool
+
+        if patcher.is_monkey_patched("socket"):
+            return tpool.execute
+
+    return None
+
+
+def _run(fn, *args):
+    global _in_use, _waiting
+
+    with _lock:
+        _waiting += 1
+
+    with _slots:
+        with _lock:
+            _waiting -= 1
+            _in_use += 1
+        try:
+            runner = _cooperative_runner()
+            return runner(fn, *args) if runner else fn(*args)
+        finally:
+            with _lock:
+                _in_use -= 1
+
+
+def pool_usage():
+    """Return (hashes running, hashes waiting, max concurrent hashes)."""
+
+    return _in_use, _waiting, MAX_CONCURRENT_HASHES
+
+
+def hash_password(password):
+    """Return a bcrypt hash of `password` as a string."""
+
+    return _run(bcrypt.generate_password_hash, password).decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return _run(bcrypt.check_password_hash, hashed, password)
@@ -0,0 +1,384 @@
+"""On-demand request profiling.
+
+A request is profiled when it carries a valid signed X-Warbler-Profile
+header, or at random for PROFILER_SAMPLE_RATE of traffic, as long as
+PROFILER_ENABLED is set. Get a token (valid for an hour) with:
+
+    python profiler.py
+
+Each profile records cProfile stats, a sampled call stack every few ms
+(for flame graphs) and every SQL statement run with its timing. The last
+PROFILER_MAX_PROFILES profiles are kept in memory, per worker, and can be
+listed and downloaded with the same token:
+
+    GET /_profiler/                   list of profiles (JSON)
+    GET /_profiler/<id>               one profile with its SQL (JSON)
+    GET /_profiler/<id>.pstats        for pstats, snakeviz, etc.
+    GET /_profiler/<id>.folded        for flamegraph.pl, speedscope, etc.
+
+Both cProfile and the stack sampler watch an OS thread, and in a gevent
+worker every request's greenlet shares one. So there, a greenlet trace
+function pauses a request's profile whenever its greenlet switches out
+and resumes it when it switches back, and the sampler runs in a real OS
+thread, only sampling while the profiled greenlet is running. Eventlet
+isn't supported: the profiler stays off under it.
+"""
+
+import _thread
+import cProfile
+import marshal
+import pstats
+import random
+import sys
+import time
+import uuid
+from collections import Counter, deque
+
+from flask import (
+    Blueprint, Response, abort, current_app, g, has_app_context, jsonify,
+    request)
+from itsdangerous import BadSignature, TimestampSigner
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+HEADER = "X-Warbler-Profile"
+TOKEN_MAX_AGE = 60 * 60
+SAMPLE_INTERVAL = 0.005
+
+profiler = Blueprint("profiler", __name__, url_prefix="/_profiler")
+
+
+def _signer(app):
+    return TimestampSigner(app.config["SECRET_KEY"], salt="profiler")
+
+
+def make_token(app):
+    """Return a token that turns on profiling for an hour."""
+
+    return _signer(app).sign("profile").decode()
+
+
+def gevent_patched():
+    """Has gevent monkey-patched threading in this process?"""
+
+    gevent_monkey = sys.modules.get("gevent.monkey")
+    return bool(gevent_monkey
+                and gevent_monkey.is_module_patched("threading"))
+
+
+def eventlet_patched():
+    """Has eventlet monkey-patched threading in this process?"""
+
+    eventlet_patcher = sys.modules.get("eventlet.patcher")
+    return bool(eventlet_patcher
+                and eventlet_patcher.is_monkey_patched("thread"))
+
+
+def is_enabled():
+    """Is profiling turned on, and able to run in this worker?"""
+
+    return current_app.config["PROFILER_ENABLED"] and not eventlet_patched()
+
+
+def native_thread():
+    """(start_new_thread, get_ident, allocate_lock, sleep) for real OS
+    threads, even once gevent has patched them to be greenlets."""
+
+    if gevent_patched():
+        from gevent.monkey import get_original
+        return (*get_original("_thread", ["start_new_thread", "get_ident",
+                                          "allocate_lock"]),
+                get_original("time", "sleep"))
+
+    return (_thread.start_new_thread, _thread.get_ident,
+            _thread.allocate_lock, time.sleep)
+
+
+def has_valid_token():
+    """Does this request carry a valid profiler token (header or ?token=)?"""
+
+    token = request.headers.get(HEADER) or request.args.get("token")
+    if not token:
+        return False
+
+    try:
+        _signer(current_app).unsign(token, max_age=TOKEN_MAX_AGE)
+    except BadSignature:
+        return False
+
+    return True
+
+
+class StackSampler:
+    """Samples one thread's call stack on a timer, for flame graphs.
+
+    Only samples while `running`, which a gevent worker turns off while
+    the profiled request's greenlet is switched out.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        start_new_thread, get_ident, allocate_lock, sleep = native_thread()
+        # The thread being sampled: this one.
+        self.thread_id = get_ident()
+        self._start_new_thread = start_new_thread
+        self._sleep = sleep
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = True
+        self._stopped = False
+        self._lock = allocate_lock()
+
+    def start(self):
+        self._start_new_thread(self._run, ())
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+
+    def _run(self):
+        while True:
+            self._sleep(self.interval)
+            with self._lock:
+                if self._stopped:
+                    return
+                if self.running:
+                    self._sample()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:"
+                         f"{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        """Stacks in Brendan Gregg's folded format, one per line."""
+
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self.stacks.most_common())
+
+
+# Greenlet: (profile, sampler) for the request it's serving, in a gevent
+# worker. Only one greenlet runs at a time, so only one is enabled.
+profiled_greenlets = {}
+_previous_tracer = None
+_tracing = False
+
+
+def _switch_profiles(event, args):
+    """greenlet trace function: a request's profile only runs while its
+    greenlet does."""
+
+    if event in ("switch", "throw"):
+        origin, target = args
+        if origin in profiled_greenlets:
+            profile, sampler = profiled_greenlets[origin]
+            profile.disable()
+            sampler.running = False
+        if target in profiled_greenlets:
+            profile, sampler = profiled_greenlets[target]
+            sampler.running = True
+            profile.enable()
+
+    if _previous_tracer is not None:
+        _previous_tracer(event, args)
+
+
+def follow_greenlet(profile, sampler):
+    """Pause `profile` and `sampler` whenever this greenlet switches out."""
+
+    global _previous_tracer, _tracing
+    import greenlet
+
+    if not _tracing:
+        _previous_tracer = greenlet.settrace(_switch_profiles)
+        _tracing = True
+    profiled_greenlets[greenlet.getcurrent()] = (profile, sampler)
+
+
+def unfollow_greenlet():
+    import greenlet
+
+    profiled_greenlets.pop(greenlet.getcurrent(), None)
+
+
+def start_profile():
+    """Start profiling this request if it asked to be or was sampled."""
+
+    config = current_app.config
+    if not is_enabled() or request.blueprint == "profiler":
+        return
+
+    if not (has_valid_token()
+            or random.random() < config["PROFILER_SAMPLE_RATE"]):
+        return
+
+    g.profile_queries = []
+    g.profile_sampler = StackSampler()
+    g.profile = cProfile.Profile()
+    g.profile_start = time.perf_counter()
+
+    if gevent_patched():
+        follow_greenlet(g.profile, g.profile_sampler)
+    g.profile_sampler.start()
+    g.profile.enable()
+
+
+def stop_profile():
+    """Stop this request's profile; returns (profile, sampler) or None."""
+
+    profile = g.pop("profile", None)
+    if profile is None:
+        return None
+
+    profile.disable()
+    sampler = g.pop("profile_sampler")
+    sampler.stop()
+    if gevent_patched():
+        unfollow_greenlet()
+    return profile, sampler
+
+
+def finish_profile(response):
+    """Stop profiling this request and keep the results."""
+
+    stopped = stop_profile()
+    if stopped is None:
+        return response
+
+    profile, sampler = stopped
+    duration_ms = (time.perf_counter() - g.profile_start) * 1000
+
+    stats = pstats.Stats(profile)
+
+    current_app.extensions["profiles"].append(dict(
+        id=uuid.uuid4().hex[:12],
+        time=time.time(),
+        method=request.method,
+        path=request.path,
+        endpoint=request.endpoint,
+        status=response.status_code,
+        duration_ms=round(duration_ms, 2),
+        queries=g.pop("profile_queries"),
+        pstats=marshal.dumps(stats.stats),
+        folded=sampler.folded(),
+    ))
+
+    return response
+
+
+def stop_profile_on_error(exc):
+    """Make sure a request that errored doesn't leave its profiler on."""
+
+    stop_profile()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, params, context, many):
+    if has_app_context() and "profile_queries" in g:
+        conn.info.setdefault("profile_query_start", []).append(
+            time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, params, context, many):
+    starts = conn.info.get("profile_query_start")
+    if starts and has_app_context() and "profile_queries" in g:
+        g.profile_queries.append(dict(
+            sql=statement,
+            duration_ms=round((time.perf_counter() - starts.pop()) * 1000, 3),
+        ))
+
+
+def summary(profile):
+    """A profile without its bulky stats, for listing."""
+
+    return dict(
+        {key: value for key, value in profile.items()
+         if key not in ("pstats", "folded", "queries")},
+        query_count=len(profile["queries"]),
+        query_ms=round(sum(q["duration_ms"] for q in profile["queries"]), 3),
+    )
+
+
+def get_profile(profile_id):
+    for profile in current_app.extensions["profiles"]:
+        if profile["id"] == profile_id:
+            return profile
+    abort(404)
+
+
+@profiler.before_request
+def require_token():
+    """Hide the profiler unless it's on and the request has a token."""
+
+    if not is_enabled() or not has_valid_token():
+        abort(404)
+
+
+@profiler.get("/")
+def list_profiles():
+    """List stored profiles, newest first."""
+
+    profiles = reversed(current_app.extensions["profiles"])
+    return jsonify([summary(profile) for profile in profiles])
+
+
+@profiler.get("/<profile_id>")
+def show_profile(profile_id):
+    """Show one profile, with its SQL statements."""
+
+    profile = get_profile(profile_id)
+    return jsonify(dict(summary(profile), queries=profile["queries"]))
+
+
+@profiler.get("/<profile_id>.pstats")
+def download_pstats(profile_id):
+    """Download cProfile stats, loadable with pstats.Stats(filename)."""
+
+    return Response(
+        get_profile(profile_id)["pstats"],
+        mimetype="application/octet-stream",
+        headers={"Content-Disposition":
+                 f"attachment; filename={profile_id}.pstats"})
+
+
+@profiler.get("/<profile_id>.folded")
+def download_folded(profile_id):
+    """Download sampled stacks in folded format for flame graph tools."""
+
+    return Response(
+        get_profile(profile_id)["folded"],
+        mimetype="text/plain",
+        headers={"Content-Disposition":
+                 f"attachment; filename={profile_id}.folded"})
+
+
+def init_app(app):
+    """Set up request profiling hooks and routes on `app`."""
+
+    app.config.setdefault("PROFILER_ENABLED", False)
+    app.config.setdefault("PROFILER_SAMPLE_RATE", 0.0)
+    app.config.setdefault("PROFILER_MAX_PROFILES", 50)
+
+    if app.config["PROFILER_ENABLED"] and eventlet_patched():
+        app.logger.warning(
+            "Profiler disabled: it can't tell eventlet's requests apart")
+
+    app.extensions["profiles"] = deque(
+        maxlen=app.config["PROFILER_MAX_PROFILES"])
+
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(stop_profile_on_error)
+    app.register_blueprint(profiler)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    print(f"{HEADER}: {make_token(app)}")
@@ -0,0 +1,203 @@
+"""Publish/subscribe for pushing events to open connections.
+
+Two backends, picked with PUBSUB_BACKEND:
+
+    local     (default) in-process queues; only reaches subscribers in
+              the same worker, so fine for development or one worker
+    postgres  Postgres LISTEN/NOTIFY; reaches every worker on every
+              host. Each worker keeps one extra connection to listen on.
+
+Messages are JSON-able dicts. Each subscription has a bounded queue; if
+a subscriber falls that far behind, new messages are dropped for it
+rather than let it use up memory.
+"""
+
+import json
+import queue
+import re
+import select
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import func, select as sql_select
+
+from models import db
+
+SUBSCRIPTION_QUEUE_SIZE = 100
+
+# Postgres waits for notifications this long before checking it's alive.
+LISTEN_TIMEOUT = 5
+
+CHANNEL_RE = re.compile(r"[a-z_][a-z0-9_]*")
+
+
+class Subscription:
+    """A subscriber's queue of messages on one channel."""
+
+    def __init__(self, pubsub, channel, maxsize=SUBSCRIPTION_QUEUE_SIZE):
+        self.pubsub = pubsub
+        self.channel = channel
+        self.queue = queue.Queue(maxsize)
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            pass
+
+    def get(self, timeout=None):
+        """Next message, or None if none came within `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.pubsub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LocalPubSub:
+    """Pub/sub between threads (or greenlets) of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions[subscription.channel].discard(subscription)
+
+    def publish(self, channel, message):
+        self.deliver(channel, message)
+
+    def deliver(self, channel, message):
+        """Hand `message` to this process's subscribers to `channel`."""
+
+        with self._lock:
+            subscriptions = list(self._subscriptions[channel])
+        for subscription in subscriptions:
+            subscription.put(message)
+
+
+class PostgresPubSub(LocalPubSub):
+    """Pub/sub across processes with Postgres LISTEN/NOTIFY.
+
+    Published messages go out with NOTIFY. A listener thread, started by
+    the first subscription, LISTENs on its own connection and fans
+    notifications out to this process's subscribers.
+    """
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+        self._channels = set()
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._listener = None
+
+    def _engine(self):
+        return db.get_engine(self.app)
+
+    def publish(self, channel, message):
+        with self._engine().connect().execution_options(
+                isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(sql_select(
+                func.pg_notify(channel, json.dumps(message))))
+
+    def subscribe(self, channel):
+        if not CHANNEL_RE.fullmatch(channel):
+            raise ValueError(f"Bad channel name: {channel!r}")
+
+        subscription = super().subscribe(channel)
+
+        with self._conn_lock:
+            if self._listener is None:
+                self._connect()
+                self._listener = threading.Thread(
+                    target=self._listen, name="pubsub", daemon=True)
+                self._listener.start()
+
+            if channel not in self._channels:
+                self._channels.add(channel)
+                self._execute(f"LISTEN {channel}")
+
+        return subscription
+
+    def _connect(self):
+        """Open the listening connection, outside the pool, and LISTEN
+        on every channel. Call with _conn_lock held."""
+
+        engine = self._engine()
+        dialect = engine.dialect
+        args, kwargs = dialect.create_connect_args(engine.url)
+        self._conn = dialect.connect(*args, **kwargs)
+        self._conn.autocommit = True
+
+        for channel in self._channels:
+            self._execute(f"LISTEN {channel}")
+
+    def _execute(self, sql):
+        with self._conn.cursor() as cursor:
+            cursor.execute(sql)
+
+    def _listen(self):
+        while True:
+            try:
+                ready, _, _ = select.select([self._conn], [], [],
+                                            LISTEN_TIMEOUT)
+                with self._conn_lock:
+                    if ready:
+                        self._conn.poll()
+                    else:
+                        self._execute("SELECT 1")
+                    notifies = self._conn.notifies[:]
+                    del self._conn.notifies[:]
+
+            except Exception:
+                self.app.logger.exception("Lost pub/sub connection")
+                time.sleep(1)
+                with self._conn_lock:
+                    try:
+                        self._connect()
+                    except Exception:
+                        pass
+                continue
+
+            for notify in notifies:
+                self.deliver(notify.channel, json.loads(notify.payload))
+
+
+def get_pubsub():
+    return current_app.extensions["pubsub"]
+
+
+def publish(channel, message):
+    """Publish `message` (a JSON-able dict) to `channel`."""
+
+    get_pubsub().publish(channel, message)
+
+
+def init_app(app):
+    """Set up the pub/sub backend named by PUBSUB_BACKEND for `app`."""
+
+    app.config.setdefault("PUBSUB_BACKEND", "local")
+
+    if app.config["PUBSUB_BACKEND"] == "postgres":
+        app.extensions["pubsub"] = PostgresPubSub(app)
+    else:
+        app.extensions["pubsub"] = LocalPubSub()
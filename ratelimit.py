@@ -0,0 +1,297 @@
+"""Rate limiting and load shedding for expensive endpoints.
+
+Views opt in with the `limit` decorator. Each request to a limited view
+takes a token from a bucket for the client's IP and, when logged in, one
+for the user; an empty bucket gets a 429. Buckets refill continuously, so
+a limit of "10/minute" allows bursts of 10 and then one every 6 seconds.
+
+Limits are configured per view in app.config['RATELIMITS'], e.g.:
+
+    RATELIMITS = {"login": "10/minute", "list_users": "60/minute"}
+
+Limited views with no limit of their own get RATELIMIT_DEFAULT.
+
+Buckets live in this process by default (MemoryBackend). To share them
+across workers, set app.config['RATELIMIT_REDIS_URL'].
+
+Limited views are also shed with a 503 when this worker is overloaded:
+too many requests in flight, requests waiting too long in the router
+queue (X-Request-Start), or recent DB queries running slow.
+"""
+
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+DEFAULT_LIMITS = {
+    "login": "10/minute",
+    "signup": "5/minute",
+    "list_users": "60/minute",
+    "user_availability": "60/minute",
+}
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+# How quickly the DB latency average reacts to new queries (0-1).
+DB_LATENCY_SMOOTHING = 0.1
+
+# X-Request-Start values below this are epoch seconds, not milliseconds:
+# in milliseconds, it's early 1973.
+SECONDS_BEFORE = 1e11
+
+
+def parse_limit(limit):
+    """Parse "10/minute" into (capacity, seconds to refill fully)."""
+
+    count, period = limit.split("/")
+    return int(count), PERIODS[period.strip()]
+
+
+class MemoryBackend:
+    """Token buckets held in this process's memory."""
+
+    # Prune full buckets once this many keys are tracked.
+    MAX_KEYS = 10_000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, period, now=None):
+        """Take a token from `key`'s bucket.
+
+        Returns 0 if allowed, else seconds until a token is available.
+        """
+
+        now = time.monotonic() if now is None else now
+        rate = capacity / period
+
+        with self._lock:
+            tokens, last, _, _ = self._buckets.get(
+                key, (capacity, now, capacity, rate))
+            tokens = min(capacity, tokens + (now - last) * rate)
+
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, capacity, rate)
+                return (1 - tokens) / rate
+
+            self._buckets[key] = (tokens - 1, now, capacity, rate)
+
+            if len(self._buckets) > self.MAX_KEYS:
+                self._prune(now)
+
+        return 0
+
+    def _prune(self, now):
+        """Drop buckets that would have refilled by now; a full bucket is
+        the same as no bucket."""
+
+        full = [key for key, (tokens, last, capacity, rate)
+                in self._buckets.items()
+                if tokens + (now - last) * rate >= capacity]
+        for key in full:
+            del self._buckets[key]
+
+
+class RedisBackend:
+    """Token buckets shared by every worker through Redis.
+
+    Needs the redis package, which is only imported when configured.
+    """
+
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+    local tokens = tonumber(bucket[1]) or capacity
+    local last = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - last) * rate)
+    local wait = 0
+    if tokens < 1 then
+      wait = (1 - tokens) / rate
+    else
+      tokens = tokens - 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'last', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+    return tostring(wait)
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def consume(self, key, capacity, period, now=None):
+        now = time.time() if now is None else now
+        return float(self.script(keys=[f"ratelimit:{key}"],
+                                 args=[capacity, capacity / period, now]))
+
+
+class LoadMonitor:
+    """Tracks in-flight requests and recent DB latency for this worker."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.db_latency_ms = 0.0
+        self._lock = threading.Lock()
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record_query(self, duration_ms):
+        with self._lock:
+            self.db_latency_ms += (
+                DB_LATENCY_SMOOTHING * (duration_ms - self.db_latency_ms))
+
+
+def client_ip():
+    """The client's IP, trusting RATELIMIT_PROXY_COUNT proxies in front."""
+
+    proxies = current_app.config["RATELIMIT_PROXY_COUNT"]
+    route = request.access_route
+
+    if proxies and len(route) >= proxies:
+        return route[-proxies]
+
+    return request.remote_addr
+
+
+def queue_wait_ms():
+    """How long this request waited before reaching us, if the router
+    told us in X-Request-Start: Heroku sends epoch milliseconds, nginx
+    "t=" and epoch seconds with a fraction."""
+
+    start = request.headers.get("X-Request-Start", "").removeprefix("t=")
+    try:
+        start = float(start)
+    except ValueError:
+        return None
+
+    if start < SECONDS_BEFORE:
+        start *= 1000
+    return time.time() * 1000 - start
+
+
+def shed_load_if_overloaded():
+    """Raise 503 if this worker is too busy to take an expensive request."""
+
+    config = current_app.config
+    monitor = current_app.extensions["load_monitor"]
+    wait = queue_wait_ms()
+
+    if (monitor.in_flight > config["SHED_MAX_IN_FLIGHT"]
+            or (wait is not None and wait > config["SHED_QUEUE_WAIT_MS"])
+            or monitor.db_latency_ms > config["SHED_DB_LATENCY_MS"]):
+        raise ServiceUnavailable(
+            "Server is busy; please try again shortly.", retry_after=5)
+
+
+def check_limit(name):
+    """Raise 429 if this client has used up the limit for view `name`."""
+
+    config = current_app.config
+    capacity, period = parse_limit(
+        config["RATELIMITS"].get(name)
+        or DEFAULT_LIMITS.get(name)
+        or config["RATELIMIT_DEFAULT"])
+    backend = current_app.extensions["ratelimit"]
+
+    keys = [f"{name}:ip:{client_ip()}"]
+    if getattr(g, "user", None):
+        keys.append(f"{name}:user:{g.user.id}")
+
+    wait = max(backend.consume(key, capacity, period) for key in keys)
+    if wait:
+        raise TooManyRequests(
+            "Too many requests; please slow down.", retry_after=int(wait) + 1)
+
+
+def limit(methods=None, when=None):
+    """Decorate a view to rate limit it and shed it under load.
+
+    Only applies to requests using one of `methods` (default: all) and
+    for which `when()` is true (default: always).
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def limited_view(*args, **kwargs):
+            if ((methods is None or request.method in methods)
+                    and (when is None or when())
+                    and current_app.config["RATELIMIT_ENABLED"]):
+                shed_load_if_overloaded()
+                check_limit(view.__name__)
+
+            return view(*args, **kwargs)
+
+        return limited_view
+
+    return decorator
+
+
+# Load is tracked per process, whichever app is serving.
+monitor = LoadMonitor()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, params, context, many):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, params, context, many):
+    start = conn.info["query_start"].pop()
+    monitor.record_query((time.perf_counter() - start) * 1000)
+
+
+@event.listens_for(Engine, "handle_error")
+def discard_query_timer(context):
+    """A failed query never reaches after_cursor_execute; drop its start
+    time so the next query on this connection isn't timed from it."""
+
+    conn = context.connection
+    if context.execution_context is not None and conn is not None:
+        starts = conn.info.get("query_start")
+        if starts:
+            starts.pop()
+
+
+def init_app(app):
+    """Set up rate limit storage and load monitoring on `app`."""
+
+    app.config.setdefault("RATELIMIT_ENABLED", True)
+    app.config.setdefault("RATELIMITS", {})
+    app.config.setdefault("RATELIMIT_DEFAULT", "60/minute")
+    app.config.setdefault("RATELIMIT_PROXY_COUNT", 0)
+    app.config.setdefault("SHED_MAX_IN_FLIGHT", 32)
+    app.config.setdefault("SHED_QUEUE_WAIT_MS", 2000)
+    app.config.setdefault("SHED_DB_LATENCY_MS", 500)
+
+    if app.config.get("RATELIMIT_REDIS_URL"):
+        app.extensions["ratelimit"] = RedisBackend(
+            app.config["RATELIMIT_REDIS_URL"])
+    else:
+        app.extensions["ratelimit"] = MemoryBackend()
+
+    app.extensions["load_monitor"] = monitor
+
+    @app.before_request
+    def track_request_start():
+        monitor.request_started()
+
+    @app.teardown_request
+    def track_request_end(exc):
+        monitor.request_finished()
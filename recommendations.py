@@ -0,0 +1,206 @@
+"""Who-to-follow recommendations computed over the follow graph.
+
+This is a batch job; run it periodically (e.g. from Heroku Scheduler):
+
+    python recommendations.py
+
+or benchmark it on a generated graph:
+
+    python recommendations.py --benchmark 1000000
+
+The follow graph is loaded into a sparse adjacency matrix A, where
+A[u, v] = 1 if u follows v. For each user u, a candidate c scores:
+
+    (A @ A)[u, c]                    people u follows who follow c
+    + MUTUAL_WEIGHT * A.T[u, c]      c already follows u
+
+Users u already follows (and u themself) are never recommended. Rows are
+processed in chunks sized by how many nonzeros (A @ A) will have, so peak
+memory stays bounded no matter how big the graph is.
+"""
+
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+
+TOP_K = 10
+MUTUAL_WEIGHT = 2.0
+
+# Upper bound on nonzeros in one chunk's product; ~12 bytes each.
+MAX_CHUNK_NNZ = 4_000_000
+
+EDGE_BATCH_SIZE = 50_000
+
+
+def build_graph(followers, followed):
+    """Build (A, user_ids) from parallel arrays of follower/followed ids.
+
+    `user_ids[i]` is the real user id of row/column i of A.
+    """
+
+    user_ids, idx = np.unique(
+        np.concatenate([followers, followed]), return_inverse=True)
+    n_edges = len(followers)
+    rows, cols = idx[:n_edges], idx[n_edges:]
+
+    A = sparse.csr_matrix(
+        (np.ones(n_edges, dtype=np.float32), (rows, cols)),
+        shape=(len(user_ids), len(user_ids)))
+    A.sum_duplicates()
+    A.data[:] = 1
+
+    return A, user_ids
+
+
+def chunk_bounds(A, max_nnz=MAX_CHUNK_NNZ):
+    """Yield (start, end) row ranges whose (A @ A) is at most ~max_nnz."""
+
+    out_degree = np.diff(A.indptr)
+    # Upper bound on nonzeros of (A @ A)[u]: sum of u's followees' degrees.
+    work = A @ out_degree.astype(np.float64)
+
+    start = 0
+    total = 0
+    for row, row_work in enumerate(work):
+        if total and total + row_work > max_nnz:
+            yield start, row
+            start, total = row, 0
+        total += row_work
+
+    if start < A.shape[0]:
+        yield start, A.shape[0]
+
+
+def compute_recommendations(A, top_k=TOP_K, mutual_weight=MUTUAL_WEIGHT,
+                            max_nnz=MAX_CHUNK_NNZ):
+    """Yield (row, candidate rows, scores) for each row of A with any
+    candidates, best first."""
+
+    AT = A.T.tocsr()
+
+    for start, end in chunk_bounds(A, max_nnz):
+        chunk = A[start:end]
+        scores = (chunk @ A + mutual_weight * AT[start:end]).tocsr()
+
+        for i in range(end - start):
+            row = start + i
+            lo, hi = scores.indptr[i], scores.indptr[i + 1]
+            candidates = scores.indices[lo:hi]
+            row_scores = scores.data[lo:hi]
+
+            followed = chunk.indices[chunk.indptr[i]:chunk.indptr[i + 1]]
+            keep = (candidates != row) & ~np.isin(candidates, followed)
+            candidates, row_scores = candidates[keep], row_scores[keep]
+
+            if not len(candidates):
+                continue
+
+            if len(candidates) > top_k:
+                best = np.argpartition(-row_scores, top_k)[:top_k]
+                candidates, row_scores = candidates[best], row_scores[best]
+
+            order = np.argsort(-row_scores, kind="stable")
+            yield row, candidates[order], row_scores[order]
+
+
+def load_edges():
+    """Stream the follows table into (followers, followed) arrays."""
+
+    from models import db, Follows
+
+    followers, followed = [], []
+    query = (db.session
+             .query(Follows.user_following_id, Follows.user_being_followed_id)
+             .yield_per(EDGE_BATCH_SIZE))
+
+    batch = []
+    for edge in query:
+        batch.append(edge)
+        if len(batch) == EDGE_BATCH_SIZE:
+            arr = np.array(batch, dtype=np.int64)
+            followers.append(arr[:, 0])
+            followed.append(arr[:, 1])
+            batch = []
+
+    if batch:
+        arr = np.array(batch, dtype=np.int64)
+        followers.append(arr[:, 0])
+        followed.append(arr[:, 1])
+
+    if not followers:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    return np.concatenate(followers), np.concatenate(followed)
+
+
+def refresh_recommendations():
+    """Recompute every user's recommendations and replace the stored ones.
+
+    Runs in one transaction, so readers see either the old or new set.
+    Returns the number of recommendations stored.
+    """
+
+    from models import db, Recommendation
+
+    A, user_ids = build_graph(*load_edges())
+
+    Recommendation.query.delete()
+
+    stored = 0
+    batch = []
+    for row, candidates, scores in compute_recommendations(A):
+        user_id = int(user_ids[row])
+        for rank, (candidate, score) in enumerate(zip(candidates, scores)):
+            batch.append(dict(
+                user_id=user_id,
+                recommended_user_id=int(user_ids[candidate]),
+                score=float(score),
+                rank=rank,
+            ))
+
+        if len(batch) >= EDGE_BATCH_SIZE:
+            db.session.bulk_insert_mappings(Recommendation, batch)
+            stored += len(batch)
+            batch = []
+
+    db.session.bulk_insert_mappings(Recommendation, batch)
+    stored += len(batch)
+    db.session.commit()
+
+    return stored
+
+
+def benchmark(n_edges, n_users=None):
+    """Time compute_recommendations on a random graph of `n_edges` follows."""
+
+    import resource
+
+    n_users = n_users or max(n_edges // 20, 10)
+    rng = np.random.default_rng(0)
+    followers = rng.integers(0, n_users, n_edges)
+    # Skew followed users so a few are very popular, like real graphs.
+    followed = (rng.pareto(1.5, n_edges) * n_users / 20).astype(np.int64)
+    followed %= n_users
+
+    start = time.perf_counter()
+    A, _ = build_graph(followers, followed)
+    count = sum(1 for _ in compute_recommendations(A))
+    elapsed = time.perf_counter() - start
+
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{n_edges} edges, {n_users} users: "
+          f"{count} users recommended in {elapsed:.1f}s, "
+          f"max RSS {max_rss_mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--benchmark":
+        benchmark(int(sys.argv[2]))
+
+    else:
+        from app import app
+
+        with app.app_context():
+            print(f"Stored {refresh_recommendations()} recommendations.")
@@ -0,0 +1,513 @@
+"""Optional horizontal sharding of user-owned data.
+
+With SHARDS set to a list of database URLs, each user's messages, likes
+and follows are also kept on the shard picked by their user id (the
+author's for messages, the liker's for likes, the follower's for
+follows). The homepage is then read from the shards: who the user
+follows and which messages they've liked come from their own shard, and
+the timeline from every shard holding some of the followed users, asked
+in parallel for their newest messages and merged by timestamp.
+
+This is only the first step of moving to shards, and on its own it makes
+the main database busier, not less: everything is still written there
+first (then to the owning shards, after each commit), and every page but
+the homepage still reads it. The cutover from here:
+
+1. Dual-write, backfill, and serve the homepage from the shards (now).
+2. Move the remaining reads of messages, likes and follows (profiles,
+   trending, tags, exports, archives) to the shards.
+3. Stop writing those tables to the main database; the shards become
+   the only copy and the main database keeps users.
+
+A failed shard write is logged, and leaves the shard behind until the
+next backfill:
+
+    python sharding.py backfill     copy everything from the main DB
+    python sharding.py status       rows on each shard
+
+A backfill never empties the shards: it adds missing rows, skipping ones
+already there, then deletes rows the main database no longer has (or
+that belong on another shard). While it runs, the homepage is read from
+the main database.
+
+Any SQLAlchemy URL will do for a shard, so a few SQLite files can stand
+in for them locally:
+
+    SHARD_DATABASE_URLS=sqlite:////tmp/shard0.db,sqlite:////tmp/shard1.db
+"""
+
+import heapq
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from types import SimpleNamespace
+
+from flask import current_app
+from sqlalchemy import (
+    Column, DateTime, Index, Integer, MetaData, String, Table,
+    create_engine, delete, func, insert, select, tuple_)
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, User, Message, Like, Follows
+
+BATCH_SIZE = 1_000
+
+metadata = MetaData()
+
+# The main database's tables, without foreign keys to users (who stay
+# in the main database).
+messages = Table(
+    "messages", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("text", String(140), nullable=False),
+    Column("timestamp", DateTime, nullable=False),
+    Column("user_id", Integer, nullable=False),
+    Index("ix_messages_user_timestamp", "user_id", "timestamp"),
+)
+
+likes = Table(
+    "likes", metadata,
+    Column("user_id", Integer, primary_key=True),
+    Column("message_id", Integer, primary_key=True),
+    Column("timestamp", DateTime, nullable=False),
+)
+
+follows = Table(
+    "follows", metadata,
+    Column("user_following_id", Integer, primary_key=True),
+    Column("user_being_followed_id", Integer, primary_key=True),
+)
+
+# A row on the first shard while a backfill is running.
+backfills = Table(
+    "backfills", metadata,
+    Column("started_at", DateTime, nullable=False),
+)
+
+# Each table's key columns, the column that picks its shard, and the main
+# database's model columns they match.
+KEYS = {
+    messages: ((messages.c.id,), messages.c.user_id, (Message.id,)),
+    likes: ((likes.c.user_id, likes.c.message_id), likes.c.user_id,
+            (Like.user_id, Like.message_id)),
+    follows: ((follows.c.user_following_id, follows.c.user_being_followed_id),
+              follows.c.user_following_id,
+              (Follows.user_following_id, Follows.user_being_followed_id)),
+}
+
+
+class Shards:
+    """An engine per shard, and threads to query them all at once."""
+
+    def __init__(self, urls, check_every=5):
+        self.engines = [create_engine(url, pool_pre_ping=True)
+                        for url in urls]
+        self.executor = ThreadPoolExecutor(
+            max_workers=len(self.engines), thread_name_prefix="shards")
+        self.check_every = check_every
+        self._backfilling = True
+        self._checked_at = float("-inf")
+
+    def __len__(self):
+        return len(self.engines)
+
+    def index_for(self, user_id):
+        return user_id % len(self.engines)
+
+    def for_user(self, user_id):
+        """The engine for the shard that owns `user_id`'s data."""
+
+        return self.engines[self.index_for(user_id)]
+
+    def create_all(self):
+        for engine in self.engines:
+            metadata.create_all(engine)
+
+    def backfilling(self):
+        """Is a backfill running? Checked at most every `check_every`
+        seconds; until first checked, or if the check fails, assume so."""
+
+        if time.monotonic() - self._checked_at < self.check_every:
+            return self._backfilling
+
+        try:
+            with self.engines[0].connect() as conn:
+                self._backfilling = conn.execute(
+                    select(func.count()).select_from(backfills)).scalar() > 0
+        except Exception:
+            current_app.logger.exception("Couldn't check for a backfill")
+            self._backfilling = True
+
+        self._checked_at = time.monotonic()
+        return self._backfilling
+
+
+def get_shards():
+    """The app's Shards, or None if it isn't sharded."""
+
+    return current_app.extensions["shards"]
+
+
+def serving():
+    """Should reads that can come from the shards do so right now?"""
+
+    shards = get_shards()
+    return shards is not None and not shards.backfilling()
+
+
+def _write(description, write):
+    """Run `write(shards)`, if sharded, logging rather than raising on
+    failure: the main database already has the change."""
+
+    shards = get_shards()
+    if shards is None:
+        return
+
+    try:
+        write(shards)
+    except Exception:
+        current_app.logger.exception(
+            "Couldn't %s on the shards; they're behind until the next "
+            "backfill", description)
+
+
+def _batches(items, size=BATCH_SIZE):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+##############################################################################
+# Writes, after the main database has committed them.
+
+
+def message_posted(message):
+    def write(shards):
+        with shards.for_user(message.user_id).begin() as conn:
+            # A running backfill may have copied it already.
+            _insert_ignoring_conflicts(conn, messages, [dict(
+                id=message.id, text=message.text,
+                timestamp=message.timestamp, user_id=message.user_id)])
+
+    _write("add a message", write)
+
+
+def message_deleted(message_id, user_id):
+    def write(shards):
+        with shards.for_user(user_id).begin() as conn:
+            conn.execute(delete(messages).where(messages.c.id == message_id))
+
+        # Its likes are on the likers' shards, which could be any.
+        for engine in shards.engines:
+            with engine.begin() as conn:
+                conn.execute(
+                    delete(likes).where(likes.c.message_id == message_id))
+
+    _write("delete a message", write)
+
+
+@contextmanager
+def _locked(key):
+    """Hold a main database lock on `key` (as the event log keys it),
+    in a transaction of its own.
+
+    A follow or like is copied to its shard as the main database has it
+    once committed, holding this while reading it and writing the shard,
+    so the last copy made is of the latest state, whatever order
+    concurrent toggles got here in.
+    """
+
+    db.session.execute(select(func.pg_advisory_xact_lock(func.hashtext(key))))
+    try:
+        yield
+    finally:
+        db.session.rollback()
+
+
+def follow_changed(follower_id, followed_id):
+    """Copy whether `follower_id` follows `followed_id` to their shard."""
+
+    def write(shards):
+        key = ((follows.c.user_following_id == follower_id)
+               & (follows.c.user_being_followed_id == followed_id))
+        with _locked(f"follow:{follower_id}:{followed_id}"):
+            following = Follows.query.filter_by(
+                user_following_id=follower_id,
+                user_being_followed_id=followed_id).first()
+            with shards.for_user(follower_id).begin() as conn:
+                conn.execute(delete(follows).where(key))
+                if following is not None:
+                    conn.execute(insert(follows), dict(
+                        user_following_id=follower_id,
+                        user_being_followed_id=followed_id))
+
+    _write("update a follow", write)
+
+
+def like_changed(user_id, message_id):
+    """Copy whether `user_id` likes `message_id` to their shard."""
+
+    def write(shards):
+        key = ((likes.c.user_id == user_id)
+               & (likes.c.message_id == message_id))
+        with _locked(f"like:{user_id}:{message_id}"):
+            like = Like.query.filter_by(
+                user_id=user_id, message_id=message_id).first()
+            with shards.for_user(user_id).begin() as conn:
+                conn.execute(delete(likes).where(key))
+                if like is not None:
+                    conn.execute(insert(likes), dict(
+                        user_id=user_id, message_id=message_id,
+                        timestamp=like.timestamp))
+
+    _write("update a like", write)
+
+
+def user_deleted(user_id):
+    """Remove a deleted user's data, and others' follows and likes of it."""
+
+    def write(shards):
+        with shards.for_user(user_id).begin() as conn:
+            message_ids = conn.execute(
+                select(messages.c.id).where(messages.c.user_id == user_id)
+            ).scalars().all()
+            conn.execute(delete(messages).where(messages.c.user_id == user_id))
+            conn.execute(delete(likes).where(likes.c.user_id == user_id))
+            conn.execute(delete(follows).where(
+                follows.c.user_following_id == user_id))
+
+        for engine in shards.engines:
+            with engine.begin() as conn:
+                conn.execute(delete(follows).where(
+                    follows.c.user_being_followed_id == user_id))
+                for batch in _batches(message_ids):
+                    conn.execute(delete(likes).where(
+                        likes.c.message_id.in_(batch)))
+
+    _write("delete a user", write)
+
+
+##############################################################################
+# Reads
+
+
+def _newest(engine, user_ids, limit):
+    """One shard's newest `limit` messages by `user_ids`, newest first."""
+
+    with engine.connect() as conn:
+        return conn.execute(
+            select(messages)
+            .where(messages.c.user_id.in_(user_ids))
+            .order_by(messages.c.timestamp.desc())
+            .limit(limit)
+        ).all()
+
+
+def following_ids(user_id):
+    """Ids of everyone `user_id` follows, from their shard."""
+
+    with get_shards().for_user(user_id).connect() as conn:
+        return set(conn.execute(
+            select(follows.c.user_being_followed_id)
+            .where(follows.c.user_following_id == user_id)
+        ).scalars())
+
+
+def liked_among(user_id, message_ids):
+    """Which of `message_ids` has `user_id` liked? From their shard."""
+
+    if not message_ids:
+        return set()
+
+    with get_shards().for_user(user_id).connect() as conn:
+        return set(conn.execute(
+            select(likes.c.message_id)
+            .where(likes.c.user_id == user_id,
+                   likes.c.message_id.in_(message_ids))
+        ).scalars())
+
+
+def timeline(user_ids, limit=100):
+    """The newest `limit` messages by any of `user_ids`, gathered from
+    their shards in parallel. Rows of (id, text, timestamp, user_id)."""
+
+    shards = get_shards()
+
+    by_shard = defaultdict(list)
+    for user_id in user_ids:
+        by_shard[shards.index_for(user_id)].append(user_id)
+
+    futures = [shards.executor.submit(_newest, shards.engines[n], ids, limit)
+               for n, ids in by_shard.items()]
+    newest_first = [future.result() for future in futures]
+
+    # Each shard's rows are newest first; merge them into one list.
+    merged = heapq.merge(*newest_first,
+                         key=lambda row: row.timestamp, reverse=True)
+    return list(islice(merged, limit))
+
+
+def timeline_messages(user_ids, limit=100):
+    """Like Message.timeline, from the shards: messages with their
+    `user`s (loaded from the main database) attached."""
+
+    rows = timeline(user_ids, limit)
+    authors = {user.id: user
+               for user in User.query.filter(
+                   User.id.in_({row.user_id for row in rows}))}
+
+    return [SimpleNamespace(**row._asdict(), user=authors[row.user_id])
+            for row in rows
+            if row.user_id in authors]
+
+
+##############################################################################
+# Maintenance
+
+
+def _insert_ignoring_conflicts(conn, table, rows):
+    """Insert `rows`, skipping any whose key is already there."""
+
+    dialect = {"postgresql": postgresql, "sqlite": sqlite}[conn.dialect.name]
+    conn.execute(dialect.insert(table).on_conflict_do_nothing(), rows)
+
+
+def _copy(shards, table, query):
+    """Add the main database's rows from `query` to their shards,
+    leaving rows that are already there. Returns how many were read."""
+
+    _, owner, _ = KEYS[table]
+    per_shard = defaultdict(list)
+    count = 0
+
+    def flush(n):
+        with shards.engines[n].begin() as conn:
+            _insert_ignoring_conflicts(conn, table, per_shard.pop(n))
+
+    for row in query.yield_per(10_000):
+        n = shards.index_for(getattr(row, owner.name))
+        per_shard[n].append(row._asdict())
+        count += 1
+        if len(per_shard[n]) >= BATCH_SIZE:
+            flush(n)
+
+    for n in list(per_shard):
+        flush(n)
+    return count
+
+
+def _prune(shards, table):
+    """Delete shard rows the main database doesn't have, or that belong
+    on another shard.
+
+    Run after copying: a row deleted while the copy ran may have been
+    copied back after its shard delete. Rows only reach a shard after
+    the main database commits them, so nothing new is lost.
+    """
+
+    key, owner, main_key = KEYS[table]
+
+    for n, engine in enumerate(shards.engines):
+        last = None
+        while True:
+            query = select(*key, owner).order_by(*key).limit(BATCH_SIZE)
+            if last is not None:
+                query = query.where(tuple_(*key) > last)
+            with engine.connect() as conn:
+                batch = [(tuple(row)[:-1], row[-1])
+                         for row in conn.execute(query)]
+            if not batch:
+                break
+            last = batch[-1][0]
+
+            in_main = set(
+                db.session.query(*main_key)
+                .filter(tuple_(*main_key).in_([keys for keys, _ in batch])))
+            db.session.commit()
+
+            gone = [keys for keys, owner_id in batch
+                    if keys not in in_main
+                    or shards.index_for(owner_id) != n]
+            if gone:
+                with engine.begin() as conn:
+                    conn.execute(delete(table).where(tuple_(*key).in_(gone)))
+
+
+def backfill():
+    """Bring the shards up to date with the main database.
+
+    The homepage reads the main database until it's done. Returns the
+    number of (messages, likes, follows) in the main database.
+    """
+
+    shards = get_shards()
+    shards.create_all()
+
+    with shards.engines[0].begin() as conn:
+        conn.execute(insert(backfills), dict(started_at=datetime.utcnow()))
+
+    try:
+        # Let every worker notice before the shards start changing.
+        time.sleep(shards.check_every)
+
+        counts = (
+            _copy(shards, messages,
+                  db.session.query(Message.id, Message.text,
+                                   Message.timestamp, Message.user_id)),
+            _copy(shards, likes,
+                  db.session.query(Like.user_id, Like.message_id,
+                                   Like.timestamp)),
+            _copy(shards, follows,
+                  db.session.query(Follows.user_following_id,
+                                   Follows.user_being_followed_id)),
+        )
+        db.session.commit()
+
+        for table in (messages, likes, follows):
+            _prune(shards, table)
+
+    finally:
+        with shards.engines[0].begin() as conn:
+            conn.execute(delete(backfills))
+
+    return counts
+
+
+def status():
+    """Print how many rows of each table each shard has."""
+
+    for n, engine in enumerate(get_shards().engines):
+        with engine.connect() as conn:
+            counts = [conn.execute(select(func.count()).select_from(table))
+                      .scalar() for table in (messages, likes, follows)]
+        print(f"shard {n}  {engine.url!r}  messages {counts[0]}  "
+              f"likes {counts[1]}  follows {counts[2]}")
+
+
+def init_app(app):
+    """Connect `app` to the shards in SHARDS, if there are any."""
+
+    app.config.setdefault("SHARDS", [])
+    app.config.setdefault("SHARD_BACKFILL_CHECK_SECONDS", 5)
+
+    urls = app.config["SHARDS"]
+    app.extensions["shards"] = (
+        Shards(urls, app.config["SHARD_BACKFILL_CHECK_SECONDS"])
+        if urls else None)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        if get_shards() is None:
+            sys.exit("Set SHARD_DATABASE_URLS first.")
+
+        if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+            print("Copied %d messages, %d likes and %d follows." % backfill())
+        else:
+            status()
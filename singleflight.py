@@ -0,0 +1,301 @@
+"""Single-flight caching: one computation per key, however many ask.
+
+When many requests miss the cache for the same key at once (say, a
+profile that's just been linked from somewhere popular), the first one
+computes the value and the rest wait for it and share it, rather than
+each running the same queries.
+
+Values are fresh for SINGLEFLIGHT_TTL seconds. For SINGLEFLIGHT_STALE
+seconds after that they're still served as they are while one caller
+refreshes them, so a hot key doesn't make everyone wait each time it
+expires. Call invalidate() when a key's data changes.
+
+By default the cache is per worker. Set SINGLEFLIGHT_DIR to share it
+between the workers on a host: values are pickled to files there, and a
+key is only computed while holding an fcntl lock on its own lock file,
+so one worker on the host computes it. gunicorn.conf.py does this.
+
+Since anyone who can write to that directory could get their pickles
+loaded, it must be a directory only we can use: owned by us, mode 0700.
+Files for keys nobody has asked for since they expired are swept away
+every SINGLEFLIGHT_TTL + SINGLEFLIGHT_STALE seconds.
+
+Keys are tuples whose first item names the cache, for metrics:
+
+    profile = singleflight.cached(("profile", user_id), load)
+"""
+
+import fcntl
+import hashlib
+import os
+import pickle
+import stat
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+from metrics import record_cache
+
+# How often a worker waiting for another worker's lock checks it.
+FLOCK_POLL_SECONDS = 0.005
+
+
+class _Invalid:
+    """Stored by invalidate(), so a computation that started before then
+    can't store what it read."""
+
+    def __reduce__(self):
+        return "_INVALID"
+
+
+_INVALID = _Invalid()
+
+
+class SingleFlight:
+    """A soft-TTL cache whose misses are computed once per key."""
+
+    def __init__(self, ttl, stale, folder=None, max_entries=10_000):
+        self.ttl = ttl
+        self.stale = stale
+        self.folder = folder
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._entries = {}
+        self._next_sweep = time.monotonic() + ttl + stale
+
+    def get(self, key, compute):
+        """The value for `key`, calling compute() for it if needed."""
+
+        entry = self._load(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.time() - stored_at
+            if age < self.ttl:
+                record_cache(key[0], True)
+                return value
+
+            if age < self.ttl + self.stale:
+                # One caller refreshes it; the rest make do meanwhile.
+                with self._locked(key, blocking=False) as refresher:
+                    if refresher:
+                        record_cache(key[0], False)
+                        return self._compute(key, compute)
+                record_cache(key[0], True)
+                return value
+
+        record_cache(key[0], False)
+        with self._locked(key):
+            # Whoever held the lock before us probably just computed it.
+            entry = self._load(key)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                return entry[0]
+            return self._compute(key, compute)
+
+    def invalidate(self, key):
+        """Forget `key`, including anything being computed for it now."""
+
+        self._store(key, (_INVALID, time.time()), force=True)
+
+    def _compute(self, key, compute):
+        started_at = time.time()
+        value = compute()
+        self._store(key, (value, started_at))
+        return value
+
+    @contextmanager
+    def _locked(self, key, blocking=True):
+        """Hold `key`'s lock, in this worker and (if shared) on this host.
+
+        Yields whether we got it, which we always do if `blocking`.
+        """
+
+        with self._lock:
+            lock, holders = self._key_locks.get(key, (threading.Lock(), 0))
+            self._key_locks[key] = (lock, holders + 1)
+
+        try:
+            if not lock.acquire(blocking):
+                yield False
+                return
+            try:
+                if self.folder is None:
+                    yield True
+                    return
+                # Closing the file releases the flock.
+                with open(self._path(key, "lock"), "a") as lock_file:
+                    yield self._flock(lock_file, blocking)
+            finally:
+                lock.release()
+
+        finally:
+            with self._lock:
+                lock, holders = self._key_locks[key]
+                if holders == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (lock, holders - 1)
+
+    def _flock(self, lock_file, blocking):
+        # Polled rather than blocking, which would stall every greenlet
+        # of a gevent worker.
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if not blocking:
+                    return False
+                time.sleep(FLOCK_POLL_SECONDS)
+
+    def _path(self, key, suffix):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.folder, f"{digest}.{suffix}")
+
+    def _load(self, key):
+        """(value, stored_at) for `key`, or None if there's nothing usable."""
+
+        if self.folder is None:
+            entry = self._entries.get(key)
+        else:
+            try:
+                with open(self._path(key, "pickle"), "rb") as f:
+                    entry = pickle.load(f)
+            except (FileNotFoundError, EOFError):
+                entry = None
+
+        if entry is None or entry[0] is _INVALID:
+            return None
+        return entry
+
+    def _store(self, key, entry, force=False):
+        """Store `entry` unless `key` was invalidated since it was read."""
+
+        if self.folder is None:
+            with self._lock:
+                current = self._entries.pop(key, None)
+                if not force and current and current[1] > entry[1]:
+                    entry = current
+                self._entries[key] = entry
+                if len(self._entries) > self.max_entries:
+                    self._evict()
+            return
+
+        path = self._path(key, "pickle")
+        if not force:
+            try:
+                if os.path.getmtime(path) > entry[1]:
+                    return
+            except FileNotFoundError:
+                pass
+
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(temp, path)
+
+        if time.monotonic() > self._next_sweep:
+            self._next_sweep = time.monotonic() + self.ttl + self.stale
+            self._sweep()
+
+    def _sweep(self):
+        """Delete files for keys that have expired, from any worker.
+
+        Values (and temp files left by crashed workers) go once they're
+        too old to serve. Lock files go once their value has, and only if
+        no one holds them; someone who opened one just before it went
+        might compute its key again alongside someone else, which is
+        harmless.
+        """
+
+        expired_at = time.time() - self.ttl - self.stale
+        names = os.listdir(self.folder)
+
+        for name in names:
+            if name.endswith(".lock"):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                if os.path.getmtime(path) < expired_at:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        for name in names:
+            if not name.endswith(".lock"):
+                continue
+            path = os.path.join(self.folder, name)
+            if os.path.exists(path[:-len("lock")] + "pickle"):
+                continue
+            try:
+                with open(path, "a") as lock_file:
+                    if self._flock(lock_file, blocking=False):
+                        os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """Drop expired entries, then the oldest. Call with _lock held."""
+
+        expired_at = time.time() - self.ttl - self.stale
+        for key, (_, stored_at) in list(self._entries.items()):
+            if stored_at < expired_at:
+                del self._entries[key]
+
+        # Entries are (re)inserted as they're stored, so oldest first.
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+
+def check_private_folder(folder):
+    """Create `folder` if need be, and make sure only we can use it.
+
+    Raises RuntimeError if it's a symlink, someone else's, or open to
+    other users, since we'd be unpickling whatever they put there.
+    """
+
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    info = os.lstat(folder)
+
+    if (not stat.S_ISDIR(info.st_mode)
+            or info.st_uid != os.getuid()
+            or info.st_mode & 0o077):
+        raise RuntimeError(
+            f"SINGLEFLIGHT_DIR {folder} must be a directory owned by this "
+            "user with mode 0700")
+
+
+def get_cache():
+    return current_app.extensions["singleflight"]
+
+
+def cached(key, compute):
+    """compute(), at most once per key per SINGLEFLIGHT_TTL."""
+
+    return get_cache().get(key, compute)
+
+
+def invalidate(*keys):
+    for key in keys:
+        get_cache().invalidate(key)
+
+
+def init_app(app):
+    """Set up the single-flight cache for `app`."""
+
+    app.config.setdefault("SINGLEFLIGHT_TTL", 5)
+    app.config.setdefault("SINGLEFLIGHT_STALE", 30)
+    app.config.setdefault("SINGLEFLIGHT_DIR", None)
+    app.config.setdefault("SINGLEFLIGHT_MAX_ENTRIES", 10_000)
+
+    folder = app.config["SINGLEFLIGHT_DIR"]
+    if folder:
+        check_private_folder(folder)
+
+    app.extensions["singleflight"] = SingleFlight(
+        app.config["SINGLEFLIGHT_TTL"],
+        app.config["SINGLEFLIGHT_STALE"],
+        folder=folder,
+        max_entries=app.config["SINGLEFLIGHT_MAX_ENTRIES"])
@@ -0,0 +1,171 @@
+// Like and follow buttons, without reloading the page.
+//
+// Forms marked data-like-form or data-follow-form are posted with fetch()
+// asking for JSON, and the button is updated from the reply. Without
+// JavaScript (or if the request never reaches the server) they submit
+// normally and redirect. Once the server has answered, the like or follow
+// may already have toggled, so resubmitting could undo it; we show an
+// error instead.
+
+class NoResponseError extends Error {}
+
+async function postForJson(form) {
+  let resp;
+  try {
+    resp = await fetch(form.action, {
+      method: "POST",
+      body: new FormData(form),
+      headers: { Accept: "application/json" },
+      credentials: "same-origin",
+    });
+  } catch (err) {
+    throw new NoResponseError(err.message);
+  }
+  if (!resp.ok) throw new Error(`${form.action}: ${resp.status}`);
+  return resp.json();
+}
+
+function showError(message) {
+  const alert = document.createElement("div");
+  alert.className = "alert alert-danger";
+  alert.textContent = message;
+  document.querySelector(".container").prepend(alert);
+}
+
+function showLike(form, { liked }) {
+  const icon = form.querySelector("i");
+  icon.classList.toggle("bi-heart-fill", liked);
+  icon.classList.toggle("bi-heart", !liked);
+}
+
+function showFollow(form, { following, followers_count }) {
+  const userId = form.dataset.userId;
+  const button = form.querySelector("button");
+
+  form.action = following
+    ? `/users/stop-following/${userId}`
+    : `/users/follow/${userId}`;
+  button.textContent = following ? "Unfollow" : "Follow";
+  button.classList.toggle("btn-primary", following);
+  button.classList.toggle("btn-outline-primary", !following);
+
+  const count = document.getElementById("followers-count");
+  if (count) count.textContent = followers_count;
+}
+
+document.addEventListener("submit", async function (evt) {
+  const form = evt.target;
+  let show;
+
+  if (form.matches("[data-like-form]")) show = showLike;
+  else if (form.matches("[data-follow-form]")) show = showFollow;
+  else return;
+
+  evt.preventDefault();
+  const button = form.querySelector("button");
+  button.disabled = true;
+
+  try {
+    show(form, await postForJson(form));
+  } catch (err) {
+    if (err instanceof NoResponseError) form.submit();
+    else showError("Something went wrong; please reload the page and try again.");
+  } finally {
+    button.disabled = false;
+  }
+});
+
+// The notifications page marks them read once it's actually been seen,
+// which link prefetchers and preview bots (which don't run scripts) won't.
+
+document.addEventListener("DOMContentLoaded", async function () {
+  const form = document.querySelector("[data-mark-read-form]");
+  if (!form) return;
+
+  try {
+    await postForJson(form);
+  } catch (err) {
+    return;
+  }
+  form.hidden = true;
+  document.getElementById("unread-notifications")?.remove();
+});
+
+// Live timeline: the homepage listens for new messages and offers to
+// show them, rather than anyone polling by reloading.
+
+document.addEventListener("DOMContentLoaded", function () {
+  const timeline = document.querySelector("[data-stream]");
+  const button = document.getElementById("new-messages");
+  if (!timeline || !button || !window.EventSource) return;
+
+  const shown = new Set();
+  const source = new EventSource(timeline.dataset.stream);
+
+  source.onmessage = function (evt) {
+    const { id } = JSON.parse(evt.data);
+    shown.add(id);
+    button.textContent = `Show ${shown.size} new warble${shown.size > 1 ? "s" : ""}`;
+    button.hidden = false;
+  };
+});
+
+// Username suggestions for the search box, as you type.
+
+document.addEventListener("DOMContentLoaded", function () {
+  const search = document.getElementById("search");
+  const suggestions = document.getElementById("search-suggestions");
+  if (!search || !suggestions) return;
+
+  let latest = 0;
+
+  search.addEventListener("input", async function () {
+    const prefix = search.value.trim();
+    const request = ++latest;
+    if (!prefix) return suggestions.replaceChildren();
+
+    const resp = await fetch(
+      `/api/users/autocomplete?prefix=${encodeURIComponent(prefix)}`,
+      { credentials: "same-origin" });
+    // Ignore answers to anything but the latest keystroke.
+    if (!resp.ok || request !== latest) return;
+
+    const { users } = await resp.json();
+    suggestions.replaceChildren(...users.map(function ({ username }) {
+      const option = document.createElement("option");
+      option.value = username;
+      return option;
+    }));
+  });
+});
+
+// Signup and profile forms say whether a username or email is taken as
+// soon as it's typed, rather than after submitting.
+
+document.addEventListener("DOMContentLoaded", function () {
+  const form = document.getElementById("user_form");
+  if (!form) return;
+
+  for (const kind of ["username", "email"]) {
+    const input = form.querySelector(`[name=${kind}]`);
+    if (!input) continue;
+    const original = input.value.trim().toLowerCase();
+    let latest = 0;
+
+    input.addEventListener("change", async function () {
+      const value = input.value.trim();
+      const request = ++latest;
+      input.setCustomValidity("");
+      if (!value || value.toLowerCase() === original) return;
+
+      const resp = await fetch(
+        `/api/users/available?${kind}=${encodeURIComponent(value)}`,
+        { credentials: "same-origin" });
+      if (!resp.ok || request !== latest) return;
+
+      const available = (await resp.json())[kind];
+      input.setCustomValidity(available ? "" : `That ${kind} is already taken.`);
+      input.reportValidity();
+    });
+  }
+});
@@ -0,0 +1,123 @@
+"""#hashtags and @mentions in messages.
+
+New messages are indexed as they're posted, into message_tags and
+mentions, so tag and mention timelines are index lookups rather than
+scans of messages.text. Index messages posted before this existed with:
+
+    python tags.py
+
+which walks messages in id order, a batch per transaction, so it can be
+stopped and rerun (already-indexed rows are skipped).
+"""
+
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, User, Message, MessageTag, Mention
+
+# Not after "&", so the "&#39;" in escaped text isn't a tag.
+HASHTAG_RE = re.compile(r"(?<![\w#&])#(\w+)")
+MENTION_RE = re.compile(r"(?<![\w@])@(\w+)")
+
+BACKFILL_BATCH_SIZE = 5_000
+
+
+def hashtags(text):
+    """Set of lowercased hashtags in `text`, without the #."""
+
+    return {tag.lower() for tag in HASHTAG_RE.findall(text)}
+
+
+def mentioned_usernames(text):
+    """Set of usernames @mentioned in `text`, without the @."""
+
+    return set(MENTION_RE.findall(text))
+
+
+def index_messages(messages):
+    """Record tags and mentions for `messages`, (id, text) pairs.
+
+    Uses one query per table however many messages there are. Doesn't
+    commit.
+    """
+
+    tag_rows = []
+    mentions = []
+    for message_id, text in messages:
+        tag_rows.extend(dict(tag=tag, message_id=message_id)
+                        for tag in hashtags(text))
+        mentions.extend((username.lower(), message_id)
+                        for username in mentioned_usernames(text))
+
+    if tag_rows:
+        db.session.execute(
+            insert(MessageTag).values(tag_rows).on_conflict_do_nothing())
+
+    if mentions:
+        # Usernames are unique whatever their case, so @Jo is jo; this
+        # uses the lower(username) index.
+        lower_username = func.lower(User.username)
+        user_ids = dict(db.session
+                        .query(lower_username, User.id)
+                        .filter(lower_username.in_(
+                            {username for username, _ in mentions})))
+        mention_rows = [dict(user_id=user_ids[username],
+                             message_id=message_id)
+                        for username, message_id in mentions
+                        if username in user_ids]
+
+        if mention_rows:
+            db.session.execute(
+                insert(Mention).values(mention_rows).on_conflict_do_nothing())
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """Index every message, committing after each batch.
+
+    Returns how many messages were read.
+    """
+
+    last_id = 0
+    count = 0
+
+    while True:
+        batch = (db.session
+                 .query(Message.id, Message.text)
+                 .filter(Message.id > last_id)
+                 .order_by(Message.id)
+                 .limit(batch_size)
+                 .all())
+        if not batch:
+            return count
+
+        index_messages(batch)
+        db.session.commit()
+
+        last_id = batch[-1].id
+        count += len(batch)
+
+
+def link_tags(text):
+    """Jinja filter: escape `text`, linking its hashtags to their
+    timelines."""
+
+    return Markup(HASHTAG_RE.sub(
+        lambda match: Markup('<a href="/tags/{tag}">#{text}</a>').format(
+            tag=match[1].lower(), text=match[1]),
+        escape(text)))
+
+
+def init_app(app):
+    """Add the `link_tags` filter to `app`."""
+
+    app.add_template_filter(link_tags, "link_tags")
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        print(f"Indexed {backfill()} messages.")
@@ -0,0 +1,39 @@
+"""Persistent Jinja bytecode cache and template precompilation.
+
+Compiled templates are cached as bytecode on local disk, so a fresh
+worker loads them instead of recompiling; every template is also loaded
+at boot so the first requests after a deploy don't pay for compilation.
+"""
+
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def precompile_templates(app):
+    """Load every template under templates/ into the Jinja cache.
+
+    Returns the number of templates loaded.
+    """
+
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+def init_app(app):
+    """Use an on-disk bytecode cache for `app`'s templates and warm it."""
+
+    app.config.setdefault(
+        "JINJA_CACHE_DIR", os.path.join(app.instance_path, "jinja_cache"))
+    app.config.setdefault("PRECOMPILE_TEMPLATES", True)
+
+    if app.config["JINJA_CACHE_DIR"]:
+        os.makedirs(app.config["JINJA_CACHE_DIR"], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config["JINJA_CACHE_DIR"])
+
+    if app.config["PRECOMPILE_TEMPLATES"]:
+        precompile_templates(app)
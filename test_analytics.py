@@ -0,0 +1,169 @@
+"""Analytics report tests."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, CURR_USER_KEY
+import analytics
+
+folder = tempfile.mkdtemp()
+
+app = create_app({
+    'WTF_CSRF_ENABLED': False,
+    'ANALYTICS_FOLDER': folder,
+})
+
+# A Monday, and the Wednesday and next Monday after it.
+MONDAY = datetime(2024, 1, 1, 12)
+WEDNESDAY = datetime(2024, 1, 3, 9)
+NEXT_MONDAY = datetime(2024, 1, 8, 23)
+
+
+class AnalyticsTestCase(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(folder)
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(username=f"u{i}", email=f"u{i}@email.com",
+                      password="x")
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.flush()
+        a, b, c, d = self.users = users
+
+        messages = [
+            Message(text="a1", user=a, timestamp=MONDAY),
+            Message(text="a2", user=a, timestamp=MONDAY),
+            Message(text="b1", user=b, timestamp=WEDNESDAY),
+            Message(text="a3", user=a, timestamp=NEXT_MONDAY),
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+        a1, a2, b1, a3 = messages
+
+        db.session.add_all([
+            Like(user_id=b.id, message_id=a1.id, timestamp=MONDAY),
+            Like(user_id=c.id, message_id=a1.id, timestamp=WEDNESDAY),
+            Like(user_id=d.id, message_id=a1.id, timestamp=WEDNESDAY),
+            Like(user_id=a.id, message_id=b1.id, timestamp=NEXT_MONDAY),
+        ] + [
+            Follows(user_following_id=follower.id,
+                    user_being_followed_id=a.id)
+            for follower in (b, c, d)
+        ] + [
+            Follows(user_following_id=a.id, user_being_followed_id=b.id),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def client_for(self, user):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+        return client
+
+    def test_report(self):
+        """Test the report's numbers, reading a couple of rows at a time"""
+
+        report = analytics.compute_report(chunk_size=2)
+
+        self.assertEqual(list(report["totals"]), [4, 4, 4, 4])
+
+        first_day = (MONDAY - datetime(1970, 1, 1)).days
+        self.assertEqual(report["first_day"], first_day)
+        #                        Mon  Tue  Wed  Thu  Fri  Sat  Sun  Mon
+        self.assertEqual(list(report["posts_per_day"]),
+                         [2, 0, 1, 0, 0, 0, 0, 1])
+        self.assertEqual(list(report["likes_per_day"]),
+                         [1, 0, 2, 0, 0, 0, 0, 1])
+        self.assertEqual(list(report["posters_per_day"]),
+                         [1, 0, 1, 0, 0, 0, 0, 1])
+
+        self.assertEqual(report["first_week"] * 7 - analytics.WEEK_OFFSET,
+                         first_day)
+        self.assertEqual(list(report["posts_per_week"]), [3, 1])
+        self.assertEqual(list(report["likes_per_week"]), [3, 1])
+        self.assertEqual(list(report["posters_per_week"]), [2, 1])
+
+        # Followers: a has 3, b has 1, c and d none.
+        self.assertEqual(list(report["follower_bins"]), [0, 1, 2])
+        self.assertEqual(list(report["follower_counts"]), [2, 1, 1])
+        # Following: a, b, c and d each follow 1.
+        self.assertEqual(list(report["following_counts"]), [0, 4])
+
+        # Likes per message: 3, 0, 1, 0.
+        np.testing.assert_allclose(
+            report["likes_per_message"],
+            np.percentile([3, 0, 1, 0], analytics.PERCENTILES))
+        # a got 3 likes on 3 messages; b 1 on 1.
+        np.testing.assert_allclose(report["like_ratio"], [1, 1, 1, 1])
+
+    def test_page_shows_saved_report(self):
+        """Test admins see the saved report"""
+
+        a = self.users[0]
+        a.is_admin = True
+        db.session.commit()
+
+        html = self.client_for(a).get("/admin/analytics").get_data(
+            as_text=True)
+        self.assertIn("There's no report yet", html)
+
+        analytics.save_report(analytics.compute_report())
+
+        html = self.client_for(a).get("/admin/analytics").get_data(
+            as_text=True)
+        self.assertIn("08 January 2024", html)
+        self.assertIn("Likes per message", html)
+
+    def test_page_admins_only(self):
+        """Test users who aren't admins are turned away"""
+
+        resp = self.client_for(self.users[1]).get("/admin/analytics")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, "/")
+
+    def test_report_reads_one_snapshot(self):
+        """Test the report runs in one read-only REPEATABLE READ snapshot"""
+
+        def settings(chunk_size):
+            return [db.session.execute(db.text(f"SHOW {name}")).scalar()
+                    for name in ("transaction_isolation",
+                                 "transaction_read_only")]
+
+        with patch.object(analytics, "_compute_report", settings):
+            self.assertEqual(analytics.compute_report(),
+                             ["repeatable read", "on"])
+
+    def test_app_doesnt_import_numpy(self):
+        """Test web workers only load NumPy when the report is needed"""
+
+        code = "import sys, app; app.create_app(); print('numpy' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "False")
@@ -0,0 +1,126 @@
+"""Message archive tests."""
+
+import os
+import shutil
+import tempfile
+from datetime import date, datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Like, MessageArchive, MessageTag
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import events
+from archive import (
+    archive_month, archive_old_months, find_message, month_counts,
+    restore_month)
+from tags import backfill
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        MessageArchive.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.folder = tempfile.mkdtemp()
+        app.config['ARCHIVE_FOLDER'] = self.folder
+        self.context = app.app_context()
+        self.context.push()
+
+        u1 = User(username="u1", email="u1@email.com", password="x")
+        u2 = User(username="u2", email="u2@email.com", password="x")
+        db.session.add_all([u1, u2])
+        db.session.flush()
+
+        self.old = Message(text="old #news", user_id=u1.id,
+                           timestamp=datetime(2021, 3, 14))
+        self.new = Message(text="new", user_id=u1.id,
+                           timestamp=datetime(2022, 6, 1))
+        db.session.add_all([self.old, self.new])
+        db.session.flush()
+
+        db.session.add(Like(user_id=u2.id, message_id=self.old.id,
+                            timestamp=datetime(2021, 3, 15)))
+        db.session.commit()
+        backfill()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.old_id = self.old.id
+        self.new_id = self.new.id
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+        shutil.rmtree(self.folder)
+        del app.config['ARCHIVE_FOLDER']
+
+    def test_archive_old_months(self):
+        """Test only months past the cutoff are moved out of Postgres"""
+
+        archived = archive_old_months(months=12, today=date(2022, 7, 4))
+
+        self.assertEqual(archived, {date(2021, 3, 1): 1})
+        self.assertEqual(month_counts(), {date(2022, 6, 1): 1})
+        self.assertIsNone(Message.query.get(self.old_id))
+        self.assertEqual(os.listdir(self.folder),
+                         ["messages-2021-03.ndjson.gz"])
+
+    def test_find_archived_message(self):
+        """Test archived messages can still be found and viewed by id"""
+
+        archive_month(date(2021, 3, 1))
+
+        found = find_message(self.old_id)
+        self.assertEqual((found.id, found.text, found.timestamp, found.user.id),
+                         (self.old_id, "old #news", datetime(2021, 3, 14),
+                          self.u1_id))
+        self.assertIsNone(find_message(self.new_id))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/messages/{self.old_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("old", html)
+            self.assertIn("Archived", html)
+
+    def test_restore_month(self):
+        """Test restoring brings back messages, likes and tags"""
+
+        archive_month(date(2021, 3, 1))
+        self.assertEqual(restore_month(date(2021, 3, 1)), 1)
+
+        restored = Message.query.get(self.old_id)
+        self.assertEqual(restored.text, "old #news")
+        self.assertEqual([(l.user_id, l.timestamp) for l in Like.query],
+                         [(self.u2_id, datetime(2021, 3, 15))])
+        self.assertEqual([t.tag for t in MessageTag.query], ["news"])
+        self.assertEqual(MessageArchive.query.count(), 0)
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_log_locked_last(self):
+        """Test the event log's lock is only taken once the file is written"""
+
+        lock_log = events.lock_log
+        file_written = []
+
+        def check_then_lock():
+            file_written.append(os.listdir(self.folder)
+                                == ["messages-2021-03.ndjson.gz"])
+            lock_log()
+
+        with patch.object(events, "lock_log", check_then_lock):
+            archive_month(date(2021, 3, 1))
+
+        self.assertEqual(file_written, [True])
@@ -0,0 +1,122 @@
+"""Username autocomplete tests."""
+
+import os
+import time
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from autocomplete import Autocomplete, PrefixIndex, search_db
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class PrefixIndexTestCase(TestCase):
+    def test_search(self):
+        """Test prefix search ignores case, sorts, and stops at `limit`"""
+
+        index = PrefixIndex()
+        index.load([(1, "Joe", "a"), (2, "john", "b"), (3, "jo", "c"),
+                    (4, "kim", "d")])
+
+        self.assertEqual([u[1] for u in index.search("JO")],
+                         ["jo", "Joe", "john"])
+        self.assertEqual([u[1] for u in index.search("jo", limit=2)],
+                         ["jo", "Joe"])
+        self.assertEqual(index.search("x"), [])
+
+    def test_add_rename_remove(self):
+        """Test incremental updates keep the index sorted and unique"""
+
+        index = PrefixIndex()
+        index.load([(1, "amy", "a")])
+
+        index.add(2, "abe", "b")
+        index.add(1, "zed", "a")
+        self.assertEqual([u[1] for u in index.search("a")], ["abe"])
+        self.assertEqual([u[1] for u in index.search("z")], ["zed"])
+
+        index.remove(1)
+        index.remove(1)
+        self.assertEqual(len(index), 1)
+
+
+class AutocompleteViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        users = [User(username=name, email=f"{name}@email.com",
+                      password="x")
+                 for name in ["Ann", "anna_b", "annaXb", "bob"]]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.user_id = users[0].id
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.original = app.extensions["autocomplete"]
+        app.extensions["autocomplete"] = Autocomplete(app)
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions["autocomplete"] = self.original
+
+    def usernames(self, prefix):
+        resp = self.client.get(f"/api/users/autocomplete?prefix={prefix}")
+        return [u["username"] for u in resp.json["users"]]
+
+    def test_db_fallback(self):
+        """Test the DB search matches prefixes, escaping LIKE wildcards"""
+
+        self.assertEqual([u.username for u in search_db("ANN")],
+                         ["Ann", "anna_b", "annaXb"])
+        self.assertEqual([u.username for u in search_db("anna_")],
+                         ["anna_b"])
+
+    def test_index_follows_signups_and_deletes(self):
+        """Test the loaded index picks up signups and deletes"""
+
+        autocomplete = app.extensions["autocomplete"]
+        autocomplete.start()
+        wait_for(lambda: autocomplete.index.loaded)
+
+        self.assertEqual(self.usernames("ann"), ["Ann", "anna_b", "annaXb"])
+
+        app.test_client().post("/signup", data={
+            "username": "annie", "email": "annie@email.com",
+            "password": "password"})
+        wait_for(lambda: "annie" in self.usernames("ann"))
+
+        self.client.post("/users/delete")
+        wait_for(lambda: "Ann" not in [
+            u[1] for u in autocomplete.index.search("ann")])
+
+    def test_logged_out(self):
+        """Test autocomplete needs a login"""
+
+        resp = app.test_client().get("/api/users/autocomplete?prefix=a")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_limit_clamped(self):
+        """Test ?limit= below 1 or not a number still returns results"""
+
+        for limit in ("-1", "0", "x"):
+            resp = self.client.get(
+                f"/api/users/autocomplete?prefix=ann&limit={limit}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreaterEqual(len(resp.json["users"]), 1)
@@ -0,0 +1,151 @@
+"""Username and email availability tests."""
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, CURR_USER_KEY
+import availability
+from availability import BloomFilter
+
+app = create_app({'WTF_CSRF_ENABLED': False})
+
+
+class BloomFilterTestCase(TestCase):
+    def test_no_false_negatives(self):
+        """Test everything added is found, and few other things are"""
+
+        bloom = BloomFilter(capacity=10_000, error_rate=0.01)
+        for n in range(10_000):
+            bloom.add(f"username:user{n}")
+
+        self.assertTrue(all(f"username:user{n}" in bloom
+                            for n in range(10_000)))
+
+        false_positives = sum(f"username:other{n}" in bloom
+                              for n in range(10_000))
+        self.assertLess(false_positives, 200)
+        self.assertTrue(bloom.full)
+
+
+class AvailabilityTestCase(TestCase):
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        user = User.signup("Taken", "taken@email.com", "password")
+        db.session.commit()
+        self.user_id = user.id
+
+        # Load the filter here, rather than in a background thread.
+        checker = app.extensions["availability"]
+        checker._started = True
+        checker.filter = availability.load_filter()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_api(self):
+        """Test the API answers case-insensitively"""
+
+        client = app.test_client()
+
+        resp = client.get("/api/users/available?username=TAKEN"
+                          "&email=free@email.com")
+        self.assertEqual(resp.json, {"username": False, "email": True})
+
+        resp = client.get("/api/users/available?email=%20Taken@Email.com")
+        self.assertEqual(resp.json, {"email": False})
+
+        self.assertEqual(client.get("/api/users/available").json, {})
+
+    def test_available_names_skip_db(self):
+        """Test names the filter doesn't have aren't looked up"""
+
+        with patch("availability.taken_in_db") as taken_in_db:
+            self.assertEqual(availability.taken(username="free",
+                                                email="free@email.com"),
+                             set())
+        taken_in_db.assert_not_called()
+
+    def test_signup_checks_before_hashing(self):
+        """Test a taken name is rejected without hashing a password"""
+
+        with patch("models.hash_password") as hash_password:
+            resp = app.test_client().post("/signup", data={
+                "username": "taken",
+                "password": "password",
+                "email": "new@email.com",
+            })
+
+        hash_password.assert_not_called()
+        html = resp.get_data(as_text=True)
+        self.assertIn("That username is already taken.", html)
+        self.assertEqual(User.query.count(), 1)
+
+    def test_signup_and_rename_update_filter(self):
+        """Test new and changed names are in the filter straight away"""
+
+        client = app.test_client()
+        client.post("/signup", data={
+            "username": "newbie",
+            "password": "password",
+            "email": "newbie@email.com",
+        })
+        self.assertTrue(app.extensions["availability"].maybe_taken(
+            "username", "NEWBIE"))
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        client.post("/users/profile", data={
+            "username": "renamed",
+            "email": "taken@email.com",
+            "password": "password",
+        })
+
+        resp = client.get("/api/users/available?username=Renamed")
+        self.assertEqual(resp.json, {"username": False})
+
+    def test_own_names_not_taken_on_edit(self):
+        """Test keeping your own username and email isn't a clash"""
+
+        self.assertEqual(
+            availability.taken(user_id=self.user_id, username="taken",
+                               email="TAKEN@email.com"),
+            set())
+
+    def test_db_rejects_names_differing_in_case(self):
+        """Test the database agrees a name taken in any case is taken"""
+
+        User.signup("TAKEN", "other@email.com", "password")
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        User.signup("other", "Taken@Email.com", "password")
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+    def test_signup_strips_names(self):
+        """Test names are stored as they're compared, without spaces"""
+
+        app.test_client().post("/signup", data={
+            "username": " spacey ",
+            "password": "password",
+            "email": " spacey@email.com ",
+        })
+
+        user = User.query.filter_by(username="spacey").one()
+        self.assertEqual(user.email, "spacey@email.com")
@@ -0,0 +1,119 @@
+"""Concurrency stress tests: parallel likes and follows.
+
+Hammers toggle_like and start_following/stop_following from many
+threads at once, like a threaded or gevent worker would, and checks for
+deadlocks (threads that never finish), errors and lost updates.
+"""
+
+import os
+import threading
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+N_THREADS = 8
+N_ROUNDS = 15
+
+# Generous: each thread only does a few dozen requests.
+DEADLOCK_TIMEOUT = 60
+
+
+class ConcurrencyTestCase(TestCase):
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(username=f"c{i}", email=f"c{i}@email.com", password="x")
+                 for i in range(N_THREADS + 1)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.target_id = users[0].id
+        self.user_ids = [u.id for u in users[1:]]
+
+        msg = Message(text="popular", user_id=self.target_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def hammer(self, requests_for_user):
+        """Run each user's requests in its own thread, all at once.
+
+        Returns the status codes seen; fails if any thread hangs.
+        """
+
+        statuses = []
+        errors = []
+        start = threading.Barrier(N_THREADS)
+
+        def run(user_id):
+            try:
+                client = app.test_client()
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                start.wait()
+                for url in requests_for_user(user_id):
+                    statuses.append(client.post(url).status_code)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(user_id,))
+                   for user_id in self.user_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(DEADLOCK_TIMEOUT)
+
+        self.assertFalse(any(t.is_alive() for t in threads),
+                         "threads deadlocked")
+        self.assertEqual(errors, [])
+        return statuses
+
+    def test_parallel_toggle_like(self):
+        """Test every user's like toggles land, with no duplicates"""
+
+        like_url = f"/messages/{self.msg_id}/like"
+        # An odd number of toggles each: everyone should end up liking.
+        statuses = self.hammer(lambda user_id: [like_url] * (2 * N_ROUNDS + 1))
+
+        self.assertEqual(set(statuses), {302})
+        self.assertEqual(Like.query.filter_by(message_id=self.msg_id).count(),
+                         N_THREADS)
+
+    def test_parallel_follow_unfollow(self):
+        """Test follower counters match the follows table afterwards"""
+
+        follow_url = f"/users/follow/{self.target_id}"
+        unfollow_url = f"/users/stop-following/{self.target_id}"
+
+        # Repeated follows are no-ops; users with even ids end unfollowed.
+        def requests_for_user(user_id):
+            urls = [follow_url, follow_url, unfollow_url] * N_ROUNDS
+            return urls + [follow_url if user_id % 2 else unfollow_url]
+
+        statuses = self.hammer(requests_for_user)
+        self.assertEqual(set(statuses), {302})
+
+        db.session.expire_all()
+        followers = Follows.query.filter_by(
+            user_being_followed_id=self.target_id).count()
+        target = User.query.get(self.target_id)
+
+        self.assertEqual(followers,
+                         len([u for u in self.user_ids if u % 2]))
+        self.assertEqual(target.followers_count, followers)
+        for user_id in self.user_ids:
+            self.assertEqual(User.query.get(user_id).following_count,
+                             user_id % 2)
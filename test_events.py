@@ -0,0 +1,198 @@
+"""Event log tests."""
+
+import os
+import shutil
+import tempfile
+from datetime import date, datetime
+from unittest import TestCase
+
+from sqlalchemy import func
+
+from models import (
+    db, User, Message, Follows, Like, Event, ConsumerCheckpoint,
+    EventSnapshot)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, CURR_USER_KEY
+from archive import archive_month, restore_month
+import events
+
+app = create_app({'WTF_CSRF_ENABLED': False})
+
+
+def message_counts():
+    """Each user's number of messages, straight from the messages table."""
+
+    return dict(db.session
+                .query(Message.user_id, func.count())
+                .group_by(Message.user_id)
+                .all())
+
+
+def replayed(consumer):
+    consumer.rebuild()
+    return {user_id: count
+            for user_id, count in consumer.counts.items() if count}
+
+
+class EventsTestCase(TestCase):
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        for model in (Event, ConsumerCheckpoint, EventSnapshot, Like,
+                      Follows, Message, User):
+            model.query.delete()
+
+        users = [User.signup(f"u{i}", f"u{i}@email.com", "password")
+                 for i in range(3)]
+        db.session.commit()
+        self.ids = [u.id for u in users]
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def post_messages(self, user_id, *texts):
+        client = self.client_for(user_id)
+        for text in texts:
+            client.post("/messages/new", data={"text": text})
+        return [m.id for m in Message.query.filter(Message.text.in_(texts))]
+
+    def test_routes_append_events(self):
+        """Test each change is logged once, in order, with its key"""
+
+        a, b, c = self.ids
+        [msg_id] = self.post_messages(a, "hello")
+        self.client_for(b).post(f"/users/follow/{a}")
+        self.client_for(b).post(f"/users/follow/{a}")
+        self.client_for(b).post(f"/messages/{msg_id}/like")
+        self.client_for(b).post(f"/users/stop-following/{a}")
+        self.client_for(a).post(f"/messages/{msg_id}/delete")
+
+        logged = events.read()
+        self.assertEqual(
+            [(e.type, e.key) for e in logged],
+            [("message_posted", f"message:{msg_id}"),
+             ("followed", f"follow:{b}:{a}"),
+             ("liked", f"like:{b}:{msg_id}"),
+             ("unfollowed", f"follow:{b}:{a}"),
+             ("message_deleted", f"message:{msg_id}")])
+        self.assertEqual(logged[0].data["text"], "hello")
+        self.assertEqual(logged[2].target_user_id, a)
+
+        offsets = [e.offset for e in logged]
+        self.assertEqual(offsets, sorted(offsets))
+
+    def test_consumer_snapshot_and_replay(self):
+        """Test a consumer rebuilt from a snapshot matches the database"""
+
+        a, b, c = self.ids
+        self.post_messages(a, "a1", "a2")
+        self.post_messages(b, "b1")
+
+        counts = events.MessageCounts()
+        self.assertEqual(replayed(counts), message_counts())
+        counts.snapshot()
+        self.assertEqual(events.get_checkpoint("message_counts"),
+                         counts.offset)
+
+        [b2] = self.post_messages(b, "b2")
+        self.post_messages(c, "c1")
+        self.client_for(b).post(f"/messages/{b2}/delete")
+
+        rebuilt = events.MessageCounts()
+        rebuilt.rebuild()
+        self.assertEqual(rebuilt.counts, {**message_counts(), b: 1})
+        self.assertEqual(rebuilt.offset, events.last_offset())
+
+    def test_compaction_keeps_replay_the_same(self):
+        """Test compacting the log doesn't change what replaying gives"""
+
+        a, b, c = self.ids
+        a1, a2 = self.post_messages(a, "a1", "a2")
+        [c1] = self.post_messages(c, "c1")
+        for follower, followed in [(b, a), (c, a), (a, c)]:
+            self.client_for(follower).post(f"/users/follow/{followed}")
+        self.client_for(b).post(f"/messages/{a1}/like")
+        self.client_for(b).post(f"/messages/{c1}/like")
+        self.client_for(b).post(f"/messages/{c1}/like")
+        self.client_for(b).post(f"/users/stop-following/{a}")
+        self.client_for(a).post(f"/messages/{a2}/delete")
+        self.client_for(c).post("/users/delete")
+
+        before = replayed(events.MessageCounts())
+        self.assertEqual(before, message_counts())
+
+        events.save_checkpoint("message_counts", events.last_offset())
+        db.session.commit()
+        removed = events.compact()
+
+        self.assertGreater(removed, 0)
+        self.assertEqual(replayed(events.MessageCounts()), before)
+
+        # Only what's still true is left: a's message, and b liking it.
+        self.assertEqual(
+            [(e.type, e.key) for e in events.read()],
+            [("message_posted", f"message:{a1}"),
+             ("liked", f"like:{b}:{a1}")])
+
+    def test_compaction_stops_at_checkpoints(self):
+        """Test events a consumer hasn't reached aren't compacted"""
+
+        [a1] = self.post_messages(self.ids[0], "a1")
+        self.client_for(self.ids[0]).post(f"/messages/{a1}/delete")
+
+        self.assertEqual(events.compact(), 0)
+        self.assertEqual(len(events.read()), 2)
+
+    def test_archiving_is_logged(self):
+        """Test archiving and restoring a month keep replayed counts right"""
+
+        a, b, c = self.ids
+        old = Message(text="old", user_id=a, timestamp=datetime(2021, 3, 14))
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+        self.post_messages(a, "new")
+
+        counts = events.MessageCounts()
+        counts.seed()
+
+        app.config['ARCHIVE_FOLDER'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app.config.pop('ARCHIVE_FOLDER'))
+
+        archive_month(date(2021, 3, 1))
+        self.assertEqual(events.read(counts.offset)[-1].key,
+                         f"message:{old_id}")
+        self.assertEqual(replayed(counts), message_counts())
+
+        restore_month(date(2021, 3, 1))
+        self.assertEqual(replayed(counts), message_counts())
+
+    def test_seed_from_tables(self):
+        """Test a consumer seeded on history from before the log is right"""
+
+        a, b, c = self.ids
+        self.post_messages(a, "a1", "a2")
+        Event.query.delete()
+        db.session.commit()
+
+        counts = events.MessageCounts()
+        counts.seed()
+        self.assertEqual(counts.counts, {a: 2})
+
+        [a3] = self.post_messages(a, "a3")
+        self.client_for(a).post(f"/messages/{a3}/delete")
+        [a1] = [m.id for m in Message.query.filter_by(text="a1")]
+        self.client_for(a).post(f"/messages/{a1}/delete")
+
+        self.assertEqual(replayed(counts), message_counts())
@@ -0,0 +1,125 @@
+"""Account export tests."""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import export
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.folder = tempfile.mkdtemp()
+        app.config['EXPORT_FOLDER'] = self.folder
+
+        u1 = User(username="u1", email="u1@email.com", password="x")
+        u2 = User(username="u2", email="u2@email.com", password="x")
+        db.session.add_all([u1, u2])
+        db.session.flush()
+
+        m1 = Message(text="mine", user_id=u1.id)
+        m2 = Message(text="theirs", user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.flush()
+
+        db.session.add_all([
+            Like(user_id=u1.id, message_id=m2.id),
+            Follows(user_following_id=u1.id, user_being_followed_id=u2.id),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m2_id = m2.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(self.folder)
+        app.config['EXPORT_INLINE_MAX_ROWS'] = 50_000
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_export_ndjson(self):
+        """Test the NDJSON export has every section, and only this user's
+        rows"""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get(f"/users/{self.u1_id}/export")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            records = [json.loads(line)
+                       for line in resp.get_data(as_text=True).splitlines()]
+
+        self.assertEqual([r["type"] for r in records],
+                         ["profile", "messages", "likes", "following"])
+        self.assertEqual(records[0]["username"], "u1")
+        self.assertEqual(records[1]["text"], "mine")
+        self.assertEqual(records[2]["message_id"], self.m2_id)
+        self.assertEqual(records[3]["username"], "u2")
+
+    def test_export_zip(self):
+        """Test the zip export has one NDJSON file per section"""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get(f"/users/{self.u1_id}/export?format=zip")
+
+            zf = zipfile.ZipFile(io.BytesIO(resp.get_data()))
+
+        self.assertEqual(zf.namelist(),
+                         [f"{name}.ndjson" for name, _ in export.SECTIONS])
+        self.assertEqual(json.loads(zf.read("messages.ndjson"))["text"],
+                         "mine")
+        self.assertEqual(zf.read("followers.ndjson"), b"")
+
+    def test_export_other_user(self):
+        """Test users can't export someone else's data"""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get(f"/users/{self.u2_id}/export", follow_redirects=True)
+
+            self.assertIn("Access unauthorized.",
+                          resp.get_data(as_text=True))
+
+    def test_big_export_runs_in_background(self):
+        """Test big accounts are exported by a background job"""
+
+        app.config['EXPORT_INLINE_MAX_ROWS'] = 1
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get(f"/users/{self.u1_id}/export")
+            self.assertEqual(resp.status_code, 302)
+            job_url = resp.location
+
+            # The pool runs one job at a time, so this waits for ours.
+            export.executor.submit(lambda: None).result()
+
+            resp = c.get(job_url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("attachment", resp.headers["Content-Disposition"])
+            self.assertEqual(len(resp.get_data(as_text=True).splitlines()),
+                             4)
@@ -0,0 +1,78 @@
+"""Per-route memory budget tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, CURR_USER_KEY
+import memprofile
+
+# Big enough that a route loading a whole table blows its budget.
+SIZE = 3_000
+
+# No cached profiles, so show_user is measured loading one.
+app = create_app({
+    'WTF_CSRF_ENABLED': False,
+    'SINGLEFLIGHT_TTL': 0,
+    'SINGLEFLIGHT_STALE': 0,
+})
+
+
+def delete_all():
+    Follows.query.delete()
+    Message.query.delete()
+    User.query.delete()
+    db.session.commit()
+
+
+class MemoryBudgetTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with app.app_context():
+            db.create_all()
+            delete_all()
+            cls.user_id = memprofile.fill(users=SIZE, messages=SIZE,
+                                          likes=SIZE)
+
+    @classmethod
+    def tearDownClass(cls):
+        with app.app_context():
+            delete_all()
+
+    def setUp(self):
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_routes_within_budget(self):
+        """Test each route's peak allocation stays within its budget"""
+
+        for endpoint, url in memprofile.ROUTES:
+            url = url.format(user_id=self.user_id)
+            with self.subTest(url=url), app.app_context():
+                profile = memprofile.measure(self.client, url)
+                budget = memprofile.budget_for(endpoint)
+
+                self.assertLessEqual(
+                    profile.peak, budget,
+                    f"{url} allocated {profile.peak} bytes:\n"
+                    + memprofile.format_sites(profile.sites))
+
+    def test_sampled_request_over_budget_logged(self):
+        """Test sampling logs requests over budget, with allocation sites"""
+
+        app.config['MEMPROFILE_SAMPLE_RATE'] = 1.0
+        app.config['MEMORY_BUDGETS'] = {'warbler.list_users': 1}
+        try:
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                self.client.get("/users")
+        finally:
+            app.config['MEMPROFILE_SAMPLE_RATE'] = 0.0
+            app.config['MEMORY_BUDGETS'] = dict(memprofile.DEFAULT_BUDGETS)
+
+        [message] = logs.output
+        self.assertIn("GET /users allocated", message)
+        self.assertIn("models.py:", message)
@@ -155,3 +155,51 @@ class MessageDetailViewTestCase(MessageBaseViewTestCase):
             html = resp.get_data(as_text=True)
             self.assertIn("Access unauthorized.", html)
 
+
+class MessageLikeViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u2_id = u2.id
+
+    def test_toggle_like_redirects(self):
+        """Test that liking from a page still redirects home."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/")
+
+    def test_toggle_like_json(self):
+        """Test that liking with Accept: application/json returns the new
+        state and count instead of redirecting."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            headers = {"Accept": "application/json"}
+
+            resp = c.post(f"/messages/{self.m1_id}/like", headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"liked": True, "likes_count": 1})
+
+            resp = c.post(f"/messages/{self.m1_id}/like", headers=headers)
+            self.assertEqual(resp.json, {"liked": False, "likes_count": 0})
+
+    def test_toggle_like_own_message_json(self):
+        """Test that liking your own message is a 403 for JSON clients."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like",
+                          headers={"Accept": "application/json"})
+            self.assertEqual(resp.status_code, 403)
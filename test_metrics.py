@@ -0,0 +1,56 @@
+"""Prometheus metrics tests."""
+
+import os
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['METRICS_TOKEN'] = None
+
+    def test_metrics_count_requests(self):
+        """Test requests and their latency show up at /metrics"""
+
+        with self.client as c:
+            c.get("/login")
+            html = c.get("/metrics").get_data(as_text=True)
+
+            self.assertIn('warbler_requests_total{endpoint="warbler.login",'
+                          'method="GET",status="200"}', html)
+            self.assertIn('warbler_request_duration_seconds_bucket'
+                          '{endpoint="warbler.login"', html)
+            self.assertIn("warbler_db_pool_size", html)
+            self.assertIn("warbler_bcrypt_slots", html)
+
+    def test_metrics_token(self):
+        """Test /metrics needs the bearer token when one is set"""
+
+        app.config['METRICS_TOKEN'] = "sekrit"
+
+        with self.client as c:
+            self.assertEqual(c.get("/metrics").status_code, 404)
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer sekrit"})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_failed_query_leaves_no_timer(self):
+        """Test a query that errors doesn't leave its start time behind"""
+
+        with db.engine.connect() as conn:
+            for _ in range(3):
+                with self.assertRaises(Exception):
+                    conn.exec_driver_sql("SELECT * FROM no_such_table")
+            self.assertEqual(conn.info.get("metrics_query_start"), [])
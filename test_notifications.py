@@ -0,0 +1,166 @@
+"""Notification tests."""
+
+import os
+from unittest import TestCase
+
+from models import (
+    db, User, Message, Follows, Like, Event, ConsumerCheckpoint,
+    Notification)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, CURR_USER_KEY
+import notifications
+
+app = create_app({'WTF_CSRF_ENABLED': False})
+
+
+class NotificationsTestCase(TestCase):
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        for model in (Event, ConsumerCheckpoint, Notification, Like,
+                      Follows, Message, User):
+            model.query.delete()
+
+        users = [User(username=f"u{i}", email=f"u{i}@email.com",
+                      password="x")
+                 for i in range(6)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = [u.id for u in users]
+
+        author = users[0]
+        author.messages.append(Message(text="popular"))
+        db.session.commit()
+        self.msg_id = author.messages[0].id
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def unread_count(self, user_id):
+        return db.session.get(User, user_id).unread_notifications
+
+    def test_likes_and_follows_collapse(self):
+        """Test a batch of likes and follows becomes one notification each"""
+
+        author, *others = self.ids
+        for user_id in others:
+            self.client_for(user_id).post(f"/messages/{self.msg_id}/like")
+        for user_id in others[:2]:
+            self.client_for(user_id).post(f"/users/follow/{author}")
+
+        self.assertEqual(Notification.query.count(), 0)
+        self.assertEqual(notifications.process_all(), 7)
+
+        like, follow = (Notification.query
+                        .filter_by(user_id=author)
+                        .order_by(Notification.kind.desc()))
+        self.assertEqual((like.kind, like.message_id, like.count),
+                         ("like", self.msg_id, 5))
+        self.assertEqual(like.actor_ids, others[::-1][:3])
+        self.assertEqual((follow.kind, follow.count), ("follow", 2))
+
+        db.session.expire_all()
+        self.assertEqual(self.unread_count(author), 2)
+        self.assertEqual(notifications.process_all(), 0)
+
+    def test_unread_notification_grows_until_read(self):
+        """Test later likes join the unread notification, then a new one"""
+
+        author, a, b, c = self.ids[:4]
+        self.client_for(a).post(f"/messages/{self.msg_id}/like")
+        notifications.process_all()
+        self.client_for(b).post(f"/messages/{self.msg_id}/like")
+        notifications.process_all()
+
+        [notification] = Notification.query.all()
+        self.assertEqual((notification.count, notification.actor_ids),
+                         (2, [b, a]))
+        self.assertEqual(self.unread_count(author), 1)
+
+        client = self.client_for(author)
+        html = client.get("/notifications").get_data(as_text=True)
+        self.assertIn("@u2</a> and <a", html)
+        self.assertIn("liked your warble", html)
+        self.assertIn("list-group-item-primary", html)
+
+        # Just looking (or prefetching) doesn't mark them read.
+        db.session.expire_all()
+        self.assertEqual(self.unread_count(author), 1)
+
+        resp = client.post("/notifications/read",
+                           headers={"Accept": "application/json"})
+        self.assertEqual(resp.json, {"unread_notifications": 0})
+
+        db.session.expire_all()
+        self.assertEqual(self.unread_count(author), 0)
+        html = client.get("/notifications").get_data(as_text=True)
+        self.assertNotIn("list-group-item-primary", html)
+
+        self.client_for(c).post(f"/messages/{self.msg_id}/like")
+        notifications.process_all()
+        self.assertEqual(Notification.query.count(), 2)
+        self.assertEqual(self.unread_count(author), 1)
+
+    def test_navbar_shows_unread_count(self):
+        """Test the navbar shows how many notifications are unread"""
+
+        author = self.ids[0]
+        self.client_for(self.ids[1]).post(f"/users/follow/{author}")
+        notifications.process_all()
+
+        html = self.client_for(author).get("/mentions").get_data(
+            as_text=True)
+        self.assertIn('id="unread-notifications"', html)
+
+        self.client_for(author).post("/notifications/read")
+        html = self.client_for(author).get("/mentions").get_data(
+            as_text=True)
+        self.assertNotIn('id="unread-notifications"', html)
+
+    def test_notifications_paginated(self):
+        """Test notifications page back with ?before="""
+
+        author = self.ids[0]
+        for user_id in self.ids[1:]:
+            self.client_for(author).post(f"/users/follow/{user_id}")
+        notifications.process_all()
+
+        page, next_before = Notification.page(
+            db.session.get(User, self.ids[1]), limit=1)
+        self.assertEqual(next_before, None)
+
+        for user_id in self.ids[1:]:
+            self.client_for(user_id).post(f"/users/follow/{author}")
+            notifications.process_all()
+            Notification.mark_all_read(db.session.get(User, author))
+            db.session.commit()
+
+        user = db.session.get(User, author)
+        first, next_before = Notification.page(user, limit=3)
+        rest, end = Notification.page(user, before=next_before, limit=3)
+
+        self.assertEqual(len(first + rest), 5)
+        self.assertEqual(end, None)
+        self.assertEqual(len({n.id for n in first + rest}), 5)
+
+    def test_deleted_message_skipped(self):
+        """Test likes of a message deleted before notifying are dropped"""
+
+        self.client_for(self.ids[1]).post(f"/messages/{self.msg_id}/like")
+        self.client_for(self.ids[0]).post(f"/messages/{self.msg_id}/delete")
+
+        notifications.process_all()
+
+        self.assertEqual(Notification.query.count(), 0)
+        self.assertEqual(self.unread_count(self.ids[0]), 0)
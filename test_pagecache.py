@@ -0,0 +1,75 @@
+"""Anonymous page cache tests."""
+
+import os
+import re
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import pagecache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class PageCacheTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        with app.app_context():
+            pagecache.get_page_cache().clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['WTF_CSRF_ENABLED'] = False
+        with app.app_context():
+            pagecache.get_page_cache().clear()
+
+    def test_cached_page_gets_own_token(self):
+        """Test a cached form page carries each visitor's own CSRF token"""
+
+        first = app.test_client()
+        second = app.test_client()
+
+        resp = first.get("/login")
+        self.assertIn("Cookie", resp.headers["Vary"])
+        first_token = CSRF_RE.search(resp.get_data(as_text=True))[1]
+
+        with app.app_context():
+            self.assertIsNotNone(pagecache.get_page_cache().get("/login"))
+
+        html = second.get("/login").get_data(as_text=True)
+        second_token = CSRF_RE.search(html)[1]
+        self.assertNotEqual(first_token, second_token)
+        self.assertNotIn(pagecache.CSRF_PLACEHOLDER, html)
+
+        # The token is accepted, so the login fails on the password.
+        resp = second.post("/login", data={
+            "csrf_token": second_token, "username": "u1",
+            "password": "wrongpass"})
+        self.assertIn("Invalid credentials.", resp.get_data(as_text=True))
+
+    def test_logged_in_not_cached(self):
+        """Test logged-in and flashed requests are rendered as usual"""
+
+        client = app.test_client()
+        client.get("/")
+
+        with client.session_transaction() as sess:
+            sess["_flashes"] = [("info", "Just for you")]
+        self.assertIn("Just for you", client.get("/").get_data(as_text=True))
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        html = client.get("/").get_data(as_text=True)
+        self.assertIn("@u1", html)
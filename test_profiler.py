@@ -0,0 +1,135 @@
+"""Request profiler tests."""
+
+import os
+import pstats
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import profiler
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class ProfilerTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        u1 = User(username="u1", email="u1@email.com", password="x")
+        db.session.add(u1)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        app.config['PROFILER_ENABLED'] = True
+        app.extensions['profiles'].clear()
+        self.token = profiler.make_token(app)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['PROFILER_ENABLED'] = False
+
+    def test_profile_with_signed_header(self):
+        """Test a signed request is profiled with its SQL, and downloadable"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u1_id}",
+                         headers={profiler.HEADER: self.token})
+            self.assertEqual(resp.status_code, 200)
+
+            listing = c.get("/_profiler/", headers={profiler.HEADER: self.token})
+            [summary] = listing.json
+            self.assertEqual(summary["endpoint"], "warbler.show_user")
+            self.assertGreater(summary["query_count"], 0)
+
+            detail = c.get(f"/_profiler/{summary['id']}?token={self.token}")
+            self.assertIn("users", detail.json["queries"][0]["sql"])
+
+            resp = c.get(f"/_profiler/{summary['id']}.pstats?token={self.token}")
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(resp.data)
+                f.flush()
+                self.assertGreater(pstats.Stats(f.name).total_calls, 0)
+
+            resp = c.get(f"/_profiler/{summary['id']}.folded?token={self.token}")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_no_profile_without_valid_token(self):
+        """Test unsigned requests aren't profiled and can't see profiles"""
+
+        with self.client as c:
+            c.get("/login", headers={profiler.HEADER: "forged"})
+            self.assertEqual(len(app.extensions['profiles']), 0)
+
+            resp = c.get("/_profiler/", headers={profiler.HEADER: "forged"})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_token_not_stored_in_path(self):
+        """Test a profile keeps the path but not the ?token= query string"""
+
+        with self.client as c:
+            c.get(f"/login?token={self.token}")
+            [profile] = app.extensions['profiles']
+            self.assertEqual(profile["path"], "/login")
+
+    def test_off_under_eventlet(self):
+        """Test nothing is profiled in an eventlet worker"""
+
+        with patch.object(profiler, "eventlet_patched", return_value=True):
+            with self.client as c:
+                c.get("/login", headers={profiler.HEADER: self.token})
+                self.assertEqual(len(app.extensions['profiles']), 0)
+
+    def test_gevent_profiles_only_own_greenlet(self):
+        """Test under gevent a profile leaves out other requests' greenlets"""
+
+        result = subprocess.run([sys.executable, "-c", GEVENT_SCRIPT],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.split(), ["True", "False", "True"])
+
+
+# Two requests at once in one thread: a profiled one that sleeps (so
+# switches out) and an unprofiled one that runs meanwhile.
+GEVENT_SCRIPT = """
+from gevent import monkey; monkey.patch_all()
+import time, gevent
+from app import create_app
+import profiler
+
+app = create_app({"PROFILER_ENABLED": True})
+
+def profiled_work():
+    time.sleep(0.05)
+
+def other_work():
+    end = time.perf_counter() + 0.02
+    while time.perf_counter() < end:
+        pass
+
+app.add_url_rule("/profiled", "profiled", lambda: profiled_work() or "")
+app.add_url_rule("/other", "other", lambda: other_work() or "")
+
+token = profiler.make_token(app)
+gevent.joinall([
+    gevent.spawn(app.test_client().get, "/profiled",
+                 headers={profiler.HEADER: token}),
+    gevent.spawn(app.test_client().get, "/other"),
+])
+
+[profile] = app.extensions["profiles"]
+functions = {name for _, _, name in profiler.marshal.loads(profile["pstats"])}
+print("profiled_work" in functions, "other_work" in functions,
+      profile["duration_ms"] >= 50)
+"""
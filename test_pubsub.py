@@ -0,0 +1,113 @@
+"""Pub/sub and live timeline stream tests."""
+
+import json
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from pubsub import LocalPubSub, PostgresPubSub, SUBSCRIPTION_QUEUE_SIZE
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class LocalPubSubTestCase(TestCase):
+    def test_publish_subscribe(self):
+        """Test subscribers get messages on their channel only, until they
+        unsubscribe"""
+
+        pubsub = LocalPubSub()
+        with pubsub.subscribe("a") as a:
+            with pubsub.subscribe("b") as b:
+                pubsub.publish("a", {"n": 1})
+
+                self.assertEqual(a.get(timeout=1), {"n": 1})
+                self.assertIsNone(b.get(timeout=0.01))
+
+            pubsub.publish("b", {"n": 2})
+            self.assertIsNone(b.get(timeout=0.01))
+
+    def test_slow_subscriber_drops(self):
+        """Test a full subscriber queue drops messages instead of growing"""
+
+        pubsub = LocalPubSub()
+        with pubsub.subscribe("a") as a:
+            for n in range(SUBSCRIPTION_QUEUE_SIZE + 5):
+                pubsub.publish("a", n)
+
+            self.assertEqual(a.queue.qsize(), SUBSCRIPTION_QUEUE_SIZE)
+            self.assertEqual(a.get(), 0)
+
+
+class PostgresPubSubTestCase(TestCase):
+    def test_notify_reaches_listener(self):
+        """Test messages go through Postgres NOTIFY to subscribers"""
+
+        pubsub = PostgresPubSub(app)
+        with pubsub.subscribe("test_channel") as subscription:
+            pubsub.publish("test_channel", {"id": 7})
+            self.assertEqual(subscription.get(timeout=5), {"id": 7})
+
+
+class TimelineStreamTestCase(TestCase):
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(username=f"s{i}", email=f"s{i}@email.com",
+                      password="x")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add(Follows(user_following_id=users[0].id,
+                               user_being_followed_id=users[1].id))
+        db.session.commit()
+
+        self.reader_id, self.followed_id, self.stranger_id = [
+            u.id for u in users]
+        app.config['TIMELINE_STREAM_ENABLED'] = True
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['TIMELINE_STREAM_ENABLED'] = False
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def test_stream_followed_messages(self):
+        """Test the stream sends new messages by followed users only"""
+
+        resp = self.client_for(self.reader_id).get(
+            "/timeline/stream", buffered=False)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        events = iter(resp.response)
+
+        # Subscribed once the first event is out.
+        self.assertEqual(next(events), b"retry: 5000\n\n")
+
+        self.client_for(self.stranger_id).post(
+            "/messages/new", data={"text": "not for you"})
+        self.client_for(self.followed_id).post(
+            "/messages/new", data={"text": "for you"})
+
+        msg = Message.query.filter_by(text="for you").one()
+        self.assertEqual(
+            json.loads(next(events).decode().removeprefix("data: ")),
+            {"id": msg.id, "user_id": self.followed_id})
+        resp.close()
+
+    def test_stream_disabled(self):
+        """Test sync workers tell browsers not to stream"""
+
+        app.config['TIMELINE_STREAM_ENABLED'] = False
+        resp = self.client_for(self.reader_id).get("/timeline/stream")
+        self.assertEqual(resp.status_code, 204)
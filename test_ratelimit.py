@@ -0,0 +1,121 @@
+"""Rate limiting and load shedding tests."""
+
+import os
+import time
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import ratelimit
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class MemoryBackendTestCase(TestCase):
+    def test_bucket_empties_and_refills(self):
+        """Test a 2/minute bucket allows a burst of 2, then one every 30s"""
+
+        backend = ratelimit.MemoryBackend()
+
+        self.assertEqual(backend.consume("k", 2, 60, now=0), 0)
+        self.assertEqual(backend.consume("k", 2, 60, now=0), 0)
+        self.assertAlmostEqual(backend.consume("k", 2, 60, now=0), 30)
+        self.assertEqual(backend.consume("other", 2, 60, now=0), 0)
+        self.assertEqual(backend.consume("k", 2, 60, now=31), 0)
+
+    def test_prune_drops_full_buckets(self):
+        """Test pruning forgets buckets that have refilled"""
+
+        backend = ratelimit.MemoryBackend()
+        backend.consume("old", 2, 60, now=0)
+        backend.consume("new", 2, 60, now=100)
+        backend._prune(now=100)
+
+        self.assertEqual(list(backend._buckets), ["new"])
+
+
+class RateLimitViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        self.old_backend = app.extensions['ratelimit']
+        app.extensions['ratelimit'] = ratelimit.MemoryBackend()
+        app.config['RATELIMITS'] = {"login": "2/minute"}
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions['ratelimit'] = self.old_backend
+        app.config['RATELIMITS'] = {}
+
+    def test_login_limited_per_ip(self):
+        """Test a third login POST in a minute gets 429, but GETs don't"""
+
+        data = {"username": "nobody", "password": "password"}
+
+        with self.client as c:
+            self.assertEqual(c.post("/login", data=data).status_code, 200)
+            self.assertEqual(c.post("/login", data=data).status_code, 200)
+
+            resp = c.post("/login", data=data)
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Retry-After", resp.headers)
+
+            self.assertEqual(c.get("/login").status_code, 200)
+
+            other_ip = c.post("/login", data=data,
+                              environ_base={"REMOTE_ADDR": "10.0.0.2"})
+            self.assertEqual(other_ip.status_code, 200)
+
+    def test_shed_when_queued_too_long(self):
+        """Test limited views 503 when the router queue wait is too long"""
+
+        queued_at = (time.time() - 10) * 1000
+
+        with self.client as c:
+            resp = c.post("/login",
+                          data={"username": "nobody", "password": "password"},
+                          headers={"X-Request-Start": f"t={queued_at:.0f}"})
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn("Retry-After", resp.headers)
+
+    def test_nginx_request_start_in_seconds(self):
+        """Test nginx's t=<seconds>.<millis> header is read as seconds"""
+
+        with self.client as c:
+            data = {"username": "nobody", "password": "password"}
+
+            recent = c.post("/login", data=data, headers={
+                "X-Request-Start": f"t={time.time() - 0.1:.3f}"})
+            self.assertEqual(recent.status_code, 200)
+
+            stale = c.post("/login", data=data, headers={
+                "X-Request-Start": f"t={time.time() - 10:.3f}"})
+            self.assertEqual(stale.status_code, 503)
+
+    def test_unlisted_view_uses_default_limit(self):
+        """Test a limited view with no configured limit gets the default"""
+
+        app.config['RATELIMIT_DEFAULT'] = "1/minute"
+
+        with app.test_request_context("/"):
+            ratelimit.check_limit("not_configured")
+            with self.assertRaises(ratelimit.TooManyRequests):
+                ratelimit.check_limit("not_configured")
+
+        app.config['RATELIMIT_DEFAULT'] = "60/minute"
+
+    def test_failed_query_leaves_no_timer(self):
+        """Test a query that errors doesn't leave its start time behind"""
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.exec_driver_sql("SELECT * FROM no_such_table")
+            self.assertEqual(conn.info.get("query_start"), [])
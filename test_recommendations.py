@@ -0,0 +1,88 @@
+"""Who-to-follow recommendation tests."""
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Follows, Recommendation
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from recommendations import (
+    build_graph, compute_recommendations, refresh_recommendations)
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class RecommendationsComputeTestCase(TestCase):
+    def test_friends_of_friends_and_mutual(self):
+        """Test scores count shared followees plus follow-backs, and skip
+        self and users already followed"""
+
+        # 1 follows 2 and 3; 2 and 3 both follow 4; 3 follows 1; 5 follows 1
+        followers = np.array([1, 1, 2, 3, 3, 5])
+        followed = np.array([2, 3, 4, 4, 1, 1])
+
+        A, user_ids = build_graph(followers, followed)
+        recs = {int(user_ids[row]): dict(zip(user_ids[cands].tolist(),
+                                             scores.tolist()))
+                for row, cands, scores in compute_recommendations(A)}
+
+        # 4 is followed by two of 1's followees; 5 follows 1 back.
+        self.assertEqual(recs[1], {4: 2.0, 5: 2.0})
+
+    def test_small_chunks_give_same_results(self):
+        """Test chunking rows doesn't change the results"""
+
+        rng = np.random.default_rng(1)
+        A, _ = build_graph(rng.integers(0, 50, 400), rng.integers(0, 50, 400))
+
+        whole = [(row, list(c)) for row, c, _ in compute_recommendations(A)]
+        chunked = [(row, list(c)) for row, c, _
+                   in compute_recommendations(A, max_nnz=10)]
+
+        self.assertEqual(whole, chunked)
+
+
+class RecommendationsViewTestCase(TestCase):
+    def setUp(self):
+        Follows.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u3_id = u3.id
+
+        db.session.add_all([
+            Follows(user_following_id=u1.id, user_being_followed_id=u2.id),
+            Follows(user_following_id=u2.id, user_being_followed_id=u3.id),
+        ])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_refresh_and_homepage_sidebar(self):
+        """Test stored recommendations show on the homepage"""
+
+        self.assertGreater(refresh_recommendations(), 0)
+        recs = Recommendation.query.filter_by(user_id=self.u1_id).all()
+        self.assertEqual([r.recommended_user_id for r in recs], [self.u3_id])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['curr_user'] = self.u1_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn(f'action="/users/follow/{self.u3_id}"', html)
@@ -0,0 +1,210 @@
+"""Sharding tests, with SQLite files standing in for the shards."""
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import delete, insert, select
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, timeline_for, CURR_USER_KEY
+import sharding
+
+folder = tempfile.mkdtemp()
+
+app = create_app({
+    'WTF_CSRF_ENABLED': False,
+    'SHARDS': [f"sqlite:///{folder}/shard{n}.db" for n in range(3)],
+    'SHARD_BACKFILL_CHECK_SECONDS': 0,
+})
+
+
+def shard_rows(n, table):
+    with app.app_context():
+        engine = sharding.get_shards().engines[n]
+        with engine.connect() as conn:
+            return conn.execute(select(table)).all()
+
+
+class ShardingTestCase(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(folder)
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(username=f"u{i}", email=f"u{i}@email.com",
+                      password="x")
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = [u.id for u in users]
+
+        sharding.backfill()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def shard_of(self, user_id):
+        return sharding.get_shards().index_for(user_id)
+
+    def test_writes_go_to_owners_shard(self):
+        """Test messages, follows and likes land on their owner's shard"""
+
+        author, reader = self.ids[0], self.ids[1]
+
+        self.client_for(author).post("/messages/new", data={"text": "hi"})
+        self.client_for(reader).post(f"/users/follow/{author}")
+        msg_id = Message.query.filter_by(text="hi").one().id
+        self.client_for(reader).post(f"/messages/{msg_id}/like")
+
+        [row] = shard_rows(self.shard_of(author), sharding.messages)
+        self.assertEqual((row.id, row.user_id), (msg_id, author))
+        self.assertEqual(shard_rows(self.shard_of(reader), sharding.follows),
+                         [(reader, author)])
+        self.assertEqual(
+            [(like.user_id, like.message_id)
+             for like in shard_rows(self.shard_of(reader), sharding.likes)],
+            [(reader, msg_id)])
+
+        self.client_for(author).post("/users/delete")
+        for n in range(3):
+            self.assertEqual(shard_rows(n, sharding.messages), [])
+            self.assertEqual(shard_rows(n, sharding.follows), [])
+            self.assertEqual(shard_rows(n, sharding.likes), [])
+
+    def test_timeline_merges_shards(self):
+        """Test the sharded timeline matches the main database's"""
+
+        now = datetime.utcnow()
+        db.session.add_all([
+            Message(text=f"m{n}", user_id=self.ids[n % 4],
+                    timestamp=now - timedelta(minutes=n * 7 % 31))
+            for n in range(30)])
+        db.session.commit()
+        sharding.backfill()
+
+        expected = Message.timeline(self.ids[:3], limit=10)
+        merged = sharding.timeline_messages(self.ids[:3], limit=10)
+
+        self.assertEqual([m.id for m in merged], [m.id for m in expected])
+        self.assertEqual(merged[0].user.username, expected[0].user.username)
+
+        html = self.client_for(self.ids[0]).get("/").get_data(as_text=True)
+        self.assertIn("m28", html)
+
+    def test_backfill(self):
+        """Test backfill copies existing rows to their shards"""
+
+        msg = Message(text="old", user_id=self.ids[2])
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add_all([
+            Follows(user_following_id=self.ids[3],
+                    user_being_followed_id=self.ids[2]),
+            Like(user_id=self.ids[3], message_id=msg.id),
+        ])
+        db.session.commit()
+
+        self.assertEqual(sharding.backfill(), (1, 1, 1))
+        self.assertEqual(
+            len(shard_rows(self.shard_of(self.ids[2]), sharding.messages)), 1)
+        self.assertEqual(
+            len(shard_rows(self.shard_of(self.ids[3]), sharding.likes)), 1)
+
+    def test_backfill_keeps_and_prunes_rows(self):
+        """Test backfill leaves dual-written rows and drops ones gone from
+        the main database"""
+
+        author = self.ids[0]
+        self.client_for(author).post("/messages/new", data={"text": "kept"})
+        msg_id = Message.query.filter_by(text="kept").one().id
+
+        shard = sharding.get_shards().for_user(author)
+        with shard.begin() as conn:
+            conn.execute(insert(sharding.messages), dict(
+                id=msg_id + 1000, text="deleted", timestamp=datetime.utcnow(),
+                user_id=author))
+
+        self.assertEqual(sharding.backfill(), (1, 0, 0))
+        self.assertEqual(
+            [row.id for row in shard_rows(self.shard_of(author),
+                                          sharding.messages)],
+            [msg_id])
+
+    def test_reads_main_db_during_backfill(self):
+        """Test the homepage isn't read from the shards mid-backfill"""
+
+        self.assertTrue(sharding.serving())
+
+        with sharding.get_shards().engines[0].begin() as conn:
+            conn.execute(insert(sharding.backfills),
+                         dict(started_at=datetime.utcnow()))
+        self.assertFalse(sharding.serving())
+
+        with sharding.get_shards().engines[0].begin() as conn:
+            conn.execute(delete(sharding.backfills))
+        self.assertTrue(sharding.serving())
+
+    def test_follows_and_likes_read_from_shards(self):
+        """Test the homepage takes follows and likes from the shards"""
+
+        author, reader = self.ids[0], self.ids[1]
+        self.client_for(author).post("/messages/new", data={"text": "hi"})
+        self.client_for(reader).post(f"/users/follow/{author}")
+        msg_id = Message.query.filter_by(text="hi").one().id
+        self.client_for(reader).post(f"/messages/{msg_id}/like")
+
+        self.assertEqual(sharding.following_ids(reader), {author})
+        self.assertEqual(sharding.liked_among(reader, [msg_id]), {msg_id})
+        self.assertEqual([m.id for m in timeline_for(User.query.get(reader))],
+                         [msg_id])
+
+    def test_late_writes_copy_the_latest_state(self):
+        """Test a follow or like reaching the shard after a later toggle
+        copies what the main database has now, with its timestamp"""
+
+        follower, followed = self.ids[0], self.ids[1]
+        msg = Message(text="hi", user_id=followed)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        liked_at = datetime(2020, 1, 2, 3, 4, 5)
+        db.session.add(Like(user_id=follower, message_id=msg_id,
+                            timestamp=liked_at))
+        db.session.commit()
+
+        # Writes for a follow already undone and a like still there.
+        sharding.like_changed(follower, msg_id)
+        sharding.follow_changed(follower, followed)
+
+        shard = self.shard_of(follower)
+        self.assertEqual(shard_rows(shard, sharding.follows), [])
+        self.assertEqual(
+            [(like.message_id, like.timestamp)
+             for like in shard_rows(shard, sharding.likes)],
+            [(msg_id, liked_at)])
+
+        Like.query.delete()
+        db.session.commit()
+        sharding.like_changed(follower, msg_id)
+        self.assertEqual(shard_rows(shard, sharding.likes), [])
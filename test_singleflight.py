@@ -0,0 +1,186 @@
+"""Single-flight cache tests."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from singleflight import SingleFlight, check_private_folder
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class SlowCounter:
+    """A compute function that takes a while and counts its calls."""
+
+    def __init__(self, seconds=0.05):
+        self.seconds = seconds
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.seconds)
+        return self.calls
+
+
+def run_together(n, target):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(target()))
+               for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class SingleFlightTestCase(TestCase):
+    def test_concurrent_misses_compute_once(self):
+        """Test concurrent misses for a key share one computation"""
+
+        cache = SingleFlight(ttl=60, stale=0)
+        compute = SlowCounter()
+
+        results = run_together(20, lambda: cache.get(("t", 1), compute))
+
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(results, [1] * 20)
+
+    def test_stale_served_while_refreshing(self):
+        """Test expired values are served while one caller refreshes"""
+
+        cache = SingleFlight(ttl=0, stale=60)
+        compute = SlowCounter()
+        cache.get(("t", 1), compute)
+
+        results = run_together(10, lambda: cache.get(("t", 1), compute))
+
+        self.assertEqual(compute.calls, 2)
+        self.assertEqual(sorted(results), [1] * 9 + [2])
+
+    def test_invalidate_during_compute(self):
+        """Test a computation that started before invalidate() isn't kept"""
+
+        cache = SingleFlight(ttl=60, stale=0)
+
+        def compute():
+            cache.invalidate(("t", 1))
+            return "old"
+
+        self.assertEqual(cache.get(("t", 1), compute), "old")
+        self.assertEqual(cache.get(("t", 1), lambda: "new"), "new")
+
+    def test_evicts_oldest(self):
+        """Test the per-worker cache stays under max_entries"""
+
+        cache = SingleFlight(ttl=60, stale=0, max_entries=2)
+        for n in range(3):
+            cache.get(("t", n), lambda: n)
+
+        self.assertEqual(list(cache._entries), [("t", 1), ("t", 2)])
+
+    def test_shared_between_workers(self):
+        """Test caches sharing a folder compute a key once between them"""
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        workers = [SingleFlight(ttl=60, stale=0, folder=folder)
+                   for _ in range(4)]
+        compute = SlowCounter()
+
+        results = run_together(
+            4, lambda: workers.pop().get(("t", 1), compute))
+
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(results, [1] * 4)
+
+        cache = SingleFlight(ttl=60, stale=0, folder=folder)
+        cache.invalidate(("t", 1))
+        self.assertEqual(cache.get(("t", 1), lambda: 2), 2)
+
+
+class ProfileCacheTestCase(TestCase):
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User(username="u1", email="u1@email.com", password="x")
+        u2 = User(username="u2", email="u2@email.com", password="x")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def test_profile_updates_after_changes(self):
+        """Test posting and following show up on cached profiles"""
+
+        viewer = self.client_for(self.u2_id)
+        html = viewer.get(f"/users/{self.u1_id}").get_data(as_text=True)
+        self.assertNotIn("cached hello", html)
+
+        self.client_for(self.u1_id).post(
+            "/messages/new", data={"text": "cached hello"})
+        viewer.post(f"/users/follow/{self.u1_id}")
+
+        html = viewer.get(f"/users/{self.u1_id}").get_data(as_text=True)
+        self.assertIn("cached hello", html)
+        self.assertIn("Unfollow", html)
+        self.assertIn('id="followers-count">\n                1', html)
+
+    def test_missing_profile(self):
+        """Test unknown users are still a 404"""
+
+        resp = self.client_for(self.u1_id).get("/users/999999")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_sweeps_expired_files(self):
+        """Test files for expired keys are deleted, but not fresh ones"""
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        cache = SingleFlight(ttl=0, stale=0, folder=folder)
+
+        cache.get(("t", 1), lambda: 1)
+        old = time.time() - 10
+        for name in os.listdir(folder):
+            os.utime(os.path.join(folder, name), (old, old))
+
+        cache.ttl = 60
+        cache.get(("t", 2), lambda: 2)
+
+        self.assertEqual(sorted(os.listdir(folder)),
+                         sorted([os.path.basename(cache._path(("t", 2), s))
+                                 for s in ("lock", "pickle")]))
+
+    def test_rejects_shared_folder(self):
+        """Test a folder other users can write to isn't used"""
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        os.chmod(folder, 0o777)
+
+        with self.assertRaises(RuntimeError):
+            check_private_folder(folder)
+
+        os.chmod(folder, 0o700)
+        check_private_folder(folder)
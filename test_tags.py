@@ -0,0 +1,130 @@
+"""Hashtag and mention tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, MessageTag, Mention
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from tags import backfill, hashtags, link_tags, mentioned_usernames
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class TagParsingTestCase(TestCase):
+    def test_hashtags(self):
+        """Test hashtags are found, lowercased and deduplicated"""
+
+        self.assertEqual(hashtags("#Flask and #flask, not a#b or ##c; #x_1!"),
+                         {"flask", "x_1"})
+
+    def test_mentions(self):
+        """Test mentions are found, but not email addresses"""
+
+        self.assertEqual(mentioned_usernames("hi @u1, @u2! me@email.com"),
+                         {"u1", "u2"})
+
+    def test_link_tags(self):
+        """Test link_tags escapes text and links tags, but not entities"""
+
+        self.assertEqual(
+            str(link_tags("it's <b>#Big</b>")),
+            'it&#39;s &lt;b&gt;<a href="/tags/big">#Big</a>&lt;/b&gt;')
+
+
+class TagIndexTestCase(TestCase):
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User(username="u1", email="u1@email.com", password="x")
+        u2 = User(username="u2", email="u2@email.com", password="x")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_add_message_indexes(self):
+        """Test posting a message records its tags and mentions"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new",
+                   data={"text": "#Hello @u2 and @nobody #hello"})
+
+        msg = Message.query.one()
+        self.assertEqual(
+            [(t.tag, t.message_id) for t in MessageTag.query.all()],
+            [("hello", msg.id)])
+        self.assertEqual(
+            [(m.user_id, m.message_id) for m in Mention.query.all()],
+            [(self.u2_id, msg.id)])
+
+    def test_mentions_ignore_case(self):
+        """Test @U2 mentions user u2, as usernames are unique in any case"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "hi @U2 and @u2"})
+
+        msg = Message.query.one()
+        self.assertEqual(
+            [(m.user_id, m.message_id) for m in Mention.query.all()],
+            [(self.u2_id, msg.id)])
+
+    def test_backfill_and_pages(self):
+        """Test backfilling indexes old messages, and tag and mention
+        timelines page newest first"""
+
+        db.session.add_all([Message(text=f"#old{i % 2} @u2", user_id=self.u1_id)
+                            for i in range(5)])
+        db.session.commit()
+
+        self.assertEqual(backfill(batch_size=2), 5)
+        # Rerunning is harmless.
+        self.assertEqual(backfill(batch_size=2), 5)
+
+        ids = [m.id for m in Message.query.order_by(Message.id.desc())]
+        u2 = User.query.get(self.u2_id)
+
+        page, next_before = Message.mentioning(u2, limit=3)
+        self.assertEqual([m.id for m in page], ids[:3])
+
+        page, next_before = Message.mentioning(u2, before=next_before,
+                                               limit=3)
+        self.assertEqual([m.id for m in page], ids[3:])
+        self.assertIsNone(next_before)
+
+        page, _ = Message.tagged("OLD0")
+        self.assertEqual([m.id for m in page], ids[::2])
+
+    def test_tag_page(self):
+        """Test /tags/<tag> shows tagged messages only"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "tagged #yes"})
+            c.post("/messages/new", data={"text": "untagged"})
+
+            resp = c.get("/tags/Yes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<!--Test string for message timeline-->", html)
+            self.assertIn('<a href="/tags/yes">#yes</a>', html)
+            self.assertNotIn("untagged", html)
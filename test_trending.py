@@ -0,0 +1,148 @@
+"""Trending score tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import (
+    db, User, Message, Like, TrendingScore, TRENDING_PERIODS,
+    trending_exponent)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from trending import log_sum_exp, rebuild_trending, top_scores
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+def scores(period):
+    return {row.message_id: row.score
+            for row in TrendingScore.query.filter_by(period=period)}
+
+
+class TrendingTestCase(TestCase):
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        self.users = [User(username=f"t{i}", email=f"t{i}@email.com",
+                           password="x")
+                      for i in range(3)]
+        db.session.add_all(self.users)
+        db.session.flush()
+
+        self.messages = [Message(text=f"m{i}", user_id=self.users[0].id)
+                         for i in range(3)]
+        db.session.add_all(self.messages)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_like_and_unlike_update_scores(self):
+        """Test scores are log-sums of like weights, and unliking takes a
+        like back out"""
+
+        m0 = self.messages[0]
+        self.users[1].toggle_like(m0)
+        self.users[2].toggle_like(m0)
+        db.session.commit()
+
+        liked_at = [like.timestamp
+                    for like in Like.query.filter_by(message_id=m0.id)]
+        for period in TRENDING_PERIODS:
+            expected = log_sum_exp(
+                [trending_exponent(period, t) for t in liked_at])
+            self.assertAlmostEqual(scores(period)[m0.id], expected)
+
+        self.users[2].toggle_like(m0)
+        db.session.commit()
+        self.assertAlmostEqual(
+            scores("day")[m0.id], trending_exponent("day", liked_at[0]))
+
+        self.users[1].toggle_like(m0)
+        db.session.commit()
+        self.assertEqual(scores("day"), {})
+
+    def test_newer_likes_win(self):
+        """Test a message liked twice long ago ranks below one liked once
+        just now"""
+
+        old, new = self.messages[:2]
+        long_ago = datetime.utcnow() - timedelta(days=3)
+        db.session.add_all([
+            Like(user_id=self.users[1].id, message_id=old.id,
+                 timestamp=long_ago),
+            Like(user_id=self.users[2].id, message_id=old.id,
+                 timestamp=long_ago),
+        ])
+        db.session.commit()
+        rebuild_trending()
+
+        self.users[1].toggle_like(new)
+        db.session.commit()
+
+        self.assertEqual(TrendingScore.top("day"), [new, old])
+        # Over a week, three days doesn't fade two likes below one.
+        self.assertEqual(TrendingScore.top("week"), [old, new])
+
+    def test_prune_keeps_best(self):
+        """Test only TRENDING_KEEP scores are kept per period"""
+
+        with patch("models.TRENDING_KEEP", 2):
+            for message in self.messages:
+                self.users[1].toggle_like(message)
+            db.session.commit()
+
+        # The oldest like has the lowest score, so it's the one dropped.
+        self.assertEqual(set(scores("day")),
+                         {m.id for m in self.messages[1:]})
+
+    def test_rebuild_matches_incremental(self):
+        """Test rebuilding from likes gives the scores toggle_like kept"""
+
+        for user in self.users[1:]:
+            for message in self.messages[:2]:
+                user.toggle_like(message)
+        db.session.commit()
+
+        incremental = scores("week")
+        self.assertEqual(rebuild_trending(), 2 * len(TRENDING_PERIODS))
+
+        rebuilt = scores("week")
+        self.assertEqual(set(rebuilt), set(incremental))
+        for message_id, score in rebuilt.items():
+            self.assertAlmostEqual(score, incremental[message_id])
+
+    def test_top_scores_bounded(self):
+        """Test the streaming pass keeps only the best `keep` messages"""
+
+        now = datetime.utcnow()
+        likes = [(1, now - timedelta(days=2)),
+                 (2, now), (2, now),
+                 (3, now - timedelta(days=1))]
+
+        heaps = top_scores(iter(likes), keep=2)
+        self.assertEqual(sorted(m for _, m in heaps["day"]), [2, 3])
+
+    def test_trending_page(self):
+        """Test /trending lists liked messages, best first"""
+
+        self.users[1].toggle_like(self.messages[1])
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.users[1].id
+
+            resp = c.get("/trending?period=week")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<!--Test string for trending page-->", html)
+            self.assertIn("m1", html)
+            self.assertNotIn("m2", html)
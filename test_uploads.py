@@ -0,0 +1,144 @@
+"""Image upload tests."""
+
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import uploads
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+def make_image(color="red", size=(300, 200)):
+    """Return PNG bytes for a solid-color image."""
+
+    out = BytesIO()
+    Image.new("RGB", size, color).save(out, "PNG")
+    return out.getvalue()
+
+
+class UploadsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.upload_dir = tempfile.mkdtemp()
+        self.old_storage = app.extensions['uploads']
+        app.extensions['uploads'] = uploads.LocalStorage(self.upload_dir)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions['uploads'] = self.old_storage
+        shutil.rmtree(self.upload_dir)
+
+    def test_store_image_dedupes_and_makes_thumbnails(self):
+        """Test same bytes stored once, with every avatar thumbnail"""
+
+        with app.app_context():
+            url1, future = uploads.store_image(make_image(), "avatar")
+            future.result()
+            url2, _ = uploads.store_image(make_image(), "avatar")
+
+            self.assertEqual(url1, url2)
+            self.assertTrue(url1.endswith("/original.png"))
+
+            digest = url1.split("/")[2]
+            self.assertEqual(len(os.listdir(os.path.join(self.upload_dir, digest))),
+                             len(uploads.AVATAR_SIZES) + 1)
+
+            with Image.open(os.path.join(self.upload_dir, digest, "48.jpg")) as im:
+                self.assertEqual(im.size, (48, 48))
+
+            self.assertEqual(uploads.thumbnail_url(url1, 48),
+                             f"/uploads/{digest}/48.jpg")
+            self.assertEqual(uploads.thumbnail_url("/static/x.png", 48),
+                             "/static/x.png")
+
+    def test_store_image_rejects_non_images(self):
+        """Test non-image bytes raise InvalidImageError"""
+
+        with app.app_context():
+            with self.assertRaises(uploads.InvalidImageError):
+                uploads.store_image(b"not an image", "avatar")
+
+    def test_store_image_rejects_decompression_bombs(self):
+        """Test images with too many pixels raise InvalidImageError"""
+
+        with app.app_context():
+            with patch.object(Image, "MAX_IMAGE_PIXELS", 1000):
+                with self.assertRaises(uploads.InvalidImageError):
+                    uploads.store_image(make_image(), "avatar")
+
+    def test_concurrent_saves_of_one_key(self):
+        """Test threads saving the same key don't clash over a temp file"""
+
+        storage = uploads.LocalStorage(self.upload_dir)
+        data = make_image()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            for future in [pool.submit(storage.save, "k/original.png", data)
+                           for _ in range(50)]:
+                future.result()
+
+        with open(os.path.join(self.upload_dir, "k/original.png"), "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(os.path.join(self.upload_dir, "k")),
+                         ["original.png"])
+
+    def test_profile_upload(self):
+        """Test profile form upload sets image_url and is served cacheably"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['curr_user'] = self.u1_id
+
+            resp = c.post("/users/profile",
+                          data={
+                              "username": "u1",
+                              "email": "u1@email.com",
+                              "password": "password",
+                              "image_file": (BytesIO(make_image()), "me.png"),
+                          },
+                          content_type="multipart/form-data")
+            self.assertEqual(resp.status_code, 302)
+
+            image_url = User.query.get(self.u1_id).image_url
+            self.assertTrue(image_url.startswith("/uploads/"))
+
+            resp = c.get(image_url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertNotIn("no-store", resp.headers["Cache-Control"])
+
+    def test_store_image_regenerates_missing_thumbnails(self):
+        """Test re-uploading stored bytes remakes thumbnails that are missing"""
+
+        with app.app_context():
+            url, future = uploads.store_image(make_image(), "avatar")
+            future.result()
+
+            digest = url.split("/")[2]
+            os.remove(os.path.join(self.upload_dir, digest, "48.jpg"))
+
+            _, future = uploads.store_image(make_image(), "avatar")
+            future.result()
+
+            self.assertTrue(
+                os.path.exists(os.path.join(self.upload_dir, digest, "48.jpg")))
@@ -148,5 +148,41 @@ class UserModelTestCase(TestCase):
         # u1 is following u2 returns true
         self.assertTrue(u2.is_following(u1))
 
+    def test_follow_unfollow_counts(self):
+        """Test that follow/unfollow keep both users' counters in step"""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual((u1.following_count, u2.followers_count), (1, 1))
+
+        u1.unfollow(u2)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.following_count, u2.followers_count), (0, 0))
+
+    def test_following_page(self):
+        """Test that following_page pages through followed users by id"""
+
+        u1 = User.query.get(self.u1_id)
+        others = [User(username=f"p{i}", email=f"p{i}@email.com", password="x")
+                  for i in range(3)]
+        db.session.add_all(others)
+        db.session.flush()
+        for other in others:
+            u1.follow(other)
+        db.session.commit()
+
+        page1, after = u1.following_page(limit=2)
+        page2, last = u1.following_page(after=after, limit=2)
+
+        self.assertEqual([c.username for c in page1 + page2],
+                         ["p0", "p1", "p2"])
+        self.assertIsNone(last)
+        self.assertEqual(u1.following_ids_among([others[0].id, self.u2_id]),
+                         {others[0].id})
+
 
     #TODO: test relationships (.following, .followers)
\ No newline at end of file
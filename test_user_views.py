@@ -302,6 +302,7 @@ class UsersModifyFollowTestCase(UserBaseViewTestCase):
             self.assertNotIn("@u6", html)
             self.assertEqual(Follows.query.filter_by(user_being_followed_id =
                                                      self.u2_id).count(), 1)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
 
     def test_start_following_not_in_session(self):
         """Test that start_following redirects to register
@@ -335,6 +336,39 @@ class UsersModifyFollowTestCase(UserBaseViewTestCase):
             self.assertEqual(Follows.query.filter_by(user_being_followed_id =
                                                      self.u1_id).count(), 0)
 
+    def test_follow_unfollow_json(self):
+        """Test that follow routes return the new state as JSON when asked,
+        instead of redirecting"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['curr_user'] = self.u1_id
+
+            headers = {"Accept": "application/json"}
+
+            resp = c.post(f"/users/follow/{self.u2_id}", headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"following": True,
+                                         "followers_count": 1,
+                                         "following_count": 1})
+
+            resp = c.post(f"/users/stop-following/{self.u2_id}",
+                          headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"following": False,
+                                         "followers_count": 0,
+                                         "following_count": 0})
+
+    def test_follow_json_not_in_session(self):
+        """Test that follow routes return a 403 to JSON clients when logged
+        out"""
+
+        with self.client as c:
+            resp = c.post(f"/users/follow/{self.u2_id}",
+                          headers={"Accept": "application/json"})
+            self.assertEqual(resp.status_code, 403)
+            self.assertEqual(resp.json, {"error": "Access unauthorized."})
+
     def test_stop_following_not_in_session(self):
         """Test that stop_following redirects to register
         page if user not logged in and flashes unauthorized"""
@@ -0,0 +1,123 @@
+"""Warm-up tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like, Event, AccessCount
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, CURR_USER_KEY
+import warmup
+
+app = create_app({
+    'WTF_CSRF_ENABLED': False,
+    'WARMUP_STATS_SAVE_SECONDS': 0,
+    'SINGLEFLIGHT_TTL': 60,
+})
+
+
+class WarmupTestCase(TestCase):
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        for model in (AccessCount, Event, Like, Follows, Message, User):
+            model.query.delete()
+
+        users = [User(username=f"u{i}", email=f"u{i}@email.com",
+                      password="x")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = [u.id for u in users]
+
+        app.extensions["warmup_stats"] = warmup.AccessStats()
+        app.extensions["singleflight"]._entries.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def test_access_counted_and_saved(self):
+        """Test homepage and profile views are counted and saved"""
+
+        a, b, c = self.ids
+        client = self.client_for(a)
+        client.get("/")
+        client.get(f"/users/{b}")
+        client.get(f"/users/{b}")
+        client.get(f"/users/{c}")
+        client.get("/users/0")
+
+        saved = warmup.load_stats(max_age=3600)
+        self.assertEqual(saved["timeline"], {a: 1})
+        self.assertEqual(saved["profile"], {b: 2, c: 1})
+
+        # Each save starts counting again, so memory stays bounded.
+        self.assertEqual(
+            sum(map(len, app.extensions["warmup_stats"].counts.values())), 0)
+
+    def test_old_stats_ignored(self):
+        """Test stats older than the maximum age are ignored and removed"""
+
+        stats = warmup.AccessStats()
+        stats.record("timeline", self.ids[0])
+        stats.save(max_age=3600)
+        AccessCount.query.update(
+            {AccessCount.hour: datetime.utcnow() - timedelta(days=2)})
+        db.session.commit()
+
+        self.assertEqual(warmup.load_stats(max_age=3600)["timeline"], {})
+
+        warmup.AccessStats().save(max_age=3600)
+        self.assertEqual(AccessCount.query.count(), 0)
+
+    def test_warms_hot_profiles_and_timelines(self):
+        """Test warm-up loads the most viewed profiles into the cache"""
+
+        a, b, c = self.ids
+        stats = warmup.AccessStats()
+        for kind, user_id in [("profile", b), ("profile", b),
+                              ("profile", c), ("timeline", a)]:
+            stats.record(kind, user_id)
+        stats.save(app.config["WARMUP_STATS_MAX_AGE"])
+
+        warmed = warmup.warm_up()
+
+        self.assertFalse(warmed["stopped"])
+        self.assertEqual(warmed["profiles"], 2)
+        self.assertEqual(warmed["timelines"], 1)
+        self.assertGreater(warmed["templates"], 0)
+        self.assertEqual(set(app.extensions["singleflight"]._entries),
+                         {("profile", b), ("profile", c)})
+
+    def test_falls_back_to_event_log(self):
+        """Test the most active users are warmed when there are no stats"""
+
+        self.client_for(self.ids[1]).post("/messages/new",
+                                          data={"text": "hi"})
+        app.extensions["warmup_stats"] = warmup.AccessStats()
+
+        self.assertEqual(warmup.hot_set(10), ([self.ids[1]], [self.ids[1]]))
+
+    def test_stops_at_budget(self):
+        """Test warm-up stops once it runs out of time"""
+
+        stats = warmup.AccessStats()
+        stats.record("profile", self.ids[0])
+        stats.save(app.config["WARMUP_STATS_MAX_AGE"])
+
+        warmed = warmup.warm_up(seconds=0)
+
+        self.assertTrue(warmed["stopped"])
+        self.assertNotIn("profiles", warmed)
+        self.assertEqual(app.extensions["singleflight"]._entries, {})
@@ -0,0 +1,94 @@
+"""Rebuild trending scores from the likes table.
+
+toggle_like keeps trending_scores up to date as likes come and go. This
+recomputes them exactly, e.g. after changing TRENDING_PERIODS, or to
+undo the drift from messages that fell out of the top and came back:
+
+    python trending.py
+
+Likes are streamed in message order, so only one message's likes and a
+TRENDING_KEEP-sized heap per period are in memory at a time. Likes made
+while it runs wait for it to finish, then count as usual.
+"""
+
+import heapq
+import math
+from itertools import groupby
+from operator import itemgetter
+
+from models import (
+    db, Like, TrendingScore, TRENDING_KEEP, TRENDING_PERIODS,
+    trending_exponent)
+
+LIKE_BATCH_SIZE = 10_000
+
+
+def log_sum_exp(exponents):
+    """log(sum(exp(x) for x in exponents)), without overflowing."""
+
+    top = max(exponents)
+    return top + math.log(sum(math.exp(x - top) for x in exponents))
+
+
+def top_scores(likes, keep=TRENDING_KEEP):
+    """Best `keep` scores per period from (message_id, liked_at) pairs.
+
+    `likes` must be sorted by message_id. Returns {period: [(score,
+    message_id), ...]}, in no particular order.
+    """
+
+    heaps = {period: [] for period in TRENDING_PERIODS}
+
+    for message_id, group in groupby(likes, key=itemgetter(0)):
+        liked_at = [timestamp for _, timestamp in group]
+
+        for period, heap in heaps.items():
+            score = log_sum_exp(
+                [trending_exponent(period, t) for t in liked_at])
+
+            if len(heap) < keep:
+                heapq.heappush(heap, (score, message_id))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, message_id))
+
+    return heaps
+
+
+def load_likes():
+    """Stream (message_id, timestamp) for every like, by message."""
+
+    return (db.session
+            .query(Like.message_id, Like.timestamp)
+            .order_by(Like.message_id)
+            .yield_per(LIKE_BATCH_SIZE))
+
+
+def rebuild_trending():
+    """Replace trending_scores with scores computed from likes.
+
+    Returns how many scores were stored.
+    """
+
+    # Block toggle_like's score updates (but not reads) until we commit,
+    # so no like is both missed by our scan and wiped out by our delete.
+    db.session.execute(
+        db.text("LOCK TABLE trending_scores IN EXCLUSIVE MODE"))
+
+    heaps = top_scores(load_likes())
+
+    TrendingScore.query.delete()
+    db.session.bulk_insert_mappings(TrendingScore, [
+        dict(period=period, message_id=message_id, score=score)
+        for period, heap in heaps.items()
+        for score, message_id in heap
+    ])
+    db.session.commit()
+
+    return sum(len(heap) for heap in heaps.values())
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        print(f"Stored {rebuild_trending()} trending scores.")
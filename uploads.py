@@ -0,0 +1,276 @@
+"""Content-addressed storage for uploaded avatar and header images.
+
+Uploads are keyed by the SHA-256 of their bytes, so identical uploads are
+stored once. Thumbnails for the sizes the templates actually render are
+generated in a background thread pool, off the request thread.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from flask import (
+    Blueprint, current_app, redirect, send_from_directory, abort)
+
+from metrics import record_cache
+
+# Square pixel sizes avatars are shown at: navbar (32), timeline (48),
+# user cards (70) and the profile page (200).
+AVATAR_SIZES = (32, 48, 70, 200)
+
+# Widths header images are shown at: user cards and the profile hero.
+HEADER_SIZES = (400, 1300)
+
+THUMBNAIL_SIZES = {
+    "avatar": AVATAR_SIZES,
+    "header": HEADER_SIZES,
+}
+
+ALLOWED_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp"}
+
+# Uploaded files never change once written, so they can be cached forever.
+CACHE_MAX_AGE = 60 * 60 * 24 * 365
+
+UPLOAD_URL_RE = re.compile(r"/uploads/(?P<digest>[0-9a-f]{64})/original\.\w+$")
+
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbnails")
+
+uploads = Blueprint("uploads", __name__)
+
+
+class InvalidImageError(ValueError):
+    """Uploaded file is not an image we accept."""
+
+
+class LocalStorage:
+    """Stores uploads as files under a local directory."""
+
+    def __init__(self, root, url_prefix="/uploads"):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def save(self, key, data):
+        """Write `data` to `key` atomically, so readers never see half a file."""
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Per thread: thumbnail jobs and requests may save the same key.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def url(self, key):
+        return f"{self.url_prefix}/{key}"
+
+
+class S3Storage:
+    """Stores uploads in an S3-compatible bucket.
+
+    Needs boto3, which is only imported when this storage is configured.
+    """
+
+    def __init__(self, bucket, public_url, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client("s3")
+
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/")
+        self.client = client
+
+        # Keys are never overwritten or deleted, so once one is known to
+        # exist we needn't ask S3 again.
+        self.known_keys = set()
+
+    def exists(self, key):
+        if key in self.known_keys:
+            return True
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError:
+            return False
+
+        self.known_keys.add(key)
+        return True
+
+    def save(self, key, data):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=data,
+            CacheControl=f"public, max-age={CACHE_MAX_AGE}, immutable",
+        )
+        self.known_keys.add(key)
+
+    def url(self, key):
+        return f"{self.public_url}/{key}"
+
+
+def get_storage():
+    """Return the storage configured for the current app."""
+
+    return current_app.extensions["uploads"]
+
+
+def store_image(data, kind):
+    """Store uploaded image bytes and queue its thumbnails.
+
+    Returns (url of the original, future for the thumbnail job). Uploading
+    bytes that are already stored returns the existing url, and only redoes
+    thumbnails that are missing (say, because generating them failed).
+
+    Raises InvalidImageError if `data` isn't an image we accept.
+    """
+
+    # Pillow is slow to import, and only needed once someone uploads.
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        image = Image.open(BytesIO(data))
+        image.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise InvalidImageError("Not a valid image.")
+    except Image.DecompressionBombError:
+        raise InvalidImageError("That image is too big.")
+
+    ext = ALLOWED_FORMATS.get(image.format)
+    if ext is None:
+        raise InvalidImageError(f"Unsupported image format: {image.format}")
+
+    storage = get_storage()
+    digest = hashlib.sha256(data).hexdigest()
+    key = f"{digest}/original.{ext}"
+
+    already_stored = storage.exists(key)
+    record_cache("uploads", already_stored)
+
+    if not already_stored:
+        storage.save(key, data)
+
+    if already_stored and all(storage.exists(f"{digest}/{size}.jpg")
+                              for size in THUMBNAIL_SIZES[kind]):
+        future = executor.submit(lambda: None)
+    else:
+        future = executor.submit(make_thumbnails, storage, digest, data, kind)
+        future.add_done_callback(
+            _log_thumbnail_failure(current_app.logger, digest))
+
+    return storage.url(key), future
+
+
+def _log_thumbnail_failure(logger, digest):
+    """Return a future callback logging any error making `digest`'s thumbnails.
+
+    Nothing else waits on the thumbnail job, so without this its errors
+    would vanish with the future.
+    """
+
+    def callback(future):
+        error = future.exception()
+        if error is not None:
+            logger.error("Making thumbnails for %s failed", digest,
+                         exc_info=error)
+
+    return callback
+
+
+def make_thumbnails(storage, digest, data, kind):
+    """Write every thumbnail size for `kind` next to the original."""
+
+    from PIL import Image
+
+    for size in THUMBNAIL_SIZES[kind]:
+        image = Image.open(BytesIO(data))
+        image = image.convert("RGB")
+
+        if kind == "avatar":
+            side = min(image.size)
+            left = (image.width - side) // 2
+            top = (image.height - side) // 2
+            image = image.crop((left, top, left + side, top + side))
+            image = image.resize((size, size), Image.LANCZOS)
+        else:
+            image.thumbnail((size, size * 4), Image.LANCZOS)
+
+        out = BytesIO()
+        image.save(out, "JPEG", quality=85, optimize=True)
+        storage.save(f"{digest}/{size}.jpg", out.getvalue())
+
+
+def thumbnail_url(url, size):
+    """Jinja filter: url of the `size` thumbnail for an uploaded image.
+
+    Urls that aren't uploads (defaults, external links) come back unchanged.
+    Local thumbnails that don't exist yet redirect to the original when
+    served; other storage is checked here, falling back to the original.
+    """
+
+    match = UPLOAD_URL_RE.search(url or "")
+    if not match:
+        return url
+
+    storage = get_storage()
+    key = f"{match['digest']}/{size}.jpg"
+
+    if not isinstance(storage, LocalStorage) and not storage.exists(key):
+        return url
+
+    return storage.url(key)
+
+
+@uploads.get("/uploads/<digest>/<filename>")
+def serve_upload(digest, filename):
+    """Serve an uploaded file from local storage with long-lived caching.
+
+    A thumbnail that hasn't been generated yet redirects to the original.
+    """
+
+    storage = get_storage()
+    key = f"{digest}/{filename}"
+
+    if (not isinstance(storage, LocalStorage)
+            or not re.fullmatch(r"[0-9a-f]{64}", digest)):
+        abort(404)
+
+    if not storage.exists(key):
+        originals = [f"{digest}/original.{ext}"
+                     for ext in ALLOWED_FORMATS.values()]
+        for original in originals:
+            if storage.exists(original):
+                return redirect(storage.url(original))
+        abort(404)
+
+    response = send_from_directory(storage.root, key)
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    """Set up upload storage, routes and the `thumbnail` filter on `app`."""
+
+    app.config.setdefault(
+        "UPLOAD_FOLDER", os.path.join(app.instance_path, "uploads"))
+    app.config.setdefault("MAX_CONTENT_LENGTH", 8 * 1024 * 1024)
+
+    if app.config.get("UPLOAD_S3_BUCKET"):
+        storage = S3Storage(
+            app.config["UPLOAD_S3_BUCKET"], app.config["UPLOAD_S3_URL"])
+    else:
+        storage = LocalStorage(app.config["UPLOAD_FOLDER"])
+
+    app.extensions["uploads"] = storage
+    app.register_blueprint(uploads)
+    app.add_template_filter(thumbnail_url, "thumbnail")
@@ -0,0 +1,296 @@
+"""Warm a fresh worker up before (or while) it takes traffic.
+
+After a deploy every worker starts cold, and the busiest users all hit
+their homepages and favourite profiles at once. warm_up() gets ahead of
+them, most important first:
+
+- templates, compiled (or loaded from the bytecode cache)
+- the DB pool's connections, opened
+- the autocomplete index and availability filter, loading in the
+  background
+- for the hottest users and profiles, taking turns:
+  - the homepage timeline query, so Postgres has their messages in
+    memory and SQLAlchemy has the statements compiled
+  - the cached profile snapshot (singleflight), so the first visitors
+    get it without waiting
+
+"Hottest" comes from access statistics. Each worker counts who loads
+their homepage and which profiles are viewed, and every
+WARMUP_STATS_SAVE_SECONDS it adds its counts to the hourly totals in the
+access_counts table, which (unlike the filesystem on most platforms)
+outlives deploys, and starts counting again. If nothing has been saved
+in the last WARMUP_STATS_MAX_AGE seconds, the most active users in the
+event log are used instead.
+
+Warming stops at WARMUP_SECONDS, or when the worker has grown by
+WARMUP_MEMORY_MB, whichever comes first. WARMUP picks when it runs:
+
+    boot        in post_fork, before the worker accepts requests (keep
+                WARMUP_SECONDS under gunicorn's --timeout)
+    background  in a thread, while the worker serves requests
+    (empty)     not at all
+
+What was warmed is logged and counted in warbler_warmup_items_total.
+"""
+
+import os
+import resource
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from flask import current_app, g, request
+from prometheus_client import Counter as PrometheusCounter, Gauge
+from sqlalchemy import delete, func
+
+import autocomplete
+import availability
+import events
+import template_cache
+from models import db, AccessCount, Event, User
+
+WARMUP_ITEMS = PrometheusCounter(
+    "warbler_warmup_items_total",
+    "Things loaded by warm-up, by kind.",
+    ["kind"])
+
+WARMUP_DURATION = Gauge(
+    "warbler_warmup_duration_seconds",
+    "How long this worker's warm-up took.",
+    multiprocess_mode="liveall")
+
+# Requests counted towards each kind of hot item.
+COUNTED_ENDPOINTS = {
+    "warbler.homepage": "timeline",
+    "warbler.show_user": "profile",
+}
+
+MB = 1024 * 1024
+
+
+class AccessStats:
+    """How often each user's timeline and each profile was loaded."""
+
+    def __init__(self):
+        self.counts = {kind: Counter() for kind in COUNTED_ENDPOINTS.values()}
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+
+    def record(self, kind, user_id):
+        with self._lock:
+            self.counts[kind][user_id] += 1
+
+    def save(self, max_age):
+        """Add the counts so far to the database's, and start again.
+
+        Counts that fail to save are dropped; they're only a hint.
+        Also forgets totals more than `max_age` seconds old.
+        """
+
+        with self._lock:
+            counts = self.counts
+            self.counts = {kind: Counter() for kind in counts}
+            self._saved_at = time.monotonic()
+
+        now = datetime.utcnow()
+        hour = now.replace(minute=0, second=0, microsecond=0)
+
+        with db.engine.begin() as connection:
+            for kind, kind_counts in counts.items():
+                AccessCount.add(connection, kind, kind_counts, hour)
+            connection.execute(delete(AccessCount).where(
+                AccessCount.hour < now - timedelta(seconds=max_age)))
+
+    def save_due(self, seconds):
+        return time.monotonic() - self._saved_at >= seconds
+
+
+def load_stats(max_age):
+    """Add up the counts saved in the last `max_age` seconds."""
+
+    since = datetime.utcnow() - timedelta(seconds=max_age)
+    saved = AccessCount.totals(since)
+
+    return {kind: Counter(saved.get(kind, {}))
+            for kind in COUNTED_ENDPOINTS.values()}
+
+
+def active_users(limit, hours=24):
+    """The users with the most events in the last `hours` hours."""
+
+    since = datetime.utcnow() - timedelta(hours=hours)
+    return [user_id for user_id, in (
+        db.session
+        .query(Event.user_id)
+        .filter(Event.created_at >= since,
+                Event.type.notin_(events.MAINTENANCE))
+        .group_by(Event.user_id)
+        .order_by(func.count().desc())
+        .limit(limit))]
+
+
+def hot_set(limit):
+    """(timeline user ids, profile user ids) to warm, hottest first."""
+
+    config = current_app.config
+    stats = load_stats(config["WARMUP_STATS_MAX_AGE"])
+    # This worker's own counts, when it's warming in the background.
+    for kind, counts in get_stats().counts.items():
+        stats[kind].update(counts)
+
+    timelines = [id for id, _ in stats["timeline"].most_common(limit)]
+    profiles = [id for id, _ in stats["profile"].most_common(limit)]
+
+    if not timelines and not profiles:
+        timelines = profiles = active_users(limit)
+
+    return timelines, profiles
+
+
+def _rss():
+    """This process's resident memory, in bytes."""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current, but it's what there is.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _open_pool(size):
+    connections = [db.engine.connect() for _ in range(size)]
+    for connection in connections:
+        connection.close()
+    return len(connections)
+
+
+def _warm_timeline(user_id):
+    from app import timeline_for
+
+    user = User.query.get(user_id)
+    if user is not None:
+        timeline_for(user)
+    return user is not None
+
+
+def _warm_profile(user_id):
+    from app import profile_snapshot
+
+    return profile_snapshot(user_id) is not None
+
+
+def warm_up(seconds=None, memory_mb=None):
+    """Warm this worker's caches, within the time and memory budgets.
+
+    Needs an app context. Returns the number of things warmed by kind,
+    plus "seconds" taken and whether it "stopped" early for a budget.
+    """
+
+    config = current_app.config
+    seconds = config["WARMUP_SECONDS"] if seconds is None else seconds
+    memory_mb = config["WARMUP_MEMORY_MB"] if memory_mb is None else memory_mb
+
+    started = time.monotonic()
+    deadline = started + seconds
+    memory_limit = _rss() + memory_mb * MB
+    warmed = Counter()
+
+    def over_budget():
+        return time.monotonic() >= deadline or _rss() >= memory_limit
+
+    def warm(kind, load, *args):
+        count = int(load(*args))
+        warmed[kind] += count
+        WARMUP_ITEMS.labels(kind).inc(count)
+
+    warm("templates", template_cache.precompile_templates, current_app)
+    warm("connections", _open_pool,
+         config["SQLALCHEMY_ENGINE_OPTIONS"].get("pool_size", 5))
+    autocomplete.get_autocomplete().start()
+    availability.get_availability().start()
+
+    timelines, profiles = hot_set(config["WARMUP_MAX_USERS"])
+    stopped = False
+    for n in range(max(len(timelines), len(profiles))):
+        if over_budget():
+            stopped = True
+            break
+        try:
+            if n < len(timelines):
+                warm("timelines", _warm_timeline, timelines[n])
+            if n < len(profiles):
+                warm("profiles", _warm_profile, profiles[n])
+        finally:
+            db.session.remove()
+
+    elapsed = time.monotonic() - started
+    WARMUP_DURATION.set(elapsed)
+    current_app.logger.info(
+        "Warmed up in %.2fs%s: %s", elapsed,
+        " (stopped at budget)" if stopped else "",
+        ", ".join(f"{n} {kind}" for kind, n in warmed.items()))
+
+    return dict(warmed, seconds=elapsed, stopped=stopped)
+
+
+def start(app):
+    """Warm `app` up as its WARMUP setting says; for gunicorn's post_fork."""
+
+    def run():
+        with app.app_context():
+            try:
+                warm_up()
+            except Exception:
+                app.logger.exception("Warm-up failed")
+
+    if app.config["WARMUP"] == "boot":
+        run()
+    elif app.config["WARMUP"] == "background":
+        threading.Thread(target=run, name="warmup", daemon=True).start()
+
+
+def get_stats():
+    return current_app.extensions["warmup_stats"]
+
+
+def count_access(response):
+    """Count this request towards its user's or profile's heat, and save
+    the counts now and then."""
+
+    kind = COUNTED_ENDPOINTS.get(request.endpoint)
+    if kind is None or response.status_code != 200:
+        return response
+
+    if kind == "timeline":
+        user_id = g.user.id if g.get("user") else None
+    else:
+        user_id = request.view_args.get("user_id")
+
+    if user_id is not None:
+        stats = get_stats()
+        stats.record(kind, user_id)
+
+        config = current_app.config
+        if stats.save_due(config["WARMUP_STATS_SAVE_SECONDS"]):
+            try:
+                stats.save(config["WARMUP_STATS_MAX_AGE"])
+            except Exception:
+                current_app.logger.exception("Couldn't save access stats")
+
+    return response
+
+
+def init_app(app):
+    """Count accesses for `app`'s warm-ups."""
+
+    app.config.setdefault("WARMUP", "")
+    app.config.setdefault("WARMUP_SECONDS", 10)
+    app.config.setdefault("WARMUP_MEMORY_MB", 64)
+    app.config.setdefault("WARMUP_MAX_USERS", 500)
+    app.config.setdefault("WARMUP_STATS_SAVE_SECONDS", 60)
+    app.config.setdefault("WARMUP_STATS_MAX_AGE", 24 * 3600)
+
+    app.extensions["warmup_stats"] = AccessStats()
+    app.after_request(count_access)